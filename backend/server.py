@@ -1,21 +1,50 @@
-from fastapi import FastAPI, APIRouter, HTTPException, File, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, File, UploadFile, Query, Request, Response
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+import pymongo
+from pymongo import monitoring
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, SecondaryPreferred
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from bson import ObjectId, Timestamp
+from bson.errors import InvalidId
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 import uuid
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from enum import Enum
+from collections import OrderedDict, defaultdict, deque
+import asyncio
 import base64
-
-# Global variable to store doctor image (in production, this would be in database)
-DOCTOR_IMAGE_DATA = "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAMCAgMCAgMDAwMEAwMEBQgFBQQEBQoHBwYIDAoMDAsKCwsNDhIQDQ4RDgsLEBYQERMUFRUVDA8XGBYUGBIUFRT/2wBDAQMEBAUEBQkFBQkUDQsNFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBT/wAARCAFAAUADASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwD8/KKKKACKKKACKKKAKKKKA"
+import bisect
+import contextlib
+import contextvars
+import csv
+import functools
+import hashlib
+import importlib.util
+import io
+import json
+import jwt
+import math
+import orjson
+import re
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+from zoneinfo import ZoneInfo
+
+# Default doctor image, stored in db.doctor_images on first startup
+DEFAULT_DOCTOR_IMAGE_DATA = "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDAAMCAgMCAgMDAwMEAwMEBQgFBQQEBQoHBwYIDAoMDAsKCwsNDhIQDQ4RDgsLEBYQERMUFRUVDA8XGBYUGBIUFRT/2wBDAQMEBAUEBQkFBQkUDQsNFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBQUFBT/wAARCAFAAUADASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwD8/KKKKACKKKACKKKAKKKKA"
 
 # Pydantic models for request bodies
 class DoctorImageUpdate(BaseModel):
@@ -24,10 +53,1612 @@ class DoctorImageUpdate(BaseModel):
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# Metrics, exposed in Prometheus text format on /api/metrics. pymongo calls
+# its listeners from Motor's worker threads, so every update takes the lock.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152)
+EVENT_LOOP_SAMPLE_SECONDS = 0.5
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, *label_values, value: float):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *label_values, value: float):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][position] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {label_values: (list(counts), total, count) for label_values, (counts, total, count) in self.values.items()}
+
+    def quantile(self, counts: List[int], count: int, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile, None past the last bucket"""
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= q * count:
+                return bound
+        return None
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(names, label_values + (f'{bound:g}',))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(names, label_values + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route template and status", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "Time until response headers are sent", ("method", "route"))
+HTTP_RESPONSE_SIZE = Histogram("http_response_size_bytes", "Response body size", ("method", "route"), SIZE_BUCKETS)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled")
+MONGO_COMMAND_LATENCY = Histogram("mongodb_command_duration_seconds", "MongoDB command round trip", ("collection", "command"))
+MONGO_COMMAND_FAILURES = Counter("mongodb_command_failures_total", "Failed MongoDB commands", ("collection", "command"))
+MONGO_CHECKOUT_WAIT = Histogram("mongodb_pool_checkout_wait_seconds", "Wait for a pooled connection", ("address",))
+MONGO_CHECKOUT_FAILURES = Counter("mongodb_pool_checkout_failures_total", "Failed connection checkouts", ("address", "reason"))
+MONGO_CONNECTIONS = Gauge("mongodb_pool_connections", "Open pooled connections", ("address",))
+MONGO_CONNECTIONS_IN_USE = Gauge("mongodb_pool_connections_in_use", "Checked out pooled connections", ("address",))
+MONGO_CONNECTIONS_CREATED = Counter("mongodb_pool_connections_created_total", "Pooled connections opened", ("address",))
+MONGO_CONNECTIONS_CLOSED = Counter("mongodb_pool_connections_closed_total", "Pooled connections closed by reason", ("address", "reason"))
+MONGO_POOL_CLEARED = Counter("mongodb_pool_cleared_total", "Pool clears after network errors or failovers", ("address",))
+EVENT_LOOP_LAG = Histogram("event_loop_lag_seconds", "Delay of a scheduled event loop wakeup")
+JOBS_PROCESSED = Counter("jobs_processed_total", "Background job attempts by outcome", ("type", "outcome"))
+RATE_LIMITED = Counter("http_rate_limited_total", "Requests rejected by the rate limiter", ("route",))
+ADMISSION_REJECTED = Counter("http_admission_rejected_total", "Requests shed by the concurrency limiter", ("priority",))
+ADMISSION_IN_FLIGHT = Gauge("http_admission_in_flight", "Requests holding a concurrency limiter slot")
+CONCURRENCY_LIMIT = Gauge("http_concurrency_limit", "Current adaptive concurrency limit")
+MONGO_WINDOW_LATENCY = Gauge("mongodb_window_latency_seconds", "Mean command plus checkout latency of the last limiter window")
+UNREAD_DRIFT = Counter("unread_counter_drift_total", "Negative unread counters read, shown as 0 until rebuilt", ("counter",))
+DEADLINE_EXCEEDED = Counter(
+    "request_deadline_exceeded_total", "MongoDB work that missed the request deadline, by handler and response", ("handler", "outcome")
+)
+
+METRICS = [
+    HTTP_REQUESTS, HTTP_LATENCY, HTTP_RESPONSE_SIZE, HTTP_IN_FLIGHT,
+    MONGO_COMMAND_LATENCY, MONGO_COMMAND_FAILURES,
+    MONGO_CHECKOUT_WAIT, MONGO_CHECKOUT_FAILURES, MONGO_CONNECTIONS, MONGO_CONNECTIONS_IN_USE,
+    MONGO_CONNECTIONS_CREATED, MONGO_CONNECTIONS_CLOSED, MONGO_POOL_CLEARED,
+    EVENT_LOOP_LAG, JOBS_PROCESSED, RATE_LIMITED,
+    ADMISSION_REJECTED, ADMISSION_IN_FLIGHT, CONCURRENCY_LIMIT, MONGO_WINDOW_LATENCY, DEADLINE_EXCEEDED,
+]
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+class CommandMetrics(monitoring.CommandListener):
+    """Per collection and operation timing of every command sent to MongoDB"""
+
+    def __init__(self):
+        self.collections = {}
+        # Change stream and tailable awaitData cursors, whose getMores block until data
+        # arrives by design and say nothing about load, so they stay out of the limiter
+        self.long_poll_cursors: Set[int] = set()
+
+    def started(self, event):
+        command = event.command
+        name = event.command_name
+        target = command.get("collection") if name == "getMore" else command.get(name)
+        opens_long_poll = (name == "aggregate" and bool(command.get("pipeline")) and "$changeStream" in command["pipeline"][0]) or \
+            (name == "find" and bool(command.get("awaitData")))
+        long_poll_cursor = command["getMore"] if name == "getMore" and command["getMore"] in self.long_poll_cursors else None
+        self.collections[(event.connection_id, event.request_id)] = (
+            target if isinstance(target, str) else event.database_name, opens_long_poll, long_poll_cursor
+        )
+
+    def finished(self, event, cursor_id: int = 0) -> str:
+        collection, opens_long_poll, long_poll_cursor = self.collections.pop(
+            (event.connection_id, event.request_id), ("", False, None)
+        )
+        MONGO_COMMAND_LATENCY.observe(collection, event.command_name, value=event.duration_micros / 1e6)
+        if long_poll_cursor is not None:
+            # Exhausted or failed cursors are done
+            if not cursor_id:
+                self.long_poll_cursors.discard(long_poll_cursor)
+            return collection
+        if opens_long_poll and cursor_id:
+            self.long_poll_cursors.add(cursor_id)
+        mongo_limiter.observe_command(event.duration_micros / 1e6)
+        return collection
+
+    def succeeded(self, event):
+        self.finished(event, event.reply.get("cursor", {}).get("id", 0))
+        if event.command_name in WRITE_COMMANDS:
+            note_write(event.reply.get("operationTime"))
+
+    def failed(self, event):
+        MONGO_COMMAND_FAILURES.inc(self.finished(event), event.command_name)
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection counts and checkout waits; a checkout starts and ends on the same worker thread"""
+
+    def __init__(self):
+        self.checkout = threading.local()
+
+    def address(self, event) -> str:
+        return "%s:%s" % event.address
+
+    def connection_check_out_started(self, event):
+        self.checkout.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        wait = time.perf_counter() - self.checkout.started
+        MONGO_CHECKOUT_WAIT.observe(self.address(event), value=wait)
+        mongo_limiter.observe_checkout(wait)
+        MONGO_CONNECTIONS_IN_USE.inc(self.address(event))
+
+    def connection_check_out_failed(self, event):
+        MONGO_CHECKOUT_WAIT.observe(self.address(event), value=time.perf_counter() - self.checkout.started)
+        MONGO_CHECKOUT_FAILURES.inc(self.address(event), event.reason)
+
+    def connection_checked_in(self, event):
+        MONGO_CONNECTIONS_IN_USE.inc(self.address(event), amount=-1)
+
+    def connection_created(self, event):
+        MONGO_CONNECTIONS.inc(self.address(event))
+        MONGO_CONNECTIONS_CREATED.inc(self.address(event))
+
+    def connection_closed(self, event):
+        MONGO_CONNECTIONS.inc(self.address(event), amount=-1)
+        MONGO_CONNECTIONS_CLOSED.inc(self.address(event), event.reason)
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        MONGO_POOL_CLEARED.inc(self.address(event))
+
+    def pool_closed(self, event):
+        pass
+
+class RequestMetrics:
+    """ASGI middleware recording count, latency and response size per route template.
+
+    Latency stops at the response headers so long-lived streams such as the
+    message SSE endpoint do not distort it; size counts every body chunk.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        response = {"status": 500, "size": 0, "latency": None}
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["latency"] = time.perf_counter() - started
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            HTTP_IN_FLIGHT.inc(amount=-1)
+            # Unmatched paths share one label so scanners cannot grow the series without bound
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUESTS.inc(method, route, str(response["status"]))
+            HTTP_LATENCY.observe(method, route, value=response["latency"] or time.perf_counter() - started)
+            HTTP_RESPONSE_SIZE.observe(method, route, value=response["size"])
+
+async def sample_event_loop_lag():
+    while True:
+        scheduled = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_SAMPLE_SECONDS)
+        EVENT_LOOP_LAG.observe(value=max(time.perf_counter() - scheduled - EVENT_LOOP_SAMPLE_SECONDS, 0.0))
+
+# Rate limiting for the unauthenticated write endpoints: one token bucket per
+# (route, client IP). A budget "burst/seconds" allows `burst` requests at once
+# and refills them evenly over `seconds`; RATE_LIMITS overrides entries, e.g.
+# RATE_LIMITS="POST /api/contact=3/300,POST /api/auth/login=off"
+DEFAULT_RATE_LIMITS = {
+    "POST /api/appointments": "20/600",
+    "POST /api/contact": "5/600",
+    "POST /api/auth/register": "10/600",
+    "POST /api/auth/login": "20/60",
+    "POST /api/auth/admin/login": "5/60",
+}
+# Peers whose X-Forwarded-For is trusted, i.e. the nginx in front of the backend
+TRUSTED_PROXIES = {address.strip() for address in os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1").split(",")}
+RATE_LIMIT_MAX_KEYS = 100_000
+
+def parse_rate_limits(overrides: str) -> Dict[str, tuple]:
+    """(capacity, tokens per second) by "METHOD /path" """
+    budgets = dict(DEFAULT_RATE_LIMITS)
+    for entry in filter(None, (part.strip() for part in overrides.split(","))):
+        route, _, budget = entry.rpartition("=")
+        budgets[route.strip()] = budget.strip()
+    limits = {}
+    for route, budget in budgets.items():
+        if budget == "off":
+            continue
+        burst, _, seconds = budget.partition("/")
+        limits[route] = (int(burst), int(burst) / float(seconds))
+    return limits
+
+RATE_LIMITS = parse_rate_limits(os.environ.get("RATE_LIMITS", ""))
+
+class MemoryBucketStore:
+    """Token buckets held by this worker; each worker enforces the budget on its own"""
+
+    def __init__(self):
+        self.buckets: Dict[str, tuple] = {}
+
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        """0 when a token was taken, otherwise seconds until one is available"""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            if len(self.buckets) > RATE_LIMIT_MAX_KEYS:
+                self.prune(now)
+            return 0.0
+        self.buckets[key] = (tokens, now)
+        return (1 - tokens) / rate
+
+    def prune(self, now: float):
+        # A bucket untouched for the longest refill time is full again, the same as having no entry
+        longest = max((capacity / rate for capacity, rate in RATE_LIMITS.values()), default=0)
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < longest}
+
+class RedisBucketStore:
+    """Token buckets shared by all workers in Redis or a compatible server (Valkey, KeyDB, Dragonfly)"""
+
+    # Refill and take in one atomic step, on the server's clock
+    TAKE_SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local clock = redis.call("TIME")
+    local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+    redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / rate * 1000))
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio
+        self.redis = redis.asyncio.from_url(url)
+        self.script = self.redis.register_script(self.TAKE_SCRIPT)
+
+    async def take(self, key: str, capacity: int, rate: float) -> float:
+        return float(await self.script(keys=[f"ratelimit:{key}"], args=[capacity, rate]))
+
+def client_address(scope) -> str:
+    peer = scope["client"][0] if scope.get("client") else "unknown"
+    if peer in TRUSTED_PROXIES:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                # nginx appends the address it saw last; earlier entries are client supplied
+                return value.decode("latin-1").rsplit(",", 1)[-1].strip() or peer
+    return peer
+
+class RateLimit:
+    """ASGI middleware answering 429 with Retry-After once a client's bucket for a route is empty.
+
+    A failing shared store lets requests through rather than taking the API down with it.
+    """
+
+    def __init__(self, app, store=None):
+        self.app = app
+        self.store = store or MemoryBucketStore()
+
+    async def __call__(self, scope, receive, send):
+        route = f"{scope['method']} {scope['path'].rstrip('/')}" if scope["type"] == "http" else None
+        limit = RATE_LIMITS.get(route)
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        try:
+            wait = await self.store.take(f"{route}|{client_address(scope)}", *limit)
+        except Exception as e:
+            logger.error(f"Rate limit store failed, request allowed: {e}")
+            wait = 0.0
+        if not wait:
+            return await self.app(scope, receive, send)
+
+        RATE_LIMITED.inc(route)
+        body = orjson.dumps({"detail": "Demasiadas solicitudes, intente de nuevo más tarde"})
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(math.ceil(wait)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+# Admission control: an AIMD limit on requests in flight, adapted to the
+# MongoDB latency they see (command time plus pool checkout wait). While the
+# window latency stays near its baseline and the limit is nearly used, the
+# limit grows by one per window; when latency exceeds the baseline by
+# CONCURRENCY_LATENCY_TOLERANCE it shrinks by CONCURRENCY_BACKOFF. Requests
+# over their tier's share of the limit get an immediate 503.
+CONCURRENCY_INITIAL_LIMIT = int(os.environ.get("CONCURRENCY_INITIAL_LIMIT", "40"))
+CONCURRENCY_MIN_LIMIT = int(os.environ.get("CONCURRENCY_MIN_LIMIT", "8"))
+CONCURRENCY_MAX_LIMIT = int(os.environ.get("CONCURRENCY_MAX_LIMIT", "400"))
+CONCURRENCY_WINDOW_SECONDS = 1.0
+CONCURRENCY_LATENCY_TOLERANCE = 2.0
+CONCURRENCY_BACKOFF = 0.9
+# Windows with fewer commands than this are too noisy to act on
+CONCURRENCY_MIN_SAMPLES = 10
+# How fast the baseline follows latency upwards; it follows downwards at once
+CONCURRENCY_BASELINE_DRIFT = 0.05
+# Share of the limit each tier may fill, so landing page traffic still gets in
+# when admin work has taken its half
+ADMISSION_SHARES = {"critical": 1.0, "interactive": 0.9, "batch": 0.5}
+CATALOG_PATHS = {"/api", "/api/services", "/api/doctor-info", "/api/team", "/api/insurance", "/api/testimonials", "/api/contact-info"}
+# Long-lived or self-monitoring routes that never wait on a slot
+ADMISSION_EXEMPT_PREFIXES = ("/api/messages/stream/", "/api/metrics")
+# Time budget of a whole request by tier; every MongoDB operation it issues
+# gets the time left as maxTimeMS and as its client-side socket timeout
+REQUEST_DEADLINES = {
+    "critical": float(os.environ.get("CRITICAL_DEADLINE_SECONDS", "2")),
+    "interactive": float(os.environ.get("REQUEST_DEADLINE_SECONDS", "5")),
+    "batch": float(os.environ.get("BATCH_DEADLINE_SECONDS", "30")),
+}
+# Streamed exports take as long as the data does
+DEADLINE_EXEMPT_PREFIXES = ("/api/admin/export/",)
+
+class ConcurrencyLimiter:
+    """Adaptive in-flight limit; latency samples arrive on driver threads, admission on the event loop"""
+
+    def __init__(self):
+        self.limit = float(CONCURRENCY_INITIAL_LIMIT)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.baseline: Optional[float] = None
+        self.lock = threading.Lock()
+        self.reset_window(time.monotonic())
+        CONCURRENCY_LIMIT.set(value=self.limit)
+
+    def reset_window(self, now: float):
+        self.window_started = now
+        self.command_total = 0.0
+        self.command_count = 0
+        self.checkout_total = 0.0
+        self.checkout_count = 0
+
+    def observe_command(self, seconds: float):
+        with self.lock:
+            self.command_total += seconds
+            self.command_count += 1
+            self.maybe_adjust()
+
+    def observe_checkout(self, seconds: float):
+        with self.lock:
+            self.checkout_total += seconds
+            self.checkout_count += 1
+
+    def maybe_adjust(self):
+        now = time.monotonic()
+        if now - self.window_started < CONCURRENCY_WINDOW_SECONDS:
+            return
+        if self.command_count < CONCURRENCY_MIN_SAMPLES:
+            # Too quiet to say anything about MongoDB; stretching the window would let
+            # a few stray commands from idle minutes move the baseline and the limit
+            self.peak_in_flight = self.in_flight
+            self.reset_window(now)
+            return
+        latency = self.command_total / self.command_count
+        if self.checkout_count:
+            latency += self.checkout_total / self.checkout_count
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline += (latency - self.baseline) * CONCURRENCY_BASELINE_DRIFT
+        if latency > self.baseline * CONCURRENCY_LATENCY_TOLERANCE:
+            self.limit = max(CONCURRENCY_MIN_LIMIT, self.limit * CONCURRENCY_BACKOFF)
+        elif self.peak_in_flight >= self.limit * 0.8:
+            # Only grow when the limit is what holds traffic back
+            self.limit = min(CONCURRENCY_MAX_LIMIT, self.limit + 1)
+        self.peak_in_flight = self.in_flight
+        self.reset_window(now)
+        CONCURRENCY_LIMIT.set(value=self.limit)
+        MONGO_WINDOW_LATENCY.set(value=latency)
+
+    def try_acquire(self, priority: str) -> bool:
+        if self.in_flight + 1 > self.limit * ADMISSION_SHARES[priority]:
+            return False
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+mongo_limiter = ConcurrencyLimiter()
+
+def admission_priority(path: str) -> Optional[str]:
+    """Tier of a request path, None when it is not admission controlled"""
+    if not path.startswith("/api") or path.startswith(ADMISSION_EXEMPT_PREFIXES):
+        return None
+    if path.rstrip("/") in CATALOG_PATHS or path.startswith(("/api/flyers/", "/api/doctor-image/")):
+        return "critical"
+    if path.startswith("/api/admin/"):
+        return "batch"
+    return "interactive"
+
+class AdmissionControl:
+    """ASGI middleware holding a limiter slot and the deadline for the whole request, answering 503 when no slot is free"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        priority = admission_priority(scope["path"]) if scope["type"] == "http" else None
+        if priority is None:
+            return await self.app(scope, receive, send)
+
+        if not mongo_limiter.try_acquire(priority):
+            ADMISSION_REJECTED.inc(priority)
+            body = orjson.dumps({"detail": "Servicio ocupado, intente de nuevo en unos segundos"})
+            await send({
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", b"1"),
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        deadline = None if scope["path"].startswith(DEADLINE_EXEMPT_PREFIXES) else REQUEST_DEADLINES[priority]
+        ADMISSION_IN_FLIGHT.inc()
+        try:
+            with pymongo.timeout(deadline):
+                await self.app(scope, receive, send)
+        finally:
+            mongo_limiter.release()
+            ADMISSION_IN_FLIGHT.inc(amount=-1)
+
+# MongoDB connection, opened by the connect_mongo startup hook
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+client: Optional[AsyncIOMotorClient] = None
+# The options connect_mongo passed on top of MONGO_URL, for the pool report
+mongo_options: dict = {}
+db = None
+# The same database with the listing read preference, see fetch_page
+replica_db = None
+
+# Pool options by environment variable and default; an option written in
+# MONGO_URL wins over the default, the environment variable over both
+MONGO_POOL_OPTIONS = {
+    "maxPoolSize": ("MONGO_MAX_POOL_SIZE", 100),
+    "minPoolSize": ("MONGO_MIN_POOL_SIZE", 10),
+    "maxIdleTimeMS": ("MONGO_MAX_IDLE_TIME_MS", 300000),
+    "serverSelectionTimeoutMS": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+}
+# Wire compression in order of preference, negotiated with the server
+DEFAULT_MONGO_COMPRESSORS = "zstd,snappy,zlib"
+# Modules each compressor needs on this side; zlib ships with Python
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+def available_compressors(names: str) -> List[str]:
+    """The listed compressors whose module is installed, so pymongo does not warn about the rest"""
+    wanted = [name.strip() for name in names.split(",") if name.strip()]
+    return [name for name in wanted if name in COMPRESSOR_MODULES and importlib.util.find_spec(COMPRESSOR_MODULES[name])]
+
+def mongo_client_options(url: str) -> dict:
+    in_url = {name.lower(): values[-1] for name, values in parse_qs(urlsplit(url).query).items()}
+    options = {}
+    for option, (variable, default) in MONGO_POOL_OPTIONS.items():
+        if variable in os.environ:
+            options[option] = int(os.environ[variable])
+        elif option.lower() not in in_url:
+            options[option] = default
+    # Always passed, so the list offered to the server is known without pymongo internals
+    options["compressors"] = available_compressors(
+        os.environ.get("MONGO_COMPRESSORS", in_url.get("compressors", DEFAULT_MONGO_COMPRESSORS))
+    )
+    return options
+
+# Read routing: listings, unread counts and flyer views may be served by a
+# secondary at most LISTING_MAX_STALENESS_SECONDS behind (90 is the smallest
+# MongoDB accepts); handlers that write read back from the primary. Every
+# response to a request that wrote carries the write's cluster time in
+# X-Read-After, and a client sending it back gets its listing reads in a
+# causally consistent session, so a lagging secondary waits until it has
+# applied that write instead of hiding it.
+LISTING_MAX_STALENESS_SECONDS = int(os.environ.get("LISTING_MAX_STALENESS_SECONDS", "90"))
+LISTING_READ_PREFERENCES = {
+    "primary": Primary(),
+    "primaryPreferred": PrimaryPreferred(max_staleness=LISTING_MAX_STALENESS_SECONDS),
+    "secondaryPreferred": SecondaryPreferred(max_staleness=LISTING_MAX_STALENESS_SECONDS),
+    "nearest": Nearest(max_staleness=LISTING_MAX_STALENESS_SECONDS),
+}
+def listing_read_preference(name: str):
+    """The read preference named by LISTING_READ_PREFERENCE, refusing to start on an unknown name"""
+    if name not in LISTING_READ_PREFERENCES:
+        raise ValueError(
+            f"LISTING_READ_PREFERENCE={name!r} is not one of {', '.join(LISTING_READ_PREFERENCES)}"
+        )
+    return LISTING_READ_PREFERENCES[name]
+
+LISTING_READ_PREFERENCE = listing_read_preference(os.environ.get("LISTING_READ_PREFERENCE", "secondaryPreferred"))
+READ_AFTER_HEADER = "X-Read-After"
+WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify"}
+
+class RequestReads:
+    """Cluster time the client has seen (from X-Read-After) and those of the writes made while serving it"""
+
+    def __init__(self, after: Optional[Timestamp]):
+        self.after = after
+        # Appended from Motor's worker threads, where the request context is copied
+        self.writes: List[Timestamp] = []
+
+request_reads: contextvars.ContextVar[Optional[RequestReads]] = contextvars.ContextVar("request_reads", default=None)
+
+def parse_read_after(value: Optional[str]) -> Optional[Timestamp]:
+    try:
+        seconds, increment = value.split(".")
+        return Timestamp(int(seconds), int(increment))
+    except (AttributeError, ValueError, TypeError, OverflowError):
+        return None
+
+def note_write(operation_time: Optional[Timestamp]):
+    reads = request_reads.get()
+    # Standalone servers report no operation time; background jobs run outside any request
+    if reads is not None and operation_time is not None:
+        reads.writes.append(operation_time)
+
+@contextlib.asynccontextmanager
+async def listing_reads():
+    """The listing read database, plus a causal session past the client's last write when it sent one"""
+    reads = request_reads.get()
+    if reads is None or reads.after is None:
+        yield replica_db, None
+        return
+    async with await client.start_session(causal_consistency=True) as session:
+        session.advance_operation_time(reads.after)
+        yield replica_db, session
+
+class ReadConsistency:
+    """ASGI middleware reading X-Read-After from requests and returning the latest write time in it"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api"):
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        reads = RequestReads(parse_read_after(headers.get(READ_AFTER_HEADER.lower().encode(), b"").decode("latin-1")))
+        token = request_reads.set(reads)
+
+        async def send_with_write_time(message):
+            if message["type"] == "http.response.start" and reads.writes:
+                latest = max(reads.writes + ([reads.after] if reads.after else []))
+                message["headers"] = [
+                    *message.get("headers", []), (READ_AFTER_HEADER.lower().encode(), f"{latest.time}.{latest.inc}".encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_write_time)
+        finally:
+            request_reads.reset(token)
+
+# Indexes required by the query shapes used in this module, created on startup
+COLLECTION_INDEXES = {
+    "messages": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("receiver_id", ASCENDING), ("is_read", ASCENDING), ("created_at", DESCENDING)], name="receiver_unread_created"),
+        IndexModel([("receiver_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="receiver_created_id"),
+        IndexModel([("sender_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="sender_created_id"),
+        IndexModel([("thread_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="thread_created_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+    ],
+    "conversations": [
+        IndexModel([("participants", ASCENDING), ("updated_at", DESCENDING), ("id", DESCENDING)], name="participant_updated_id"),
+    ],
+    "appointments": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("patient_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="patient_created_id"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+        IndexModel([("status", ASCENDING), ("assigned_date", ASCENDING)], name="status_assigned_date"),
+    ],
+    "patients": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "flyers": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("service_id", ASCENDING)], name="service_id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_id"),
+    ],
+    "contacts": [
+        IndexModel([("created_at", DESCENDING)], name="created"),
+    ],
+    "patient_directory": [
+        IndexModel([("name_key", ASCENDING), ("_id", ASCENDING)], name="name_key"),
+        IndexModel([("name_tokens", ASCENDING)], name="name_tokens"),
+        IndexModel([("email_key", ASCENDING)], name="email_key"),
+    ],
+    "jobs": [
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+    ],
+    "appointment_slots": [
+        IndexModel([("intervals.appointment_id", ASCENDING)], name="interval_appointment"),
+    ],
+    "revoked_sessions": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_ttl", expireAfterSeconds=0),
+        IndexModel([("revoked_at", ASCENDING)], name="revoked_at"),
+    ],
+    "dead_jobs": [
+        IndexModel([("failed_at", DESCENDING)], name="failed_at"),
+    ],
+    "message_events": [
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)], name="user_event"),
+        IndexModel([("created_at", ASCENDING)], name="created_ttl", expireAfterSeconds=24 * 3600),
+    ],
+}
+
+# Query shapes issued by the API, checked against the query planner by the index audit
+QUERY_SHAPES = [
+    {"name": "get_user_messages", "collection": "messages",
+     "filter": {"$or": [{"sender_id": "admin"}, {"receiver_id": "admin"}]}, "sort": {"created_at": -1, "id": -1}},
+    {"name": "get_conversations", "collection": "conversations",
+     "filter": {"participants": "admin"}, "sort": {"updated_at": -1, "id": -1}},
+    {"name": "get_conversation_messages", "collection": "messages",
+     "filter": {"thread_id": ""}, "sort": {"created_at": -1, "id": -1}},
+    {"name": "poll_admin_messages", "collection": "messages",
+     "filter": {"receiver_id": "admin", "is_read": False}, "sort": {"created_at": -1}},
+    {"name": "get_patient_appointments", "collection": "appointments",
+     "filter": {"patient_id": ""}, "sort": {"created_at": -1, "id": -1}},
+    {"name": "get_appointments", "collection": "appointments",
+     "filter": {}, "sort": {"created_at": -1, "id": -1}},
+    {"name": "get_all_flyers", "collection": "flyers",
+     "filter": {}, "sort": {"created_at": -1, "id": -1}},
+    {"name": "login_patient", "collection": "patients",
+     "filter": {"email": "", "telefono": ""}},
+    {"name": "get_patient_profile", "collection": "patients",
+     "filter": {"id": ""}},
+    {"name": "search_patient_directory", "collection": "patient_directory",
+     "filter": {"$or": [{"name_key": {"$regex": "^a"}}, {"name_tokens": {"$regex": "^a"}}, {"email_key": {"$regex": "^a"}}]},
+     "sort": {"name_key": 1, "_id": 1}},
+    {"name": "get_service_flyer", "collection": "flyers",
+     "filter": {"service_id": ""}},
+    {"name": "export_appointments", "collection": "appointments",
+     "filter": {"created_at": {"$gte": datetime(2000, 1, 1)}, "status": "solicitada"}, "sort": {"created_at": 1}},
+    {"name": "export_messages", "collection": "messages",
+     "filter": {"created_at": {"$gte": datetime(2000, 1, 1)}}, "sort": {"created_at": 1}},
+    {"name": "export_contacts", "collection": "contacts",
+     "filter": {"created_at": {"$gte": datetime(2000, 1, 1)}}, "sort": {"created_at": 1}},
+    {"name": "mark_message_read", "collection": "messages",
+     "filter": {"id": ""}},
+    {"name": "confirm_appointment", "collection": "appointments",
+     "filter": {"id": ""}},
+    {"name": "load_availability", "collection": "appointments",
+     "filter": {"status": "confirmada", "assigned_date": {"$gte": ""}}},
+]
+
+# Keyset pagination: listings are ordered by (created_at, id) descending and a
+# page continues strictly after the last (created_at, id) pair of the previous one.
+# Conversations page the same way on updated_at.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(document: dict, time_field: str = "created_at") -> str:
+    """Opaque cursor pointing just past the given document"""
+    raw = json.dumps([document[time_field].isoformat(), document["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, document_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), str(document_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+def after_cursor(cursor: Optional[str], time_field: str = "created_at") -> dict:
+    """Filter selecting documents strictly after the cursor in (time_field, id) descending order.
+
+    Expressed as a created_at range plus a tie-break on id so the planner
+    keeps it as index bounds instead of a disjunction.
+    """
+    if not cursor:
+        return {}
+    created_at, document_id = decode_cursor(cursor)
+    return {
+        time_field: {"$lte": created_at},
+        "$nor": [{time_field: created_at, "id": {"$gte": document_id}}]
+    }
+
+async def fetch_page(collection, query: dict, limit: int, time_field: str = "created_at", projection: Optional[dict] = None):
+    """Read one page plus a single look-ahead document to decide whether another page exists"""
+    sort = [(time_field, DESCENDING), ("id", DESCENDING)]
+    async with listing_reads() as (reads_db, session):
+        cursor = reads_db[collection.name].find(query, projection, session=session)
+        documents = await cursor.sort(sort).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_cursor(documents[limit - 1], time_field) if len(documents) > limit else None
+    return documents[:limit], next_cursor
+
+# Server-push message events
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_RETRY_MS = 3000
+STREAM_QUEUE_SIZE = 100
+STREAM_REPLAY_LIMIT = 500
+RELAY_POLL_SECONDS = 1.0
+# ObjectIds from different workers are only ordered to the second, so the
+# fallback relay re-reads a short window and drops events it already delivered
+RELAY_POLL_OVERLAP = timedelta(seconds=5)
+
+class StreamSubscription:
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.overflowed = False
+
+class MessageEventBroker:
+    """Fans message events out to the streams connected to this worker.
+
+    Every event is stored in db.message_events first, which gives reconnecting
+    clients a replay log keyed by Last-Event-ID and lets the relay task pick up
+    events published by other workers (change stream, or tailing on a
+    standalone mongod without one).
+    """
+
+    def __init__(self):
+        self.subscriptions: Dict[str, Set[StreamSubscription]] = defaultdict(set)
+        self.delivered = deque(maxlen=5000)
+        self.delivered_ids: Set[ObjectId] = set()
+        self.relay_task: Optional[asyncio.Task] = None
+
+    def subscribe(self, user_id: str) -> StreamSubscription:
+        subscription = StreamSubscription(user_id)
+        self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: StreamSubscription):
+        subscribers = self.subscriptions.get(subscription.user_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscriptions[subscription.user_id]
+
+    async def publish(self, user_ids: List[str], event_type: str, data: dict):
+        """Persist one event per recipient and deliver it to local streams"""
+        now = datetime.utcnow()
+        payload = {k: v for k, v in data.items() if k != "_id"}
+        events = [
+            {"user_id": user_id, "type": event_type, "data": payload, "created_at": now}
+            for user_id in dict.fromkeys(user_ids)
+        ]
+        try:
+            await db.message_events.insert_many(events)
+        except Exception as e:
+            logger.error(f"Failed to publish {event_type} event: {e}")
+            return
+        for event in events:
+            self.deliver(event)
+
+    def deliver(self, event: dict):
+        if event["_id"] in self.delivered_ids:
+            return
+        if len(self.delivered) == self.delivered.maxlen:
+            self.delivered_ids.discard(self.delivered[0])
+        self.delivered.append(event["_id"])
+        self.delivered_ids.add(event["_id"])
+
+        for subscription in list(self.subscriptions.get(event["user_id"], ())):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Slow client: close its stream, it reconnects and replays from Last-Event-ID
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+    def start(self):
+        self.relay_task = asyncio.create_task(self.relay())
+
+    async def stop(self):
+        if self.relay_task:
+            self.relay_task.cancel()
+            await asyncio.gather(self.relay_task, return_exceptions=True)
+
+    async def relay(self):
+        """Deliver events written by other workers to streams on this one"""
+        try:
+            async with db.message_events.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                logger.info("Message event relay using change stream")
+                async for change in stream:
+                    self.deliver(change["fullDocument"])
+        except PyMongoError as e:
+            logger.info(f"Change stream unavailable ({e}), message event relay tailing collection")
+
+        since = datetime.utcnow()
+        while True:
+            await asyncio.sleep(RELAY_POLL_SECONDS)
+            try:
+                cursor = db.message_events.find(
+                    {"_id": {"$gt": ObjectId.from_datetime(since - RELAY_POLL_OVERLAP)}}
+                ).sort("_id", ASCENDING)
+                async for event in cursor:
+                    self.deliver(event)
+                    since = max(since, event["created_at"])
+            except Exception as e:
+                logger.error(f"Message event relay failed: {e}")
+
+def format_sse(event: dict) -> str:
+    data = orjson.dumps(event["data"], default=jsonable_encoder).decode()
+    return f"id: {event['_id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+message_events = MessageEventBroker()
+
+# Materialized unread counters: one {_id: user_id, unread: n} document per
+# user, kept in step with the messages collection by $inc on every change of
+# unread state. They are built from the messages once on the first startup,
+# and rebuild_unread_counters repairs drift from the messages themselves.
+# A negative count can only be drift: responses show 0, and each read of one
+# is logged and counted in unread_counter_drift_total so it gets rebuilt.
+def visible_unread(count: int, counter: str, key: str) -> int:
+    if count < 0:
+        UNREAD_DRIFT.inc(counter)
+        logger.warning(f"Unread {counter} counter of {key} is {count}, run the unread and conversation rebuilds")
+        return 0
+    return count
+
+async def claim_migration(name: str) -> bool:
+    """True for the one worker that gets to run a one-off startup migration"""
+    result = await db.app_settings.update_one(
+        {"_id": f"migration:{name}"}, {"$setOnInsert": {"started_at": datetime.utcnow()}}, upsert=True
+    )
+    return result.upserted_id is not None
+
+async def adjust_unread_count(user_id: str, delta: int) -> int:
+    """Apply delta to the user's counter and return the new unread count"""
+    counter = await db.unread_counters.find_one_and_update(
+        {"_id": user_id}, {"$inc": {"unread": delta}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return visible_unread(counter["unread"], "user", user_id)
+
+async def read_unread_count(user_id: str, listing: bool = False) -> int:
+    """Unread counter of a user; listing reads may come from a secondary, write handlers read the primary"""
+    if not listing:
+        counter = await db.unread_counters.find_one({"_id": user_id})
+    else:
+        async with listing_reads() as (reads_db, session):
+            counter = await reads_db.unread_counters.find_one({"_id": user_id}, session=session)
+    return visible_unread(counter["unread"], "user", user_id) if counter else 0
+
+async def rebuild_unread_counts() -> int:
+    """Recompute every unread counter from the messages collection; returns the users with unread messages"""
+    await db.unread_counters.update_many({}, {"$set": {"unread": 0}})
+    await db.messages.aggregate([
+        {"$match": {"is_read": False}},
+        {"$group": {"_id": "$receiver_id", "unread": {"$sum": 1}}},
+        {"$merge": {"into": "unread_counters", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]).to_list(None)
+    return await db.unread_counters.count_documents({"unread": {"$gt": 0}})
+
+# Materialized conversations: one document per thread_id holding the
+# participants, a preview of the latest message and an unread count per
+# participant, so the inbox lists threads without scanning message history.
+CONVERSATION_PREVIEW_LENGTH = 140
+
+async def record_conversation_message(message: dict):
+    """Fold a newly stored message into its thread summary"""
+    thread_id = message["thread_id"]
+    sender_id, receiver_id = message["sender_id"], message["receiver_id"]
+    await db.conversations.update_one({"_id": thread_id}, {
+        "$setOnInsert": {"id": thread_id, "subject": message["subject"], "created_at": message["created_at"]},
+        "$set": {
+            "last_message": {
+                "id": message["id"],
+                "sender_id": sender_id,
+                "sender_name": message["sender_name"],
+                "preview": message["message"][:CONVERSATION_PREVIEW_LENGTH],
+                "created_at": message["created_at"]
+            },
+            "updated_at": message["created_at"],
+            f"participant_names.{sender_id}": message["sender_name"],
+            f"participant_names.{receiver_id}": message["receiver_name"]
+        },
+        "$addToSet": {"participants": {"$each": [sender_id, receiver_id]}},
+        "$inc": {f"unread.{receiver_id}": 1, "message_count": 1}
+    }, upsert=True)
+
+async def adjust_conversation_unread(user_id: str, deltas: Dict[str, int]):
+    """Apply per-thread unread deltas for one participant"""
+    if not deltas:
+        return
+    await db.conversations.bulk_write([
+        UpdateOne({"_id": thread_id}, {"$inc": {f"unread.{user_id}": delta}})
+        for thread_id, delta in deltas.items()
+    ], ordered=False)
+
+async def fan_out_new_message(message: dict, once: bool = False):
+    """Counter, thread summary and event for a stored message; independent writes, so issued concurrently.
+
+    With once, as for a job that may be retried, each step first marks itself
+    on the message and is skipped when already marked. A step that fails after
+    its mark is lost rather than repeated; the rebuild endpoints repair counts.
+    """
+    steps = {
+        "unread": functools.partial(adjust_unread_count, message["receiver_id"], 1),
+        "conversation": functools.partial(record_conversation_message, message),
+        "event": functools.partial(message_events.publish, [message["receiver_id"], message["sender_id"]], "message", message)
+    }
+
+    async def run(name: str, step):
+        if once:
+            marked = await db.messages.update_one(
+                {"id": message["id"], f"fan_out.{name}": {"$exists": False}}, {"$set": {f"fan_out.{name}": datetime.utcnow()}}
+            )
+            if not marked.modified_count:
+                return
+        await step()
+
+    await asyncio.gather(*(run(name, step) for name, step in steps.items()))
+
+def conversation_summary(conversation: dict, user_id: str) -> dict:
+    return {
+        "id": conversation["id"],
+        "subject": conversation["subject"],
+        "participants": conversation["participants"],
+        "participant_names": conversation.get("participant_names", {}),
+        "last_message": conversation["last_message"],
+        "message_count": conversation.get("message_count", 0),
+        "unread_count": visible_unread(conversation.get("unread", {}).get(user_id, 0), "conversation", f"{conversation['id']}/{user_id}"),
+        "created_at": conversation["created_at"],
+        "updated_at": conversation["updated_at"]
+    }
+
+# Background jobs: side effects are persisted in db.jobs by the request that
+# causes them and run by a bounded pool of workers in every server process.
+# A claim moves run_at to the end of a lease, so jobs held by a worker that
+# died become claimable again once the lease runs out.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = 5
+JOB_BACKOFF_SECONDS = 2
+JOB_BACKOFF_MAX_SECONDS = 300
+JOB_TIMEOUT_SECONDS = 30
+JOB_LEASE_SECONDS = 60
+JOB_POLL_SECONDS = 5
+
+class JobQueue:
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self.handlers = {}
+        self.wakeup = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+
+    def handler(self, job_type: str):
+        def register(function):
+            self.handlers[job_type] = function
+            return function
+        return register
+
+    async def enqueue(self, job_type: str, payload: dict) -> ObjectId:
+        """Persist a job and return at once; one insert is all the caller pays"""
+        now = datetime.utcnow()
+        result = await db.jobs.insert_one({
+            "type": job_type,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "run_at": now,
+            "created_at": now
+        })
+        self.wakeup.set()
+        return result.inserted_id
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Jobs interrupted here stay claimed until their lease expires, then run again
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await db.jobs.find_one_and_update(
+            {"status": {"$in": ["pending", "running"]}, "run_at": {"$lte": now}},
+            {
+                "$set": {"status": "running", "run_at": now + timedelta(seconds=JOB_LEASE_SECONDS)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def work(self):
+        while True:
+            try:
+                job = await self.claim()
+            except PyMongoError as e:
+                logger.error(f"Job claim failed: {e}")
+                job = None
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.run(job)
+            except Exception as e:
+                # Acknowledging or rescheduling failed; the job runs again when its lease expires
+                logger.error(f"Job {job['_id']} ({job['type']}) could not be recorded: {e}")
+
+    async def run(self, job: dict):
+        try:
+            handler = self.handlers[job["type"]]
+            # The same budget bounds each MongoDB operation of the job
+            with pymongo.timeout(JOB_TIMEOUT_SECONDS):
+                await asyncio.wait_for(handler(job["payload"]), JOB_TIMEOUT_SECONDS)
+        except Exception as e:
+            await self.failed(job, e)
+        else:
+            JOBS_PROCESSED.inc(job["type"], "done")
+            await db.jobs.delete_one({"_id": job["_id"]})
+
+    async def failed(self, job: dict, error: Exception):
+        error_text = f"{type(error).__name__}: {error}"
+        if job["attempts"] >= JOB_MAX_ATTEMPTS or job["type"] not in self.handlers:
+            JOBS_PROCESSED.inc(job["type"], "dead")
+            logger.error(f"Job {job['_id']} ({job['type']}) moved to dead letters: {error_text}")
+            await db.dead_jobs.insert_one({**job, "status": "dead", "last_error": error_text, "failed_at": datetime.utcnow()})
+            await db.jobs.delete_one({"_id": job["_id"]})
+            return
+        JOBS_PROCESSED.inc(job["type"], "retry")
+        delay = min(JOB_BACKOFF_SECONDS * 2 ** (job["attempts"] - 1), JOB_BACKOFF_MAX_SECONDS)
+        logger.warning(f"Job {job['_id']} ({job['type']}) failed, retrying in {delay}s: {error_text}")
+        await db.jobs.update_one({"_id": job["_id"]}, {"$set": {
+            "status": "pending",
+            "run_at": datetime.utcnow() + timedelta(seconds=delay),
+            "last_error": error_text
+        }})
+
+job_queue = JobQueue()
+
+# Session tokens: HS256 JWTs carrying the patient id (or "admin") and role.
+# Access tokens are short-lived and verified from the signature alone; the
+# refresh token trades for a new pair. Both share a session id (sid) so
+# logout revokes the whole session.
+ACCESS_TOKEN_TTL = timedelta(minutes=int(os.environ.get("ACCESS_TOKEN_MINUTES", "15")))
+REFRESH_TOKEN_TTL = timedelta(days=int(os.environ.get("REFRESH_TOKEN_DAYS", "7")))
+JWT_ALGORITHM = "HS256"
+# Until the endpoints are locked down, requests without a token still pass;
+# a token that is sent is always verified. Admin tools added after sessions
+# (ADMIN_SESSION_ACCESS) always need one.
+AUTH_REQUIRED = os.environ.get("AUTH_REQUIRED", "false").lower() == "true"
+REVOCATION_SYNC_SECONDS = 5
+REVOCATION_SYNC_OVERLAP = timedelta(seconds=5)
+
+class SessionKeys:
+    """Signing secret from JWT_SECRET, or one generated once and shared by all workers through Mongo"""
+
+    def __init__(self):
+        self.secret: Optional[str] = os.environ.get("JWT_SECRET")
+
+    async def load(self):
+        if self.secret:
+            return
+        logger.warning("JWT_SECRET is not set, using the signing secret stored in the database")
+        await db.app_settings.update_one(
+            {"_id": "jwt_secret"}, {"$setOnInsert": {"value": secrets.token_urlsafe(48)}}, upsert=True
+        )
+        self.secret = (await db.app_settings.find_one({"_id": "jwt_secret"}))["value"]
+
+session_keys = SessionKeys()
+
+class RevocationCache:
+    """Session ids revoked by logout, mirrored in memory from db.revoked_sessions.
+
+    Checking a token never touches Mongo. Each worker polls for revocations
+    made by the others every REVOCATION_SYNC_SECONDS, and an entry lasts as
+    long as the longest-lived token of its session.
+    """
+
+    def __init__(self):
+        self.revoked: Dict[str, datetime] = {}
+        self.synced_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def is_revoked(self, sid: str) -> bool:
+        expires_at = self.revoked.get(sid)
+        return expires_at is not None and expires_at > datetime.utcnow()
+
+    async def revoke(self, sid: str, expires_at: datetime):
+        self.revoked[sid] = expires_at
+        await db.revoked_sessions.update_one(
+            {"_id": sid}, {"$set": {"expires_at": expires_at, "revoked_at": datetime.utcnow()}}, upsert=True
+        )
+
+    async def sync(self):
+        now = datetime.utcnow()
+        query = {"expires_at": {"$gt": now}}
+        if self.synced_at:
+            query["revoked_at"] = {"$gte": self.synced_at - REVOCATION_SYNC_OVERLAP}
+        async for entry in db.revoked_sessions.find(query):
+            self.revoked[entry["_id"]] = entry["expires_at"]
+        self.revoked = {sid: expires_at for sid, expires_at in self.revoked.items() if expires_at > now}
+        self.synced_at = now
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except PyMongoError as e:
+                logger.error(f"Revocation sync failed: {e}")
+            await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+revocations = RevocationCache()
+
+def issue_session_tokens(subject: str, role: str, sid: Optional[str] = None) -> dict:
+    now = datetime.utcnow()
+    sid = sid or str(uuid.uuid4())
+    claims = {"sub": subject, "role": role, "sid": sid, "iat": now}
+    return {
+        "access_token": jwt.encode({**claims, "type": "access", "exp": now + ACCESS_TOKEN_TTL}, session_keys.secret, JWT_ALGORITHM),
+        "refresh_token": jwt.encode({**claims, "type": "refresh", "exp": now + REFRESH_TOKEN_TTL}, session_keys.secret, JWT_ALGORITHM),
+        "token_type": "bearer",
+        "expires_in": int(ACCESS_TOKEN_TTL.total_seconds())
+    }
+
+def decode_session_token(token: str, token_type: str) -> dict:
+    try:
+        claims = jwt.decode(
+            token, session_keys.secret, algorithms=[JWT_ALGORITHM],
+            options={"require": ["exp", "sub", "role", "sid", "type"]}
+        )
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Sesión expirada", headers={"WWW-Authenticate": "Bearer"})
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Token inválido", headers={"WWW-Authenticate": "Bearer"})
+    if claims["type"] != token_type:
+        raise HTTPException(status_code=401, detail="Token inválido", headers={"WWW-Authenticate": "Bearer"})
+    if revocations.is_revoked(claims["sid"]):
+        raise HTTPException(status_code=401, detail="Sesión cerrada", headers={"WWW-Authenticate": "Bearer"})
+    return claims
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+async def get_session(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> Optional[dict]:
+    """Claims of the bearer access token, None for anonymous requests while AUTH_REQUIRED is off"""
+    if credentials is None:
+        if AUTH_REQUIRED:
+            raise HTTPException(status_code=401, detail="Inicie sesión para continuar", headers={"WWW-Authenticate": "Bearer"})
+        return None
+    return decode_session_token(credentials.credentials, "access")
+
+async def require_admin(session: Optional[dict] = Depends(get_session)):
+    if session is not None and session["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acceso restringido al administrador")
+
+async def require_admin_session(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)):
+    """require_admin without the anonymous rollout, for the admin routes that never allowed anonymous use"""
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Inicie sesión para continuar", headers={"WWW-Authenticate": "Bearer"})
+    if decode_session_token(credentials.credentials, "access")["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Acceso restringido al administrador")
+
+def authorize_user(user_id: str, session: Optional[dict]):
+    # The admin reads every inbox; a patient only their own
+    if session is not None and session["role"] != "admin" and session["sub"] != user_id:
+        raise HTTPException(status_code=403, detail="Acceso no autorizado")
+
+async def require_patient(patient_id: str, session: Optional[dict] = Depends(get_session)):
+    authorize_user(patient_id, session)
+
+async def require_user(user_id: str, session: Optional[dict] = Depends(get_session)):
+    authorize_user(user_id, session)
+
+async def require_sender(sender_id: str, session: Optional[dict] = Depends(get_session)):
+    authorize_user(sender_id, session)
+
+async def require_thread_participant(thread_id: str, session: Optional[dict] = Depends(get_session)):
+    if session is None or session["role"] == "admin":
+        return
+    user_id = session["sub"]
+    if not await db.messages.find_one(
+        {"thread_id": thread_id, "$or": [{"sender_id": user_id}, {"receiver_id": user_id}]}, {"_id": True}
+    ):
+        raise HTTPException(status_code=403, detail="Acceso no autorizado")
+
+async def require_stream_user(
+    user_id: str, token: Optional[str] = None, credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)
+):
+    """require_user for the SSE stream; EventSource cannot send headers, so the access token may come as ?token="""
+    raw_token = token or (credentials.credentials if credentials else None)
+    if raw_token is None:
+        if AUTH_REQUIRED:
+            raise HTTPException(status_code=401, detail="Inicie sesión para continuar", headers={"WWW-Authenticate": "Bearer"})
+        return
+    authorize_user(user_id, decode_session_token(raw_token, "access"))
+
+ADMIN_ACCESS = [Depends(require_admin)]
+ADMIN_SESSION_ACCESS = [Depends(require_admin_session)]
+PATIENT_ACCESS = [Depends(require_patient)]
+USER_ACCESS = [Depends(require_user)]
+SENDER_ACCESS = [Depends(require_sender)]
+THREAD_ACCESS = [Depends(require_thread_participant)]
+STREAM_ACCESS = [Depends(require_stream_user)]
+
+# Patient directory for the admin compose form: one document per patient id
+# seen at registration or on an appointment request, with lowercased keys for
+# index-backed prefix search and the date of the latest appointment. name_tokens
+# holds each word of the name so a surname prefix matches as well.
+def name_tokens(name: str) -> List[str]:
+    return name.lower().split()
+
+def name_tokens_expr(name) -> dict:
+    """Aggregation counterpart of name_tokens"""
+    return {"$filter": {"input": {"$split": [{"$toLower": name}, " "]}, "cond": {"$ne": ["$$this", ""]}}}
+
+async def upsert_directory_entry(patient_id: str, name: str, email: str, last_visit: Optional[datetime] = None):
+    update = {
+        "$set": {
+            "id": patient_id,
+            "name": name,
+            "email": email,
+            "name_key": name.lower(),
+            "name_tokens": name_tokens(name),
+            "email_key": email.lower()
+        }
+    }
+    if last_visit:
+        update["$max"] = {"last_visit": last_visit}
+    await db.patient_directory.update_one({"_id": patient_id}, update, upsert=True)
+
+def encode_directory_cursor(entry: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps([entry["name_key"], entry["_id"]]).encode()).decode()
+
+def after_directory_cursor(cursor: Optional[str]) -> dict:
+    if not cursor:
+        return {}
+    try:
+        name_key, patient_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+    return {"$or": [{"name_key": {"$gt": name_key}}, {"name_key": name_key, "_id": {"$gt": patient_id}}]}
+
+# Pre-encoded catalog responses
+CATALOG_CACHE_CONTROL = "public, max-age=300"
+
+class CatalogCache:
+    """JSON bodies for the static catalog endpoints, encoded once with a strong ETag.
+
+    Each entry is rebuilt from its registered builder only when invalidated,
+    so content that becomes admin-editable just needs to call invalidate()
+    after saving. Entries live per worker.
+    """
+
+    def __init__(self):
+        self.builders = {}
+        self.entries = {}
+
+    def register(self, name: str, builder):
+        self.builders[name] = builder
+
+    def build(self, name: str):
+        self.entries[name] = encode_json(self.builders[name]())
+        return self.entries[name]
+
+    def build_all(self):
+        for name in self.builders:
+            self.build(name)
+
+    def invalidate(self, name: Optional[str] = None):
+        for entry_name in ([name] if name else list(self.builders)):
+            self.build(entry_name)
+
+    def response(self, name: str, request: Request) -> Response:
+        body, etag = self.entries.get(name) or self.build(name)
+        return cached_json_response(body, etag, CATALOG_CACHE_CONTROL, request)
+
+def encode_json(payload):
+    """Encode a payload once to JSON bytes with its strong ETag"""
+    body = orjson.dumps(payload, default=jsonable_encoder)
+    return body, '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+def cached_json_response(body: bytes, etag: str, cache_control: str, request: Request) -> Response:
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison as required for If-None-Match"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in [candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates]
+
+catalog = CatalogCache()
+
+# Flyer cache
+FLYER_CACHE_CONTROL = "public, max-age=60"
+FLYER_VERSION_CHECK_SECONDS = 2
+
+class FlyerCache:
+    """Read-through cache of encoded flyer responses keyed by service_id.
+
+    Writers bump a shared version stamp in db.cache_versions; every worker
+    compares its version with the stamp at most every
+    FLYER_VERSION_CHECK_SECONDS and drops its entries when another worker or
+    replica wrote in between, so a burst of views costs one point lookup.
+    Misses are read with the listing read preference in a causal session
+    past the last stamp read, so a lagging secondary cannot refill an entry
+    with a flyer older than the stamp.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.version: Optional[int] = None
+        self.checked_at = 0.0
+        self.stamp_time: Optional[Timestamp] = None
+
+    async def sync(self):
+        if time.monotonic() - self.checked_at < FLYER_VERSION_CHECK_SECONDS:
+            return
+        async with await client.start_session(causal_consistency=True) as session:
+            stamp = await db.cache_versions.find_one({"_id": "flyers"}, session=session)
+        version = stamp["version"] if stamp else 0
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        self.stamp_time = session.operation_time
+        self.checked_at = time.monotonic()
+
+    async def get(self, service_id: str):
+        try:
+            await self.sync()
+        except PyMongoError as e:
+            if not e.timeout:
+                raise
+            # Past the deadline the entries this worker holds are the best answer left
+            DEADLINE_EXCEEDED.inc("get_service_flyer", "stale")
+        entry = self.entries.get(service_id)
+        if entry is None:
+            # An invalidate() or sync() landing during the read makes the flyer suspect
+            version = self.version
+            try:
+                async with await client.start_session(causal_consistency=True) as session:
+                    if self.stamp_time is not None:
+                        session.advance_operation_time(self.stamp_time)
+                    flyer = await replica_db.flyers.find_one({"service_id": service_id}, session=session)
+            except PyMongoError as e:
+                if not e.timeout:
+                    raise
+                DEADLINE_EXCEEDED.inc("get_service_flyer", "default")
+                return encode_json(create_default_flyer(service_id))
+            entry = encode_json(ServiceFlyer(**flyer) if flyer else create_default_flyer(service_id))
+            # Unknown ids still get the fallback default but are not cached, keeping the cache bounded
+            if (flyer or service_id in DEFAULT_FLYER_SERVICES) and self.version == version:
+                self.entries[service_id] = entry
+        return entry
+
+    async def invalidate(self, service_id: str):
+        async with await client.start_session(causal_consistency=True) as session:
+            stamp = await db.cache_versions.find_one_and_update(
+                {"_id": "flyers"}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER, session=session
+            )
+        if self.version is not None and stamp["version"] == self.version + 1:
+            self.entries.pop(service_id, None)
+        else:
+            # Another writer bumped the stamp too; its change is unknown here
+            self.entries.clear()
+        self.version = stamp["version"]
+        self.stamp_time = session.operation_time
+        self.checked_at = time.monotonic()
+
+flyer_cache = FlyerCache()
+
+# Doctor photo storage
+DOCTOR_IMAGE_ID = "current"
+DOCTOR_IMAGE_MAX_BYTES = 5 * 1024 * 1024
+DOCTOR_IMAGE_CHECK_SECONDS = 30
+DOCTOR_IMAGE_CACHE_CONTROL = "public, max-age=300"
+DOCTOR_IMAGE_VERSIONED_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def parse_data_url(data_url: str):
+    """Split a base64 image data URL into (content_type, bytes)"""
+    header, _, encoded = data_url.partition(",")
+    if not header.startswith("data:image/") or not header.endswith(";base64"):
+        raise ValueError("not a base64 image data URL")
+    return header[len("data:"):-len(";base64")], base64.b64decode(encoded, validate=True)
+
+class DoctorImageStore:
+    """Doctor photo kept as binary in db.doctor_images and cached per worker by content hash.
+
+    Workers only hold a copy keyed by sha256 and compare it against the stored
+    hash, so an upload handled by one worker is picked up by all of them.
+    """
+
+    def __init__(self):
+        self.sha256: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self.data: Optional[bytes] = None
+        self.checked_at = 0.0
+
+    def version(self) -> Optional[str]:
+        return self.sha256[:16] if self.sha256 else None
+
+    def url(self) -> Optional[str]:
+        return f"/api/doctor-image/current?v={self.version()}" if self.sha256 else None
+
+    async def seed(self, data_url: str):
+        """Store data_url as the photo unless one was uploaded already"""
+        try:
+            content_type, data = parse_data_url(data_url)
+        except ValueError:
+            logger.warning("Default doctor image is not valid base64, upload one from the admin panel")
+        else:
+            await db.doctor_images.update_one(
+                {"_id": DOCTOR_IMAGE_ID},
+                {"$setOnInsert": self.document(content_type, data)},
+                upsert=True
+            )
+        await self.refresh(force=True)
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Re-read the stored hash, at most every DOCTOR_IMAGE_CHECK_SECONDS; True if it changed"""
+        if not force and time.monotonic() - self.checked_at < DOCTOR_IMAGE_CHECK_SECONDS:
+            return False
+        stored = await db.doctor_images.find_one(
+            {"_id": DOCTOR_IMAGE_ID}, projection={"sha256": True, "content_type": True}
+        )
+        self.checked_at = time.monotonic()
+        sha256 = stored["sha256"] if stored else None
+        if sha256 == self.sha256:
+            return False
+        self.sha256 = sha256
+        self.content_type = stored["content_type"] if stored else None
+        self.data = None
+        return True
+
+    async def load(self, force: bool = False) -> Optional[bytes]:
+        await self.refresh(force=force)
+        if self.sha256 and self.data is None:
+            # Take whatever is stored now, the hash may have moved since the last check
+            stored = await db.doctor_images.find_one({"_id": DOCTOR_IMAGE_ID})
+            self.checked_at = time.monotonic()
+            if stored:
+                self.sha256, self.content_type, self.data = stored["sha256"], stored["content_type"], bytes(stored["data"])
+            else:
+                self.sha256 = self.content_type = None
+        return self.data
+
+    async def save(self, content_type: str, data: bytes):
+        await db.doctor_images.replace_one(
+            {"_id": DOCTOR_IMAGE_ID}, self.document(content_type, data), upsert=True
+        )
+        self.sha256, self.content_type, self.data = hashlib.sha256(data).hexdigest(), content_type, data
+        self.checked_at = time.monotonic()
+
+    @staticmethod
+    def document(content_type: str, data: bytes) -> dict:
+        return {
+            "data": data,
+            "content_type": content_type,
+            "sha256": hashlib.sha256(data).hexdigest(),
+            "size": len(data),
+            "updated_at": datetime.utcnow()
+        }
+
+def parse_byte_range(range_header: str, size: int):
+    """Resolve a single "bytes=start-end" range against the body size; None if unsatisfiable"""
+    unit, _, spec = range_header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0:
+                return None
+            return max(size - length, 0), size - 1
+        first = int(start)
+        last = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or first > last:
+        return None
+    return first, last
+
+doctor_image = DoctorImageStore()
 
 # Create the main app without a prefix
 app = FastAPI(title="ZIMI - Zerquera Integrative Medical Institute API")
@@ -47,6 +1678,7 @@ class Message(BaseModel):
     is_read: bool = False
     message_type: str = "general"  # general, appointment, medical, reminder
     appointment_id: Optional[str] = None
+    thread_id: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
     read_at: Optional[datetime] = None
 
@@ -61,6 +1693,9 @@ class MessageCreate(BaseModel):
 class MessageReply(BaseModel):
     message: str
 
+class BulkReadRequest(BaseModel):
+    message_ids: List[str]
+
 class AppointmentConfirmation(BaseModel):
     assigned_date: str
     assigned_time: str
@@ -163,6 +1798,9 @@ class Patient(BaseModel):
     seguro: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class PatientCreate(BaseModel):
     nombre: str
     apellido: str
@@ -187,6 +1825,7 @@ class Appointment(BaseModel):
     status: AppointmentStatus = AppointmentStatus.SOLICITADA
     created_at: datetime = Field(default_factory=datetime.utcnow)
     confirmed_at: Optional[datetime] = None
+    cancelled_at: Optional[datetime] = None
     telemedicine_link: Optional[str] = None
     # New fields for doctor assignment
     assigned_date: Optional[str] = None
@@ -219,35 +1858,137 @@ class ContactCreate(BaseModel):
     asunto: str
     mensaje: str
 
+# Paginated listings
+class AppointmentPage(BaseModel):
+    items: List[Appointment]
+    next_cursor: Optional[str] = None
+
+class MessagePage(BaseModel):
+    items: List[Message]
+    next_cursor: Optional[str] = None
+
+class ConversationPage(BaseModel):
+    items: List[dict]
+    next_cursor: Optional[str] = None
+
+class FlyerPage(BaseModel):
+    items: List[ServiceFlyer]
+    next_cursor: Optional[str] = None
+
+# Documents the API wrote through a model are trusted on the way out: list
+# endpoints project them to the model's fields, fill defaults the stored
+# document predates and encode them with orjson, skipping model construction
+# and response_model validation. The page models stay as the OpenAPI schema.
+class DocumentShape:
+    def __init__(self, model):
+        self.projection = {"_id": False, **{name: True for name in model.model_fields}}
+        self.defaults = {
+            name: field.default for name, field in model.model_fields.items()
+            if not field.is_required() and field.default_factory is None
+        }
+        self.field_count = len(model.model_fields)
+
+    def complete(self, document: dict) -> dict:
+        return document if len(document) == self.field_count else {**self.defaults, **document}
+
+MESSAGE_SHAPE = DocumentShape(Message)
+APPOINTMENT_SHAPE = DocumentShape(Appointment)
+FLYER_SHAPE = DocumentShape(ServiceFlyer)
+
+def page_response(items: list, next_cursor: Optional[str]) -> ORJSONResponse:
+    return ORJSONResponse({"items": items, "next_cursor": next_cursor})
+
+# Degraded responses when MongoDB misses the request deadline:
+# - listings (patient appointments, inbox, conversations, threads, admin
+#   appointments, flyers, patient directory), unread counts and the admin poll
+#   answer the last result this worker served for the same arguments, or an
+#   empty one, with "stale": true; only first pages are kept, at most
+#   LAST_KNOWN_MAX_BYTES of encoded bodies per worker
+# - a single flyer answers its cached entry, or the default flyer
+# - availability answers from the in-memory index with "stale": true
+# - everything else, including every write, answers 503 with Retry-After
+LAST_KNOWN_MAX_BYTES = int(os.environ.get("LAST_KNOWN_MAX_BYTES", str(16 * 1024 * 1024)))
+EMPTY_PAGE = {"items": [], "next_cursor": None}
+
+class LastKnownResults:
+    """LRU of the latest successful response body per (handler, arguments), bounded by total bytes"""
+
+    def __init__(self, max_bytes: int = LAST_KNOWN_MAX_BYTES):
+        self.entries = OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+
+    def get(self, key) -> Optional[bytes]:
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+
+    def put(self, key, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+last_known = LastKnownResults()
+
+def degrades_to(empty: dict):
+    """Serve the last known result, or `empty`, flagged stale when the handler misses its deadline"""
+    def decorate(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(**kwargs):
+            key = (endpoint.__name__, *sorted(kwargs.items()))
+            try:
+                response = await endpoint(**kwargs)
+            except PyMongoError as e:
+                if not e.timeout:
+                    raise
+                DEADLINE_EXCEEDED.inc(endpoint.__name__, "stale")
+                body = last_known.get(key)
+                payload = orjson.loads(body) if body is not None else empty
+                return ORJSONResponse({**payload, "stale": True})
+            # Later pages fall back to empty; keeping every page of every listing would not fit
+            if kwargs.get("after") is None:
+                last_known.put(key, response.body if isinstance(response, Response) else orjson.dumps(response))
+            return response
+        return wrapper
+    return decorate
+
 # Routes
 # Auth routes
 @api_router.post("/auth/register")
 async def register_patient(patient_data: PatientCreate):
-    # Check if patient already exists
-    existing_patient = await db.patients.find_one({"email": patient_data.email})
-    if existing_patient:
-        raise HTTPException(status_code=400, detail="Email ya registrado")
-    
     # Create patient with authentication
-    patient_dict = patient_data.dict()
+    patient_dict = patient_data.model_dump()
     patient_obj = Patient(**patient_dict)
     
-    # Save to database
-    await db.patients.insert_one(patient_obj.dict())
+    # The unique email index rejects existing patients, also when two registrations race
+    try:
+        await db.patients.insert_one(patient_obj.model_dump())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email ya registrado")
+    await upsert_directory_entry(patient_obj.id, f"{patient_obj.nombre} {patient_obj.apellido}", patient_obj.email)
     
     return {
         "message": "Paciente registrado exitosamente",
         "patient_id": patient_obj.id,
-        "patient_name": patient_obj.nombre
+        "patient_name": patient_obj.nombre,
+        **issue_session_tokens(patient_obj.id, "patient")
     }
 
 @api_router.post("/auth/login")
 async def login_patient(email: str, phone: str):
-    # Find patient by email and phone
+    # Find patient by email and phone; later requests carry the token instead
     patient = await db.patients.find_one({
         "email": email,
         "telefono": phone
-    })
+    }, {"_id": False, "id": True, "nombre": True, "email": True})
     
     if not patient:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
@@ -256,7 +1997,8 @@ async def login_patient(email: str, phone: str):
         "message": "Login exitoso",
         "patient_id": patient["id"],
         "patient_name": patient["nombre"],
-        "patient_email": patient["email"]
+        "patient_email": patient["email"],
+        **issue_session_tokens(patient["id"], "patient")
     }
 
 @api_router.post("/auth/admin/login")
@@ -271,16 +2013,39 @@ async def admin_login(email: str, password: str):
     return {
         "message": "Admin login exitoso",
         "role": "admin",
-        "access_token": "admin_token_zimi_2025"
+        **issue_session_tokens("admin", "admin")
     }
 
+@api_router.post("/auth/refresh")
+async def refresh_session(request: RefreshRequest):
+    claims = decode_session_token(request.refresh_token, "refresh")
+    # Rare enough to ask Mongo, which also covers logouts other workers have not synced yet
+    if await db.revoked_sessions.find_one({"_id": claims["sid"]}, {"_id": True}):
+        raise HTTPException(status_code=401, detail="Sesión cerrada", headers={"WWW-Authenticate": "Bearer"})
+    return issue_session_tokens(claims["sub"], claims["role"], claims["sid"])
+
+@api_router.post("/auth/logout")
+async def logout(session: Optional[dict] = Depends(get_session)):
+    if session is not None:
+        # No token of the session outlives a refresh token issued now
+        await revocations.revoke(session["sid"], datetime.utcnow() + REFRESH_TOKEN_TTL)
+    return {"message": "Sesión cerrada exitosamente"}
+
 # Protected routes for patients
-@api_router.get("/patient/{patient_id}/appointments")
-async def get_patient_appointments(patient_id: str):
-    appointments = await db.appointments.find({"patient_id": patient_id}).sort("created_at", -1).to_list(100)
-    return [Appointment(**appointment) for appointment in appointments]
+@api_router.get("/patient/{patient_id}/appointments", response_model=AppointmentPage, dependencies=PATIENT_ACCESS)
+@degrades_to(EMPTY_PAGE)
+async def get_patient_appointments(
+    patient_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None
+):
+    appointments, next_cursor = await fetch_page(
+        db.appointments, {"patient_id": patient_id, **after_cursor(after)}, limit,
+        projection=APPOINTMENT_SHAPE.projection
+    )
+    return page_response([APPOINTMENT_SHAPE.complete(appointment) for appointment in appointments], next_cursor)
 
-@api_router.get("/patient/{patient_id}/profile")
+@api_router.get("/patient/{patient_id}/profile", dependencies=PATIENT_ACCESS)
 async def get_patient_profile(patient_id: str):
     patient = await db.patients.find_one({"id": patient_id})
     if not patient:
@@ -289,48 +2054,177 @@ async def get_patient_profile(patient_id: str):
     return Patient(**patient)
 
 # Notification system for admin
-@api_router.post("/admin/notifications/new-appointment")
+@api_router.post("/admin/notifications/new-appointment", dependencies=ADMIN_ACCESS)
 async def notify_new_appointment(appointment_id: str):
-    # This would trigger push notification to admin
+    # Re-sends the admin notification for an existing appointment through the job queue
+    await job_queue.enqueue("new_appointment_notification", {"appointment_id": appointment_id})
     return {"message": "Notificación enviada al administrador"}
 
 # Message system routes
-@api_router.get("/messages/{user_id}", response_model=List[Message])
-async def get_user_messages(user_id: str):
-    messages = await db.messages.find({
-        "$or": [{"sender_id": user_id}, {"receiver_id": user_id}]
-    }).sort("created_at", -1).to_list(100)
-    return [Message(**message) for message in messages]
-
-@api_router.post("/messages", response_model=Message)
+@api_router.get("/messages/{user_id}", response_model=MessagePage, dependencies=USER_ACCESS)
+@degrades_to(EMPTY_PAGE)
+async def get_user_messages(
+    user_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None
+):
+    # The cursor bound goes inside each branch so both branches stay index range scans merged on sort
+    keyset = after_cursor(after)
+    messages, next_cursor = await fetch_page(db.messages, {
+        "$or": [{"sender_id": user_id, **keyset}, {"receiver_id": user_id, **keyset}]
+    }, limit, projection=MESSAGE_SHAPE.projection)
+    return page_response([MESSAGE_SHAPE.complete(message) for message in messages], next_cursor)
+
+@api_router.get("/messages/stream/{user_id}", dependencies=STREAM_ACCESS)
+async def stream_messages(user_id: str, request: Request, last_event_id: Optional[str] = None):
+    """Server-sent events for new messages and read receipts, replacing inbox polling"""
+    # EventSource sends Last-Event-ID on reconnect; the query parameter covers the first connect
+    resume_from = request.headers.get("last-event-id") or last_event_id
+    subscription = message_events.subscribe(user_id)
+
+    async def event_stream():
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            replayed = set()
+            if resume_from:
+                try:
+                    cursor = db.message_events.find(
+                        {"user_id": user_id, "_id": {"$gt": ObjectId(resume_from)}}
+                    ).sort("_id", ASCENDING).limit(STREAM_REPLAY_LIMIT)
+                    async for event in cursor:
+                        replayed.add(event["_id"])
+                        yield format_sse(event)
+                except InvalidId:
+                    pass
+
+            while not subscription.overflowed:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if event["_id"] not in replayed:
+                    yield format_sse(event)
+        finally:
+            message_events.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.post("/messages", response_model=Message, dependencies=SENDER_ACCESS)
 async def send_message(message_data: MessageCreate, sender_id: str, sender_name: str):
-    message_dict = message_data.dict()
+    message_dict = message_data.model_dump()
     message_dict["sender_id"] = sender_id
     message_dict["sender_name"] = sender_name
     
     message_obj = Message(**message_dict)
-    await db.messages.insert_one(message_obj.dict())
+    # A new message opens its own thread; replies join it
+    message_obj.thread_id = message_obj.id
+    message = message_obj.model_dump()
+    await db.messages.insert_one(message)
+    await fan_out_new_message(message)
     
     return message_obj
 
 @api_router.put("/messages/{message_id}/read")
-async def mark_message_read(message_id: str):
-    result = await db.messages.update_one(
-        {"id": message_id},
-        {"$set": {"is_read": True, "read_at": datetime.utcnow()}}
+async def mark_message_read(message_id: str, session: Optional[dict] = Depends(get_session)):
+    read_at = datetime.utcnow()
+    query = {"id": message_id}
+    # Only the receiver marks a message read; someone else's message looks missing
+    if session is not None and session["role"] != "admin":
+        query["receiver_id"] = session["sub"]
+    message = await db.messages.find_one_and_update(
+        query,
+        {"$set": {"is_read": True, "read_at": read_at}},
+        projection={"sender_id": True, "receiver_id": True, "is_read": True, "thread_id": True}
     )
     
-    if result.matched_count == 0:
+    if message is None:
         raise HTTPException(status_code=404, detail="Mensaje no encontrado")
     
+    # find_one_and_update returns the document as it was, so only a real unread -> read transition counts
+    if not message.get("is_read"):
+        unread_count = await adjust_unread_count(message["receiver_id"], -1)
+        if message.get("thread_id"):
+            await adjust_conversation_unread(message["receiver_id"], {message["thread_id"]: -1})
+    else:
+        unread_count = await read_unread_count(message["receiver_id"])
+    
+    await message_events.publish([message["receiver_id"], message["sender_id"]], "read", {
+        "message_id": message_id,
+        "receiver_id": message["receiver_id"],
+        "read_at": read_at,
+        "unread_count": unread_count
+    })
+    
     return {"message": "Mensaje marcado como leído"}
 
-@api_router.post("/messages/{message_id}/reply", response_model=Message)
+async def mark_messages_read(user_id: str, criteria: dict, notify: List[str]):
+    """Mark the user's unread messages matching criteria read in one update_many.
+
+    Readers and any known counterparty get a read_many event carrying the
+    criteria, which clients apply to the messages they hold.
+    """
+    read_at = datetime.utcnow()
+    query = {"receiver_id": user_id, "is_read": False}
+    if "message_ids" in criteria:
+        query["id"] = {"$in": criteria["message_ids"]}
+    if "sender_id" in criteria:
+        query["sender_id"] = criteria["sender_id"]
+    if "before" in criteria:
+        query["created_at"] = {"$lte": criteria["before"]}
+    
+    result = await db.messages.update_many(query, {"$set": {"is_read": True, "read_at": read_at}})
+    if not result.modified_count:
+        return {"marked_read": 0, "unread_count": await read_unread_count(user_id)}
+    
+    unread_count = await adjust_unread_count(user_id, -result.modified_count)
+    # The shared read_at stamp identifies exactly the messages this call flipped
+    flipped = {**query, "is_read": True, "read_at": read_at}
+    per_thread = await db.messages.aggregate([
+        {"$match": flipped},
+        {"$group": {"_id": "$thread_id", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    await adjust_conversation_unread(user_id, {
+        group["_id"]: -group["count"] for group in per_thread if group["_id"]
+    })
+    await message_events.publish([user_id, *notify], "read_many", {
+        **criteria,
+        "receiver_id": user_id,
+        "read_at": read_at,
+        "unread_count": unread_count
+    })
+    
+    return {"marked_read": result.modified_count, "unread_count": unread_count}
+
+@api_router.put("/messages/read-bulk/{user_id}/ids", dependencies=USER_ACCESS)
+async def mark_messages_read_by_ids(user_id: str, request: BulkReadRequest):
+    return await mark_messages_read(user_id, {"message_ids": request.message_ids}, [])
+
+@api_router.put("/messages/read-bulk/{user_id}/from/{sender_id}", dependencies=USER_ACCESS)
+async def mark_messages_read_from(user_id: str, sender_id: str):
+    return await mark_messages_read(user_id, {"sender_id": sender_id}, [sender_id])
+
+@api_router.put("/messages/read-bulk/{user_id}/before", dependencies=USER_ACCESS)
+async def mark_messages_read_before(user_id: str, before: Optional[datetime] = None):
+    # Without a timestamp this clears the inbox up to now
+    return await mark_messages_read(user_id, {"before": before or datetime.utcnow()}, [])
+
+@api_router.post("/messages/{message_id}/reply", response_model=Message, dependencies=SENDER_ACCESS)
 async def reply_to_message(message_id: str, reply_data: MessageReply, sender_id: str, sender_name: str):
     # Get original message
-    original_message = await db.messages.find_one({"id": message_id})
+    original_message = await db.messages.find_one({"id": message_id}, {
+        "_id": False, "id": True, "sender_id": True, "receiver_id": True, "sender_name": True, "subject": True,
+        "message_type": True, "appointment_id": True, "thread_id": True
+    })
     if not original_message:
         raise HTTPException(status_code=404, detail="Mensaje original no encontrado")
+    # SENDER_ACCESS ties sender_id to the caller; only the two ends of a message reply to it
+    if sender_id not in (original_message["sender_id"], original_message["receiver_id"]):
+        raise HTTPException(status_code=403, detail="Acceso no autorizado")
     
     # Create reply
     reply_dict = {
@@ -341,262 +2235,583 @@ async def reply_to_message(message_id: str, reply_data: MessageReply, sender_id:
         "subject": f"Re: {original_message['subject']}",
         "message": reply_data.message,
         "message_type": original_message["message_type"],
-        "appointment_id": original_message.get("appointment_id")
+        "appointment_id": original_message.get("appointment_id"),
+        # Messages stored before threads existed start a thread of their own
+        "thread_id": original_message.get("thread_id") or original_message["id"]
     }
     
     reply_obj = Message(**reply_dict)
-    await db.messages.insert_one(reply_obj.dict())
+    reply = reply_obj.model_dump()
+    await db.messages.insert_one(reply)
+    await fan_out_new_message(reply)
     
     return reply_obj
 
-@api_router.get("/messages/unread/{user_id}")
+@api_router.get("/messages/unread/{user_id}", dependencies=USER_ACCESS)
+@degrades_to({"unread_count": 0})
 async def get_unread_count(user_id: str):
-    count = await db.messages.count_documents({
-        "receiver_id": user_id,
-        "is_read": False
-    })
-    return {"unread_count": count}
-
-@api_router.get("/admin/messages/poll")
+    return {"unread_count": await read_unread_count(user_id, listing=True)}
+
+@api_router.post("/admin/messages/unread/rebuild", dependencies=ADMIN_SESSION_ACCESS)
+async def rebuild_unread_counters():
+    """Recompute every unread counter from the messages collection.
+
+    Increments landing while the rebuild runs can be overwritten, so run it
+    when the counters are known to have drifted rather than on a schedule.
+    """
+    users_with_unread = await rebuild_unread_counts()
+    return {"message": "Contadores de mensajes no leídos reconstruidos", "users_with_unread": users_with_unread}
+
+@api_router.get("/conversations/{user_id}", response_model=ConversationPage, dependencies=USER_ACCESS)
+@degrades_to(EMPTY_PAGE)
+async def get_conversations(
+    user_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None
+):
+    """Threads the user takes part in, most recently active first"""
+    conversations, next_cursor = await fetch_page(db.conversations, {
+        "participants": user_id, **after_cursor(after, "updated_at")
+    }, limit, "updated_at")
+    return page_response([conversation_summary(conversation, user_id) for conversation in conversations], next_cursor)
+
+@api_router.get("/conversations/thread/{thread_id}/messages", response_model=MessagePage, dependencies=THREAD_ACCESS)
+@degrades_to(EMPTY_PAGE)
+async def get_conversation_messages(
+    thread_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None
+):
+    """Messages of one thread, newest first"""
+    messages, next_cursor = await fetch_page(
+        db.messages, {"thread_id": thread_id, **after_cursor(after)}, limit, projection=MESSAGE_SHAPE.projection
+    )
+    return page_response([MESSAGE_SHAPE.complete(message) for message in messages], next_cursor)
+
+CONVERSATION_REBUILD_BATCH = 500
+
+@api_router.post("/admin/conversations/rebuild", dependencies=ADMIN_SESSION_ACCESS)
+async def rebuild_conversations():
+    """Backfill thread ids and recompute every conversation from the messages.
+
+    Messages stored before threads existed each become a thread of their own.
+    Like the unread counter rebuild, run it when summaries have drifted.
+    """
+    await db.messages.update_many({"thread_id": None}, [{"$set": {"thread_id": "$id"}}])
+
+    batch, rebuilt, current = [], 0, None
+
+    async def flush():
+        nonlocal batch, rebuilt
+        if batch:
+            await db.conversations.bulk_write(batch, ordered=False)
+            rebuilt += len(batch)
+            batch = []
+
+    # Walking each thread newest first makes its first message the preview and its last the opener
+    cursor = db.messages.find().sort([("thread_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)])
+    async for message in cursor:
+        if current is None or current["_id"] != message["thread_id"]:
+            if current is not None:
+                batch.append(ReplaceOne({"_id": current["_id"]}, current, upsert=True))
+                if len(batch) >= CONVERSATION_REBUILD_BATCH:
+                    await flush()
+            current = {
+                "_id": message["thread_id"],
+                "id": message["thread_id"],
+                "participants": [],
+                "participant_names": {},
+                "last_message": {
+                    "id": message["id"],
+                    "sender_id": message["sender_id"],
+                    "sender_name": message["sender_name"],
+                    "preview": message["message"][:CONVERSATION_PREVIEW_LENGTH],
+                    "created_at": message["created_at"]
+                },
+                "unread": {},
+                "message_count": 0,
+                "updated_at": message["created_at"]
+            }
+        for participant, name in ((message["sender_id"], message["sender_name"]), (message["receiver_id"], message["receiver_name"])):
+            if participant not in current["participant_names"]:
+                current["participants"].append(participant)
+                current["participant_names"][participant] = name
+        if not message.get("is_read"):
+            current["unread"][message["receiver_id"]] = current["unread"].get(message["receiver_id"], 0) + 1
+        current["message_count"] += 1
+        current["subject"] = message["subject"]
+        current["created_at"] = message["created_at"]
+    if current is not None:
+        batch.append(ReplaceOne({"_id": current["_id"]}, current, upsert=True))
+    await flush()
+
+    return {"message": "Conversaciones reconstruidas", "conversations": rebuilt}
+
+@api_router.get("/admin/messages/poll", dependencies=ADMIN_ACCESS)
+@degrades_to({"unread_count": 0, "latest_messages": []})
 async def poll_admin_messages():
     """Polling endpoint specifically for admin to check for new messages"""
-    try:
-        # Get unread message count for admin
-        unread_count = await db.messages.count_documents({
-            "receiver_id": "admin",
-            "is_read": False
-        })
-        
-        # Get latest unread messages for admin (limited to 5 most recent)
-        latest_messages = await db.messages.find({
+    # Get unread message count for admin
+    unread_count = await read_unread_count("admin", listing=True)
+    
+    # Get latest unread messages for admin (limited to 5 most recent)
+    async with listing_reads() as (reads_db, session):
+        latest_messages = await reads_db.messages.find({
             "receiver_id": "admin",
             "is_read": False
-        }).sort("created_at", -1).limit(5).to_list(5)
-        
-        return {
-            "unread_count": unread_count,
-            "latest_messages": [
+        }, session=session).sort("created_at", -1).limit(5).to_list(5)
+    
+    return {
+        "unread_count": unread_count,
+        "latest_messages": [
+            {
+                "id": msg["id"],
+                "sender_name": msg["sender_name"],
+                "subject": msg["subject"],
+                "created_at": msg["created_at"]
+            } for msg in latest_messages
+        ]
+    }
+
+@api_router.get("/admin/patients", dependencies=ADMIN_SESSION_ACCESS)
+@degrades_to(EMPTY_PAGE)
+async def get_patient_directory(
+    q: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None
+):
+    """Patients by name, optionally filtered by a name or email prefix"""
+    conditions = []
+    if q and q.strip():
+        prefix = "^" + re.escape(q.strip().lower())
+        conditions.append({"$or": [
+            {"name_key": {"$regex": prefix}},
+            {"name_tokens": {"$regex": prefix}},
+            {"email_key": {"$regex": prefix}}
+        ]})
+    if after:
+        conditions.append(after_directory_cursor(after))
+    query = {"$and": conditions} if conditions else {}
+    
+    entries = await db.patient_directory.find(
+        query, projection={"id": True, "name": True, "email": True, "last_visit": True, "name_key": True}
+    ).sort([("name_key", ASCENDING), ("_id", ASCENDING)]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = encode_directory_cursor(entries[limit - 1]) if len(entries) > limit else None
+    
+    return {
+        "items": [
+            {
+                "id": entry["id"],
+                "name": entry["name"],
+                "email": entry["email"],
+                "last_visit": entry.get("last_visit")
+            } for entry in entries[:limit]
+        ],
+        "next_cursor": next_cursor
+    }
+
+async def rebuild_directory() -> int:
+    """Backfill the patient directory from registered patients and appointment history"""
+    await db.patients.aggregate([
+        {"$project": {
+            "_id": "$id",
+            "id": "$id",
+            "name": {"$concat": ["$nombre", " ", "$apellido"]},
+            "email": "$email",
+            "name_key": {"$toLower": {"$concat": ["$nombre", " ", "$apellido"]}},
+            "name_tokens": name_tokens_expr({"$concat": ["$nombre", " ", "$apellido"]}),
+            "email_key": {"$toLower": "$email"}
+        }},
+        {"$merge": {"into": "patient_directory", "whenMatched": "merge", "whenNotMatched": "insert"}}
+    ]).to_list(None)
+    await db.appointments.aggregate([
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": "$patient_id",
+            "name": {"$last": "$patient_name"},
+            "email": {"$last": "$patient_email"},
+            "last_visit": {"$max": "$created_at"}
+        }},
+        {"$project": {
+            "id": "$_id",
+            "name": True,
+            "email": True,
+            "last_visit": True,
+            "name_key": {"$toLower": "$name"},
+            "name_tokens": name_tokens_expr("$name"),
+            "email_key": {"$toLower": "$email"}
+        }},
+        {"$merge": {"into": "patient_directory", "whenMatched": "merge", "whenNotMatched": "insert"}}
+    ]).to_list(None)
+    return await db.patient_directory.estimated_document_count()
+
+@api_router.post("/admin/patients/directory/rebuild", dependencies=ADMIN_SESSION_ACCESS)
+async def rebuild_patient_directory():
+    """Backfill the patient directory from registered patients and appointment history"""
+    total = await rebuild_directory()
+    return {"message": "Directorio de pacientes reconstruido", "patients": total}
+
+@api_router.get("/admin/db/indexes", dependencies=ADMIN_SESSION_ACCESS)
+async def audit_indexes():
+    """Report index usage per collection and any API query shape still planned as a COLLSCAN"""
+    collections = {}
+    for collection_name, indexes in COLLECTION_INDEXES.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        usage = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        collections[collection_name] = {
+            "missing": [index.document["name"] for index in indexes if index.document["name"] not in existing],
+            "indexes": [
                 {
-                    "id": msg["id"],
-                    "sender_name": msg["sender_name"],
-                    "subject": msg["subject"],
-                    "created_at": msg["created_at"]
-                } for msg in latest_messages
+                    "name": stat["name"],
+                    "key": dict(stat["key"]),
+                    "ops": stat["accesses"]["ops"],
+                    "since": stat["accesses"]["since"]
+                } for stat in usage
             ]
         }
-    except Exception as e:
-        print(f"❌ Error polling admin messages: {str(e)}")
-        return {"unread_count": 0, "latest_messages": []}
+
+    collscans = []
+    for shape in QUERY_SHAPES:
+        find = {"find": shape["collection"], "filter": shape["filter"]}
+        if "sort" in shape:
+            find["sort"] = shape["sort"]
+        explain = await db.command("explain", find, verbosity="queryPlanner")
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" in stages:
+            collscans.append({"query": shape["name"], "collection": shape["collection"], "stages": stages})
+
+    return {"collections": collections, "collscans": collscans}
+
+def _plan_stages(plan: dict) -> List[str]:
+    """Flatten a query planner tree into the list of its stage names"""
+    stages = [plan.get("stage")]
+    if "inputStage" in plan:
+        stages += _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    if "queryPlan" in plan:
+        stages += _plan_stages(plan["queryPlan"])
+    return stages
+
+@api_router.get("/admin/db/pool", dependencies=ADMIN_SESSION_ACCESS)
+async def get_pool_stats():
+    """Pool settings and, per server, live checkouts, checkout waits and connection churn since startup.
+
+    Wait percentiles are the upper bounds of the histogram buckets holding them.
+    """
+    pool = client.options.pool_options
+    servers = defaultdict(lambda: {
+        "connections": 0, "in_use": 0, "checkouts": 0, "checkout_failures": {},
+        "wait_mean_ms": None, "wait_p50_ms": None, "wait_p95_ms": None, "wait_p99_ms": None,
+        "created": 0, "closed": {}, "cleared": 0
+    })
+    for (address,), value in MONGO_CONNECTIONS.snapshot().items():
+        servers[address]["connections"] = value
+    for (address,), value in MONGO_CONNECTIONS_IN_USE.snapshot().items():
+        servers[address]["in_use"] = value
+    for (address,), value in MONGO_CONNECTIONS_CREATED.snapshot().items():
+        servers[address]["created"] = value
+    for (address, reason), value in MONGO_CONNECTIONS_CLOSED.snapshot().items():
+        servers[address]["closed"][reason] = value
+    for (address, reason), value in MONGO_CHECKOUT_FAILURES.snapshot().items():
+        servers[address]["checkout_failures"][reason] = value
+    for (address,), value in MONGO_POOL_CLEARED.snapshot().items():
+        servers[address]["cleared"] = value
+    for (address,), (counts, total, count) in MONGO_CHECKOUT_WAIT.snapshot().items():
+        # Failed checkouts are timed too, so successful ones are the total minus the failures
+        servers[address]["checkouts"] = count - sum(servers[address]["checkout_failures"].values())
+        servers[address]["wait_mean_ms"] = round(total / count * 1000, 3)
+        for name, q in (("wait_p50_ms", 0.5), ("wait_p95_ms", 0.95), ("wait_p99_ms", 0.99)):
+            bound = MONGO_CHECKOUT_WAIT.quantile(counts, count, q)
+            servers[address][name] = bound * 1000 if bound is not None else None
+    return {
+        "options": {
+            "max_pool_size": pool.max_pool_size,
+            "min_pool_size": pool.min_pool_size,
+            "max_idle_time_ms": int(pool.max_idle_time_seconds * 1000) if pool.max_idle_time_seconds else None,
+            "server_selection_timeout_ms": int(client.options.server_selection_timeout * 1000),
+            "compressors": mongo_options["compressors"]
+        },
+        "servers": [{"address": address, **stats} for address, stats in sorted(servers.items())]
+    }
+
+@api_router.get("/admin/jobs", dependencies=ADMIN_SESSION_ACCESS)
+async def get_job_status(limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)):
+    """Queue depth by status and the most recent dead letters"""
+    counts = await db.jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(None)
+    dead = await db.dead_jobs.find().sort("failed_at", DESCENDING).limit(limit).to_list(limit)
+    return {
+        "queued": {entry["_id"]: entry["count"] for entry in counts},
+        "dead": [
+            {
+                "id": str(job["_id"]),
+                "type": job["type"],
+                "attempts": job["attempts"],
+                "last_error": job["last_error"],
+                "created_at": job["created_at"],
+                "failed_at": job["failed_at"]
+            } for job in dead
+        ]
+    }
+
+@api_router.post("/admin/jobs/dead/{job_id}/retry", dependencies=ADMIN_SESSION_ACCESS)
+async def retry_dead_job(job_id: str):
+    try:
+        job = await db.dead_jobs.find_one_and_delete({"_id": ObjectId(job_id)})
+    except InvalidId:
+        job = None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    await job_queue.enqueue(job["type"], job["payload"])
+    return {"message": "Tarea reencolada"}
 
 # Flyer management routes (Admin only)
-@api_router.get("/flyers")
-async def get_all_flyers():
-    flyers = await db.flyers.find().to_list(100)
-    return [ServiceFlyer(**flyer) for flyer in flyers]
+@api_router.get("/flyers", response_model=FlyerPage)
+@degrades_to(EMPTY_PAGE)
+async def get_all_flyers(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None
+):
+    flyers, next_cursor = await fetch_page(db.flyers, after_cursor(after), limit, projection=FLYER_SHAPE.projection)
+    return page_response([FLYER_SHAPE.complete(flyer) for flyer in flyers], next_cursor)
 
 @api_router.get("/flyers/{service_id}")
-async def get_service_flyer(service_id: str):
-    flyer = await db.flyers.find_one({"service_id": service_id})
-    if not flyer:
-        # Return default flyer structure
-        return create_default_flyer(service_id)
-    return ServiceFlyer(**flyer)
-
-@api_router.post("/flyers", response_model=ServiceFlyer)
+async def get_service_flyer(service_id: str, request: Request):
+    # Stored flyer, or the default flyer structure when none was saved
+    body, etag = await flyer_cache.get(service_id)
+    return cached_json_response(body, etag, FLYER_CACHE_CONTROL, request)
+
+@api_router.post("/flyers", response_model=ServiceFlyer, dependencies=ADMIN_ACCESS)
 async def create_service_flyer(flyer_data: FlyerCreate):
-    # Check if flyer already exists for this service
-    existing = await db.flyers.find_one({"service_id": flyer_data.service_id})
-    if existing:
+    flyer_obj = ServiceFlyer(**flyer_data.model_dump())
+    # One flyer per service is enforced by the unique service_id index
+    try:
+        await db.flyers.insert_one(flyer_obj.model_dump())
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Flyer ya existe para este servicio")
-    
-    flyer_obj = ServiceFlyer(**flyer_data.dict())
-    await db.flyers.insert_one(flyer_obj.dict())
+    await flyer_cache.invalidate(flyer_obj.service_id)
     return flyer_obj
 
-@api_router.put("/flyers/{service_id}")
+@api_router.put("/flyers/{service_id}", dependencies=ADMIN_ACCESS)
 async def update_service_flyer(service_id: str, flyer_data: FlyerUpdate):
-    update_data = {k: v for k, v in flyer_data.dict().items() if v is not None}
+    update_data = {k: v for k, v in flyer_data.model_dump().items() if v is not None}
     update_data["updated_at"] = datetime.utcnow()
     
     result = await db.flyers.update_one(
         {"service_id": service_id},
-        {"$set": update_data},
+        {
+            "$set": update_data,
+            # Upserted flyers need the pagination keys like flyers created through POST
+            "$setOnInsert": {"id": str(uuid.uuid4()), "created_at": update_data["updated_at"]}
+        },
         upsert=True
     )
     
     if result.matched_count == 0 and result.upserted_id is None:
         raise HTTPException(status_code=404, detail="Error actualizando flyer")
     
+    await flyer_cache.invalidate(service_id)
     return {"message": "Flyer actualizado exitosamente"}
 
-@api_router.delete("/flyers/{service_id}")
+@api_router.delete("/flyers/{service_id}", dependencies=ADMIN_ACCESS)
 async def delete_service_flyer(service_id: str):
     result = await db.flyers.delete_one({"service_id": service_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Flyer no encontrado")
+    await flyer_cache.invalidate(service_id)
     return {"message": "Flyer eliminado exitosamente"}
 
+DEFAULT_FLYERS = {
+    "acupuntura": {
+        "title": "Tratamientos de Acupuntura",
+        "image_url": "https://via.placeholder.com/800x600/1e40af/ffffff?text=Acupuntura+ZIMI",
+        "benefits": [
+            "Alivio del dolor crónico y agudo",
+            "Reducción del estrés y ansiedad",
+            "Mejora de la calidad del sueño",
+            "Fortalecimiento del sistema inmunológico",
+            "Equilibrio energético del cuerpo"
+        ],
+        "conditions": [
+            "Dolores de espalda y cuello",
+            "Migrañas y dolores de cabeza",
+            "Artritis y dolor articular",
+            "Problemas digestivos",
+            "Ansiedad y depresión",
+            "Insomnio"
+        ],
+        "process": [
+            "Consulta inicial y evaluación",
+            "Diagnóstico según medicina tradicional china",
+            "Inserción de agujas estériles en puntos específicos",
+            "Sesión de 30-45 minutos de relajación",
+            "Plan de tratamiento personalizado"
+        ],
+        "offer_title": "OFERTA ESPECIAL",
+        "offer_description": "20 Sesiones de Acupuntura",
+        "offer_price": "$1500",
+        "offer_original_price": "$2000",
+        "offer_savings": "Ahorra $500"
+    },
+    "medicina_oriental": {
+        "title": "Medicina Oriental Tradicional",
+        "image_url": "https://via.placeholder.com/800x600/059669/ffffff?text=Medicina+Oriental",
+        "benefits": [
+            "Enfoque holístico del cuerpo",
+            "Tratamiento de la causa raíz",
+            "Técnicas milenarias probadas",
+            "Sin efectos secundarios",
+            "Mejora del equilibrio interno"
+        ],
+        "conditions": [
+            "Problemas digestivos crónicos",
+            "Desequilibrios hormonales",
+            "Fatiga crónica",
+            "Problemas respiratorios",
+            "Trastornos del sueño"
+        ],
+        "process": [
+            "Evaluación según principios TCM",
+            "Análisis de pulso y lengua",
+            "Diagnóstico energético",
+            "Plan de tratamiento integral",
+            "Seguimiento personalizado"
+        ]
+    },
+    "medicina_funcional": {
+        "title": "Medicina Funcional Personalizada",
+        "image_url": "https://via.placeholder.com/800x600/7c3aed/ffffff?text=Medicina+Funcional",
+        "benefits": [
+            "Enfoque personalizado único",
+            "Identificación de causas raíz",
+            "Prevención de enfermedades",
+            "Optimización de la salud",
+            "Tratamiento integral"
+        ],
+        "conditions": [
+            "Enfermedades autoinmunes",
+            "Síndrome metabólico",
+            "Problemas hormonales",
+            "Inflamación crónica",
+            "Alergias alimentarias"
+        ],
+        "process": [
+            "Evaluación funcional completa",
+            "Análisis de laboratorio avanzado",
+            "Identificación de desequilibrios",
+            "Protocolo de tratamiento personalizado",
+            "Monitoreo continuo de progreso"
+        ]
+    },
+    "fisioterapia": {
+        "title": "Fisioterapia Especializada",
+        "image_url": "https://via.placeholder.com/800x600/dc2626/ffffff?text=Fisioterapia",
+        "benefits": [
+            "Recuperación de movilidad",
+            "Fortalecimiento muscular",
+            "Alivio del dolor",
+            "Prevención de lesiones",
+            "Mejora de la postura"
+        ],
+        "conditions": [
+            "Lesiones deportivas",
+            "Dolor de espalda",
+            "Rehabilitación post-quirúrgica",
+            "Problemas de postura",
+            "Artritis y rigidez articular"
+        ],
+        "process": [
+            "Evaluación física completa",
+            "Análisis de movimiento",
+            "Diseño de plan de ejercicios",
+            "Terapia manual especializada",
+            "Programa de mantenimiento"
+        ]
+    }
+}
+
+DEFAULT_FLYER_DETAILS = {
+    "safety": "Procedimiento completamente seguro realizado por profesionales certificados",
+    "duration": "45-60 minutos por sesión",
+    "frequency": "1-2 sesiones por semana inicialmente",
+    "location": "7700 N Kendall Dr. Unit 807, Kendall, FL 33156",
+    "contact_phone": "(305) 274-4351",
+    "contact_website": "www.drzerquera.com"
+}
+
+# Services whose default flyer is cached; any other id falls back to the acupuntura content
+DEFAULT_FLYER_SERVICES = {service.value for service in ServiceType}
+
 def create_default_flyer(service_id: str):
     """Create default flyer content for each service"""
-    default_flyers = {
-        "acupuntura": {
-            "title": "Tratamientos de Acupuntura",
-            "image_url": "https://via.placeholder.com/800x600/1e40af/ffffff?text=Acupuntura+ZIMI",
-            "benefits": [
-                "Alivio del dolor crónico y agudo",
-                "Reducción del estrés y ansiedad",
-                "Mejora de la calidad del sueño",
-                "Fortalecimiento del sistema inmunológico",
-                "Equilibrio energético del cuerpo"
-            ],
-            "conditions": [
-                "Dolores de espalda y cuello",
-                "Migrañas y dolores de cabeza",
-                "Artritis y dolor articular",
-                "Problemas digestivos",
-                "Ansiedad y depresión",
-                "Insomnio"
-            ],
-            "process": [
-                "Consulta inicial y evaluación",
-                "Diagnóstico según medicina tradicional china",
-                "Inserción de agujas estériles en puntos específicos",
-                "Sesión de 30-45 minutos de relajación",
-                "Plan de tratamiento personalizado"
-            ],
-            "offer_title": "OFERTA ESPECIAL",
-            "offer_description": "20 Sesiones de Acupuntura",
-            "offer_price": "$1500",
-            "offer_original_price": "$2000",
-            "offer_savings": "Ahorra $500"
-        },
-        "medicina_oriental": {
-            "title": "Medicina Oriental Tradicional",
-            "image_url": "https://via.placeholder.com/800x600/059669/ffffff?text=Medicina+Oriental",
-            "benefits": [
-                "Enfoque holístico del cuerpo",
-                "Tratamiento de la causa raíz",
-                "Técnicas milenarias probadas",
-                "Sin efectos secundarios",
-                "Mejora del equilibrio interno"
-            ],
-            "conditions": [
-                "Problemas digestivos crónicos",
-                "Desequilibrios hormonales",
-                "Fatiga crónica",
-                "Problemas respiratorios",
-                "Trastornos del sueño"
-            ],
-            "process": [
-                "Evaluación según principios TCM",
-                "Análisis de pulso y lengua",
-                "Diagnóstico energético",
-                "Plan de tratamiento integral",
-                "Seguimiento personalizado"
-            ]
-        },
-        "medicina_funcional": {
-            "title": "Medicina Funcional Personalizada",
-            "image_url": "https://via.placeholder.com/800x600/7c3aed/ffffff?text=Medicina+Funcional",
-            "benefits": [
-                "Enfoque personalizado único",
-                "Identificación de causas raíz",
-                "Prevención de enfermedades",
-                "Optimización de la salud",
-                "Tratamiento integral"
-            ],
-            "conditions": [
-                "Enfermedades autoinmunes",
-                "Síndrome metabólico",
-                "Problemas hormonales",
-                "Inflamación crónica",
-                "Alergias alimentarias"
-            ],
-            "process": [
-                "Evaluación funcional completa",
-                "Análisis de laboratorio avanzado",
-                "Identificación de desequilibrios",
-                "Protocolo de tratamiento personalizado",
-                "Monitoreo continuo de progreso"
-            ]
-        },
-        "fisioterapia": {
-            "title": "Fisioterapia Especializada",
-            "image_url": "https://via.placeholder.com/800x600/dc2626/ffffff?text=Fisioterapia",
-            "benefits": [
-                "Recuperación de movilidad",
-                "Fortalecimiento muscular",
-                "Alivio del dolor",
-                "Prevención de lesiones",
-                "Mejora de la postura"
-            ],
-            "conditions": [
-                "Lesiones deportivas",
-                "Dolor de espalda",
-                "Rehabilitación post-quirúrgica",
-                "Problemas de postura",
-                "Artritis y rigidez articular"
-            ],
-            "process": [
-                "Evaluación física completa",
-                "Análisis de movimiento",
-                "Diseño de plan de ejercicios",
-                "Terapia manual especializada",
-                "Programa de mantenimiento"
-            ]
-        }
-    }
-    
-    default_data = default_flyers.get(service_id, default_flyers["acupuntura"])
+    default_data = DEFAULT_FLYERS.get(service_id, DEFAULT_FLYERS["acupuntura"])
     
     return {
         "service_id": service_id,
-        "safety": "Procedimiento completamente seguro realizado por profesionales certificados",
-        "duration": "45-60 minutos por sesión",
-        "frequency": "1-2 sesiones por semana inicialmente",
-        "location": "7700 N Kendall Dr. Unit 807, Kendall, FL 33156",
-        "contact_phone": "(305) 274-4351",
-        "contact_website": "www.drzerquera.com",
+        **DEFAULT_FLYER_DETAILS,
         **default_data
     }
 
 # Add route to serve doctor image
 @api_router.get("/doctor-image/current")
-async def get_current_doctor_image():
-    """Serve the current doctor image"""
-    global DOCTOR_IMAGE_DATA
-    
-    if not DOCTOR_IMAGE_DATA:
-        # Return default professional image if none is set
+async def get_current_doctor_image(request: Request, v: Optional[str] = None):
+    """Serve the current doctor image as binary with ETag and Range support"""
+    # A version this worker has not seen yet means an upload elsewhere, skip the throttle
+    data = await doctor_image.load(force=bool(v) and v != doctor_image.version())
+    if data is None:
         raise HTTPException(status_code=404, detail="No doctor image available")
     
-    # For base64 data URLs, return JSON with the data
-    return {"image_data": DOCTOR_IMAGE_DATA}
+    etag = f'"{doctor_image.sha256}"'
+    # Versioned URLs (as returned by /doctor-info) never change content
+    versioned = bool(v) and v == doctor_image.version()
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": DOCTOR_IMAGE_VERSIONED_CACHE_CONTROL if versioned else DOCTOR_IMAGE_CACHE_CONTROL
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range == etag):
+        byte_range = parse_byte_range(range_header, len(data))
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(data)}"})
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return Response(content=data[start:end + 1], status_code=206, media_type=doctor_image.content_type, headers=headers)
+    
+    return Response(content=data, media_type=doctor_image.content_type, headers=headers)
 
 # Add route to update doctor image (Admin only)
-@api_router.post("/admin/doctor-image")
+@api_router.post("/admin/doctor-image", dependencies=ADMIN_ACCESS)
 async def update_doctor_image(request: DoctorImageUpdate):
-    """Update doctor image with base64 data"""
-    global DOCTOR_IMAGE_DATA
+    """Update doctor image from a base64 data URL, stored as binary"""
+    # Validate that we received image data
+    if not request.image_data:
+        raise HTTPException(status_code=400, detail="No image data provided")
     
     try:
-        # Validate that we received image data
-        if not request.image_data:
-            raise HTTPException(status_code=400, detail="No image data provided")
-        
-        # Validate base64 format (basic check)
-        if not request.image_data.startswith('data:image/'):
-            raise HTTPException(status_code=400, detail="Invalid image format. Must be a valid base64 image.")
-        
-        # Update the global variable (in production, this would update the database)
-        DOCTOR_IMAGE_DATA = request.image_data
+        content_type, data = parse_data_url(request.image_data)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid image format. Must be a valid base64 image.")
+    
+    if len(data) > DOCTOR_IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="La imagen excede el tamaño máximo de 5 MB")
+    
+    try:
+        await doctor_image.save(content_type, data)
+        catalog.invalidate("doctor-info")
         
-        print(f"✅ Doctor image updated successfully! Length: {len(request.image_data)} characters")
+        print(f"✅ Doctor image updated successfully! Size: {len(data)} bytes")
         
         return {
             "message": "Imagen del doctor actualizada exitosamente",
             "status": "success",
-            "image_length": len(request.image_data),
+            "image_length": len(data),
+            "image_url": doctor_image.url(),
             "updated": True
         }
         
@@ -609,226 +2824,551 @@ async def update_doctor_image(request: DoctorImageUpdate):
 async def root():
     return {"message": "ZIMI API - Zerquera Integrative Medical Institute"}
 
+SERVICES = [
+    {
+        "id": "acupuntura",
+        "nombre": "Acupuntura",
+        "descripcion": "Técnica de curación milenaria que utiliza agujas finas para restaurar el equilibrio, aliviar el dolor y promover el bienestar general.",
+        "duracion": "45-60 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": False
+    },
+    {
+        "id": "medicina_oriental",
+        "nombre": "Medicina Oriental",
+        "descripcion": "Enfoque integral que combina diagnóstico tradicional chino con técnicas modernas para tratar la causa raíz de las enfermedades.",
+        "duracion": "60 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": True
+    },
+    {
+        "id": "medicina_funcional",
+        "nombre": "Medicina Funcional",
+        "descripcion": "Enfoque personalizado que identifica y trata las causas fundamentales de las enfermedades crónicas.",
+        "duracion": "90 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": True
+    },
+    {
+        "id": "medicina_ortomolecular",
+        "nombre": "Medicina Ortomolecular",
+        "descripcion": "Tratamiento que utiliza nutrientes en dosis terapéuticas para restaurar el equilibrio bioquímico óptimo.",
+        "duracion": "60 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": True
+    },
+    {
+        "id": "homeopatia",
+        "nombre": "Medicina Homeopática",
+        "descripcion": "Sistema de medicina natural que estimula la capacidad innata del cuerpo para curarse a sí mismo.",
+        "duracion": "75 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": True
+    },
+    {
+        "id": "nutricion_tcm",
+        "nombre": "Consulta de Nutrición TCM",
+        "descripcion": "Orientación personalizada sobre el uso de principios de la Medicina Tradicional China para optimizar la salud a través de la nutrición adecuada.",
+        "duracion": "45 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": True
+    },
+    {
+        "id": "fisioterapia",
+        "nombre": "Fisioterapia",
+        "descripcion": "Ejercicios personalizados y técnicas manuales para optimizar el movimiento, reducir el dolor y mejorar la función física.",
+        "duracion": "45 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": False
+    },
+    {
+        "id": "terapia_ozono",
+        "nombre": "Terapia de Ozono en Acupuntos",
+        "descripcion": "Aplicación dirigida de ozono en puntos de acupuntura para mejorar la curación, apoyar el sistema inmunológico y aliviar el dolor.",
+        "duracion": "30 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": False
+    },
+    {
+        "id": "terapia_inyeccion",
+        "nombre": "Terapia de Inyección",
+        "descripcion": "Utilización de inyecciones especializadas para administrar sustancias naturales para el alivio dirigido del dolor y la regeneración de tejidos.",
+        "duracion": "30 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": False
+    },
+    {
+        "id": "herbal_tcm",
+        "nombre": "Consulta Herbal TCM",
+        "descripcion": "Asesoramiento experto sobre la incorporación de la Medicina Herbal China Tradicional para objetivos personalizados de salud y bienestar.",
+        "duracion": "60 minutos",
+        "precio_estimado": "Consultar",
+        "disponible_telemedicina": True
+    }
+]
+
 @api_router.get("/services")
-async def get_services():
-    services = [
-        {
-            "id": "acupuntura",
-            "nombre": "Acupuntura",
-            "descripcion": "Técnica de curación milenaria que utiliza agujas finas para restaurar el equilibrio, aliviar el dolor y promover el bienestar general.",
-            "duracion": "45-60 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": False
-        },
+async def get_services(request: Request):
+    return catalog.response("services", request)
+
+DOCTOR_INFO = {
+    "nombre": "Dr. Pablo Zerquera",
+    "titulo": "OMD, AP, PhD",
+    "especialidades": [
+        "Medicina Oriental y Acupuntura",
+        "Medicina Funcional",
+        "Medicina Ortomolecular", 
+        "Medicina Homeopática",
+        "Manejo del Dolor"
+    ],
+    "educacion": [
         {
-            "id": "medicina_oriental",
-            "nombre": "Medicina Oriental",
-            "descripcion": "Enfoque integral que combina diagnóstico tradicional chino con técnicas modernas para tratar la causa raíz de las enfermedades.",
-            "duracion": "60 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": True
+            "institucion": "Universidad de La Habana",
+            "titulo": "Título Médico",
+            "pais": "Cuba"
         },
         {
-            "id": "medicina_funcional",
-            "nombre": "Medicina Funcional",
-            "descripcion": "Enfoque personalizado que identifica y trata las causas fundamentales de las enfermedades crónicas.",
-            "duracion": "90 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": True
+            "institucion": "AMC Miami",
+            "titulo": "Grado en Medicina Oriental y Acupuntura",
+            "pais": "Florida, USA"
         },
         {
-            "id": "medicina_ortomolecular",
-            "nombre": "Medicina Ortomolecular",
-            "descripcion": "Tratamiento que utiliza nutrientes en dosis terapéuticas para restaurar el equilibrio bioquímico óptimo.",
-            "duracion": "60 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": True
-        },
-        {
-            "id": "homeopatia",
-            "nombre": "Medicina Homeopática",
-            "descripcion": "Sistema de medicina natural que estimula la capacidad innata del cuerpo para curarse a sí mismo.",
-            "duracion": "75 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": True
-        },
-        {
-            "id": "nutricion_tcm",
-            "nombre": "Consulta de Nutrición TCM",
-            "descripcion": "Orientación personalizada sobre el uso de principios de la Medicina Tradicional China para optimizar la salud a través de la nutrición adecuada.",
-            "duracion": "45 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": True
-        },
-        {
-            "id": "fisioterapia",
-            "nombre": "Fisioterapia",
-            "descripcion": "Ejercicios personalizados y técnicas manuales para optimizar el movimiento, reducir el dolor y mejorar la función física.",
-            "duracion": "45 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": False
-        },
-        {
-            "id": "terapia_ozono",
-            "nombre": "Terapia de Ozono en Acupuntos",
-            "descripcion": "Aplicación dirigida de ozono en puntos de acupuntura para mejorar la curación, apoyar el sistema inmunológico y aliviar el dolor.",
-            "duracion": "30 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": False
-        },
-        {
-            "id": "terapia_inyeccion",
-            "nombre": "Terapia de Inyección",
-            "descripcion": "Utilización de inyecciones especializadas para administrar sustancias naturales para el alivio dirigido del dolor y la regeneración de tejidos.",
-            "duracion": "30 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": False
-        },
-        {
-            "id": "herbal_tcm",
-            "nombre": "Consulta Herbal TCM",
-            "descripcion": "Asesoramiento experto sobre la incorporación de la Medicina Herbal China Tradicional para objetivos personalizados de salud y bienestar.",
-            "duracion": "60 minutos",
-            "precio_estimado": "Consultar",
-            "disponible_telemedicina": True
+            "institucion": "Cambridge International University",
+            "titulo": "PhD en Medicina Homeopática",
+            "pais": "USA"
         }
-    ]
-    return services
+    ],
+    "experiencia": "Dr. Zerquera lidera nuestro equipo con amplia experiencia en medicina integrativa, asegurando que todos los miembros colaboren eficazmente para apoyar sus objetivos de salud. Tiene experiencia integral en el manejo del dolor, utilizando diversas técnicas de la Medicina Oriental.",
+    "filosofia": "En ZIMI estamos comprometidos a brindar atención excepcional a nuestros pacientes. Ofrecemos una amplia gama de terapias que satisfacen todas sus necesidades. Al combinar ejercicios de fisioterapia con técnicas tradicionales de acupuntura, encontraremos una solución que funcione mejor para usted."
+}
 
 @api_router.get("/doctor-info")
-async def get_doctor_info():
-    global DOCTOR_IMAGE_DATA
-    return {
+async def get_doctor_info(request: Request):
+    # Pick up a photo uploaded through another worker
+    if await doctor_image.refresh():
+        catalog.invalidate("doctor-info")
+    return catalog.response("doctor-info", request)
+
+TEAM = [
+    {
         "nombre": "Dr. Pablo Zerquera",
         "titulo": "OMD, AP, PhD",
-        "especialidades": [
-            "Medicina Oriental y Acupuntura",
-            "Medicina Funcional",
-            "Medicina Ortomolecular", 
-            "Medicina Homeopática",
-            "Manejo del Dolor"
-        ],
-        "educacion": [
-            {
-                "institucion": "Universidad de La Habana",
-                "titulo": "Título Médico",
-                "pais": "Cuba"
-            },
-            {
-                "institucion": "AMC Miami",
-                "titulo": "Grado en Medicina Oriental y Acupuntura",
-                "pais": "Florida, USA"
-            },
-            {
-                "institucion": "Cambridge International University",
-                "titulo": "PhD en Medicina Homeopática",
-                "pais": "USA"
-            }
-        ],
-        "experiencia": "Dr. Zerquera lidera nuestro equipo con amplia experiencia en medicina integrativa, asegurando que todos los miembros colaboren eficazmente para apoyar sus objetivos de salud. Tiene experiencia integral en el manejo del dolor, utilizando diversas técnicas de la Medicina Oriental.",
-        "filosofia": "En ZIMI estamos comprometidos a brindar atención excepcional a nuestros pacientes. Ofrecemos una amplia gama de terapias que satisfacen todas sus necesidades. Al combinar ejercicios de fisioterapia con técnicas tradicionales de acupuntura, encontraremos una solución que funcione mejor para usted.",
-        "imagen": DOCTOR_IMAGE_DATA  # Use stored image data
+        "rol": "Director Médico",
+        "especialidad": "Medicina Integrativa"
+    },
+    {
+        "nombre": "Minsu Blanca",
+        "titulo": "DPT",
+        "rol": "Fisioterapeuta",
+        "especialidad": "Fisioterapia"
+    },
+    {
+        "nombre": "Felix Garcia", 
+        "titulo": "PTA",
+        "rol": "Asistente de Fisioterapia",
+        "especialidad": "Terapia Física"
     }
+]
 
 @api_router.get("/team")
-async def get_team():
-    return [
-        {
-            "nombre": "Dr. Pablo Zerquera",
-            "titulo": "OMD, AP, PhD",
-            "rol": "Director Médico",
-            "especialidad": "Medicina Integrativa"
-        },
-        {
-            "nombre": "Minsu Blanca",
-            "titulo": "DPT",
-            "rol": "Fisioterapeuta",
-            "especialidad": "Fisioterapia"
-        },
-        {
-            "nombre": "Felix Garcia", 
-            "titulo": "PTA",
-            "rol": "Asistente de Fisioterapia",
-            "especialidad": "Terapia Física"
-        }
-    ]
+async def get_team(request: Request):
+    return catalog.response("team", request)
+
+INSURANCE = {
+    "seguros_aceptados": [
+        "Ambetter",
+        "Aetna", 
+        "Careplus",
+        "Doctor Health",
+        "AvMed",
+        "Oscar"
+    ],
+    "mensaje": "Aceptamos múltiples seguros médicos. Por favor contacte nuestra oficina para verificar su cobertura específica."
+}
 
 @api_router.get("/insurance")
-async def get_insurance():
-    return {
-        "seguros_aceptados": [
-            "Ambetter",
-            "Aetna", 
-            "Careplus",
-            "Doctor Health",
-            "AvMed",
-            "Oscar"
-        ],
-        "mensaje": "Aceptamos múltiples seguros médicos. Por favor contacte nuestra oficina para verificar su cobertura específica."
+async def get_insurance(request: Request):
+    return catalog.response("insurance", request)
+
+CONTACT_INFO = {
+    "telefono": "+1 305 274 4351",
+    "whatsapp": "+1 305 274 4351",
+    "email": "drzerquera@aol.com",
+    "direccion": {
+        "calle": "7700 N Kendall Dr. Unit 807",
+        "ciudad": "Kendall",
+        "estado": "FL",
+        "codigo_postal": "33156",
+        "pais": "USA"
+    },
+    "horarios": {
+        "lunes_viernes": "9:00 AM - 6:00 PM",
+        "sabado": "9:00 AM - 2:00 PM",
+        "domingo": "Cerrado"
+    },
+    "redes_sociales": {
+        "facebook": "https://www.facebook.com/p/Zerquera-Integrative-Medical-Institute-100055086833225/",
+        "youtube": "https://www.youtube.com/@dr.pablozerquera5219"
     }
+}
 
 @api_router.get("/contact-info")
-async def get_contact_info():
-    return {
-        "telefono": "+1 305 274 4351",
-        "whatsapp": "+1 305 274 4351",
-        "email": "drzerquera@aol.com",
-        "direccion": {
-            "calle": "7700 N Kendall Dr. Unit 807",
-            "ciudad": "Kendall",
-            "estado": "FL",
-            "codigo_postal": "33156",
-            "pais": "USA"
-        },
-        "horarios": {
-            "lunes_viernes": "9:00 AM - 6:00 PM",
-            "sabado": "9:00 AM - 2:00 PM",
-            "domingo": "Cerrado"
-        },
-        "redes_sociales": {
-            "facebook": "https://www.facebook.com/p/Zerquera-Integrative-Medical-Institute-100055086833225/",
-            "youtube": "https://www.youtube.com/@dr.pablozerquera5219"
-        }
+async def get_contact_info(request: Request):
+    return catalog.response("contact-info", request)
+
+# Appointment availability: confirmed appointments indexed per assigned day as
+# start-sorted (start, end, appointment_id) intervals in minutes after midnight
+CLINIC_TIMEZONE = ZoneInfo(os.environ.get("CLINIC_TIMEZONE", "America/New_York"))
+SLOT_STEP_MINUTES = 15
+DEFAULT_SERVICE_MINUTES = 60
+MAX_AVAILABILITY_DAYS = 60
+AVAILABILITY_VERSION_CHECK_SECONDS = 2
+# CONTACT_INFO["horarios"] key for each weekday, Monday first
+WEEKDAY_HOURS = ["lunes_viernes"] * 5 + ["sabado", "domingo"]
+
+def parse_service_minutes(duracion: str) -> int:
+    """Upper bound of a "45-60 minutos" style duration"""
+    values = [int(value) for value in re.findall(r"\d+", duracion)]
+    return max(values) if values else DEFAULT_SERVICE_MINUTES
+
+def parse_clock(value: str) -> int:
+    """Minutes after midnight for "14:30" or "2:30 PM" """
+    for pattern in ("%H:%M", "%I:%M %p"):
+        try:
+            parsed = datetime.strptime(value.strip().upper(), pattern)
+        except ValueError:
+            continue
+        return parsed.hour * 60 + parsed.minute
+    raise ValueError(f"Hora no reconocida: {value}")
+
+def parse_business_hours(horario: str):
+    """(open, close) for "9:00 AM - 6:00 PM", None for "Cerrado" """
+    opening, separator, closing = horario.partition(" - ")
+    if not separator:
+        return None
+    return parse_clock(opening), parse_clock(closing)
+
+def format_clock(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+SERVICE_MINUTES = {service["id"]: parse_service_minutes(service["duracion"]) for service in SERVICES}
+# No interval is longer than this, which bounds how far back a conflict scan looks
+MAX_SERVICE_MINUTES = max([DEFAULT_SERVICE_MINUTES, *SERVICE_MINUTES.values()])
+BUSINESS_HOURS = [parse_business_hours(CONTACT_INFO["horarios"][key]) for key in WEEKDAY_HOURS]
+
+def appointment_interval(service_type: str, assigned_date: str, assigned_time: str):
+    """(day, start, end) of an assignment; ValueError when the date or time does not parse"""
+    day = date.fromisoformat(assigned_date.strip()).isoformat()
+    start = parse_clock(assigned_time)
+    return day, start, start + SERVICE_MINUTES.get(service_type, DEFAULT_SERVICE_MINUTES)
+
+def within_business_hours(day: str, start: int, end: int) -> bool:
+    hours = BUSINESS_HOURS[date.fromisoformat(day).weekday()]
+    return hours is not None and hours[0] <= start and end <= hours[1]
+
+class AvailabilityIndex:
+    """In-memory index of confirmed appointments for slot search and conflict checks.
+
+    Loaded from Mongo on startup and updated in place on confirm and cancel.
+    Writers bump a shared version stamp in db.cache_versions like the flyer
+    cache; a worker that finds another writer's bump reloads, and the confirm
+    path checks the stamp before every conflict check.
+    """
+
+    def __init__(self):
+        self.days: Dict[str, list] = {}
+        self.placements: Dict[str, tuple] = {}
+        self.version: Optional[int] = None
+        self.checked_at = 0.0
+
+    def add(self, appointment_id: str, day: str, start: int, end: int):
+        self.remove(appointment_id)
+        bisect.insort(self.days.setdefault(day, []), (start, end, appointment_id))
+        self.placements[appointment_id] = (day, start, end)
+
+    def remove(self, appointment_id: str):
+        placement = self.placements.pop(appointment_id, None)
+        if placement is None:
+            return
+        day, start, end = placement
+        intervals = self.days[day]
+        del intervals[bisect.bisect_left(intervals, (start, end, appointment_id))]
+        if not intervals:
+            del self.days[day]
+
+    def conflict(self, day: str, start: int, end: int, exclude: Optional[str] = None):
+        """First confirmed (start, end, appointment_id) overlapping [start, end), or None"""
+        intervals = self.days.get(day)
+        if not intervals:
+            return None
+        # Only intervals starting before `end` can overlap; walk back until they end too early
+        index = bisect.bisect_left(intervals, (end,))
+        while index > 0:
+            index -= 1
+            other_start, other_end, other_id = intervals[index]
+            if other_start + MAX_SERVICE_MINUTES <= start:
+                break
+            if other_end > start and other_id != exclude:
+                return intervals[index]
+        return None
+
+    def free_slots(self, day: date, duration: int, not_before: int = 0) -> List[str]:
+        hours = BUSINESS_HOURS[day.weekday()]
+        if hours is None:
+            return []
+        opening, closing = hours
+        key = day.isoformat()
+        start = opening + max(0, -(-(not_before - opening) // SLOT_STEP_MINUTES)) * SLOT_STEP_MINUTES
+        slots = []
+        while start + duration <= closing:
+            if self.conflict(key, start, start + duration) is None:
+                slots.append(format_clock(start))
+            start += SLOT_STEP_MINUTES
+        return slots
+
+    async def load(self):
+        """Replace the index with the confirmed appointments from today on"""
+        stamp = await db.cache_versions.find_one({"_id": "availability"})
+        today = datetime.now(CLINIC_TIMEZONE).date().isoformat()
+        confirmed = db.appointments.find(
+            {"status": AppointmentStatus.CONFIRMADA, "assigned_date": {"$gte": today}},
+            {"_id": False, "id": True, "service_type": True, "assigned_date": True, "assigned_time": True}
+        )
+        days, placements = {}, {}
+        async for appointment in confirmed:
+            try:
+                day, start, end = appointment_interval(
+                    appointment["service_type"], appointment["assigned_date"], appointment.get("assigned_time") or ""
+                )
+            except ValueError:
+                logger.warning(f"Appointment {appointment['id']} has an unreadable assignment, left out of availability")
+                continue
+            days.setdefault(day, []).append((start, end, appointment["id"]))
+            placements[appointment["id"]] = (day, start, end)
+        for intervals in days.values():
+            intervals.sort()
+        self.days, self.placements = days, placements
+        self.version = stamp["version"] if stamp else 0
+        self.checked_at = time.monotonic()
+
+    async def sync(self, force: bool = False):
+        if not force and time.monotonic() - self.checked_at < AVAILABILITY_VERSION_CHECK_SECONDS:
+            return
+        stamp = await db.cache_versions.find_one({"_id": "availability"})
+        if (stamp["version"] if stamp else 0) != self.version:
+            await self.load()
+        self.checked_at = time.monotonic()
+
+    async def commit(self, appointment_id: str, placement: Optional[tuple] = None):
+        """Publish a confirm (placement given) or cancel already written to Mongo"""
+        stamp = await db.cache_versions.find_one_and_update(
+            {"_id": "availability"}, {"$inc": {"version": 1}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        if self.version is None or stamp["version"] != self.version + 1:
+            # Another writer bumped the stamp too; its change is unknown here
+            await self.load()
+            return
+        if placement:
+            self.add(appointment_id, *placement)
+        else:
+            self.remove(appointment_id)
+        self.version = stamp["version"]
+        self.checked_at = time.monotonic()
+
+availability = AvailabilityIndex()
+
+# Slot claims: one db.appointment_slots document per day holding its confirmed
+# intervals. A confirmation pushes its interval with an upsert that only
+# matches the day while nothing overlaps, so on an overlap the upsert's insert
+# hits the unique _id instead; of two concurrent confirms on any workers only
+# one can win. The in-memory index stays the cheap pre-check and slot search.
+async def claim_slot(appointment_id: str, day: str, start: int, end: int) -> Optional[str]:
+    """Claim id of the interval pushed for the appointment, None when it overlaps another claim"""
+    claim_id = str(uuid.uuid4())
+    overlapping = {"start": {"$lt": end}, "end": {"$gt": start}, "appointment_id": {"$ne": appointment_id}}
+    try:
+        await db.appointment_slots.update_one(
+            {"_id": day, "intervals": {"$not": {"$elemMatch": overlapping}}},
+            {"$push": {"intervals": {"appointment_id": appointment_id, "start": start, "end": end, "claim": claim_id}}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return None
+    return claim_id
+
+async def release_slot(appointment_id: str, keep: Optional[str] = None):
+    """Drop the appointment's claims on every day, except the claim `keep`"""
+    released = {"appointment_id": appointment_id}
+    if keep:
+        released["claim"] = {"$ne": keep}
+    await db.appointment_slots.update_many({"intervals.appointment_id": appointment_id}, {"$pull": {"intervals": released}})
+
+async def release_claim(day: str, claim_id: str):
+    await db.appointment_slots.update_one({"_id": day}, {"$pull": {"intervals": {"claim": claim_id}}})
+
+async def overlapping_claim(appointment_id: str, day: str, start: int, end: int) -> Optional[dict]:
+    slots = await db.appointment_slots.find_one({"_id": day}, {"intervals": True})
+    for interval in (slots or {}).get("intervals", []):
+        if interval["start"] < end and interval["end"] > start and interval["appointment_id"] != appointment_id:
+            return interval
+    return None
+
+def slot_claim_days() -> List[dict]:
+    """The db.appointment_slots documents matching the loaded index"""
+    return [
+        {"_id": day, "intervals": [
+            {"appointment_id": appointment_id, "start": start, "end": end, "claim": str(uuid.uuid4())}
+            for start, end, appointment_id in intervals
+        ]} for day, intervals in availability.days.items()
+    ]
+
+async def seed_slot_claims():
+    """Fill db.appointment_slots from the loaded index the first time it is empty"""
+    if await db.appointment_slots.find_one({}, {"_id": True}):
+        return
+    days = slot_claim_days()
+    if not days:
+        return
+    try:
+        await db.appointment_slots.insert_many(days, ordered=False)
+    except BulkWriteError:
+        # Another worker seeded the same days first
+        pass
+    logger.info(f"Seeded slot claims for {len(days)} days")
+
+def overlap_detail(start: int, end: int) -> str:
+    return f"El horario se superpone con otra cita confirmada ({format_clock(start)} - {format_clock(end)})"
+
+async def sync_availability(handler: str) -> bool:
+    """Sync the index, or report it stale when MongoDB misses the deadline; confirmations always force a sync"""
+    try:
+        await availability.sync()
+    except PyMongoError as e:
+        if not e.timeout:
+            raise
+        DEADLINE_EXCEEDED.inc(handler, "stale")
+        return True
+    return False
+
+@api_router.get("/appointments/availability")
+async def get_availability(service_type: ServiceType, days: int = Query(14, ge=1, le=MAX_AVAILABILITY_DAYS)):
+    """Free start times for a service over the next `days` days, in clinic local time"""
+    stale = await sync_availability("get_availability")
+    duration = SERVICE_MINUTES.get(service_type.value, DEFAULT_SERVICE_MINUTES)
+    now = datetime.now(CLINIC_TIMEZONE)
+    schedule = []
+    for offset in range(days):
+        day = now.date() + timedelta(days=offset)
+        if BUSINESS_HOURS[day.weekday()] is None:
+            continue
+        not_before = now.hour * 60 + now.minute if offset == 0 else 0
+        schedule.append({"date": day.isoformat(), "slots": availability.free_slots(day, duration, not_before)})
+    result = {"service_type": service_type, "duration_minutes": duration, "days": schedule}
+    if stale:
+        result["stale"] = True
+    return result
+
+@api_router.get("/appointments/availability/check")
+async def check_availability(
+    service_type: ServiceType,
+    assigned_date: str,
+    assigned_time: str,
+    appointment_id: Optional[str] = None
+):
+    """Whether an assignment overlaps a confirmed appointment; appointment_id excludes its own slot"""
+    try:
+        day, start, end = appointment_interval(service_type.value, assigned_date, assigned_time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha u hora asignada inválida")
+    stale = await sync_availability("check_availability")
+    conflict = availability.conflict(day, start, end, exclude=appointment_id)
+    result = {
+        "available": conflict is None,
+        "within_business_hours": within_business_hours(day, start, end),
+        "conflict": {
+            "appointment_id": conflict[2], "assigned_date": day,
+            "start_time": format_clock(conflict[0]), "end_time": format_clock(conflict[1])
+        } if conflict else None
     }
+    if stale:
+        result["stale"] = True
+    return result
 
 @api_router.post("/appointments", response_model=Appointment)
 async def create_appointment(appointment_data: AppointmentCreate):
     # Create patient ID for tracking
     patient_id = str(uuid.uuid4())
     
-    appointment_dict = appointment_data.dict()
+    appointment_dict = appointment_data.model_dump()
     appointment_dict["patient_id"] = patient_id
     
     appointment_obj = Appointment(**appointment_dict)
     
-    # Save to database
-    await db.appointments.insert_one(appointment_obj.dict())
-    
-    # Trigger admin notification
-    try:
-        # This would send real-time notification to admin
-        logger.info(f"New appointment created: {appointment_obj.id} for patient {appointment_obj.patient_name}")
-        
-        # In production, you could send email, SMS, or push notification here
-        # await send_admin_notification(appointment_obj)
-        
-    except Exception as e:
-        logger.error(f"Failed to send admin notification: {e}")
+    # Save to database; directory entry and admin notification follow in the job queue
+    await db.appointments.insert_one(appointment_obj.model_dump())
+    await job_queue.enqueue("new_appointment_notification", {"appointment": appointment_obj.model_dump(mode="json")})
     
     return appointment_obj
 
-@api_router.get("/appointments", response_model=List[Appointment])
-async def get_appointments():
-    appointments = await db.appointments.find().sort("created_at", -1).to_list(100)
-    return [Appointment(**appointment) for appointment in appointments]
+@job_queue.handler("new_appointment_notification")
+async def notify_admin_of_appointment(payload: dict):
+    appointment = payload.get("appointment")
+    if appointment is None:
+        appointment = await db.appointments.find_one({"id": payload["appointment_id"]}, APPOINTMENT_SHAPE.projection)
+        if appointment is None:
+            logger.warning(f"Appointment {payload['appointment_id']} not found, notification dropped")
+            return
+        appointment = jsonable_encoder(appointment)
+    created_at = datetime.fromisoformat(appointment["created_at"])
+    await asyncio.gather(
+        upsert_directory_entry(appointment["patient_id"], appointment["patient_name"], appointment["patient_email"], created_at),
+        message_events.publish(["admin"], "appointment", appointment)
+    )
+    # In production, you could send email, SMS, or push notification here
+    logger.info(f"New appointment created: {appointment['id']} for patient {appointment['patient_name']}")
+
+@api_router.get("/appointments", response_model=AppointmentPage, dependencies=ADMIN_ACCESS)
+@degrades_to(EMPTY_PAGE)
+async def get_appointments(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None
+):
+    appointments, next_cursor = await fetch_page(
+        db.appointments, after_cursor(after), limit, projection=APPOINTMENT_SHAPE.projection
+    )
+    return page_response([APPOINTMENT_SHAPE.complete(appointment) for appointment in appointments], next_cursor)
 
-@api_router.put("/appointments/{appointment_id}/confirm")
+@api_router.put("/appointments/{appointment_id}/confirm", dependencies=ADMIN_ACCESS)
 async def confirm_appointment(appointment_id: str, confirmation_data: AppointmentConfirmation):
-    # First, get the appointment details
-    appointment = await db.appointments.find_one({"id": appointment_id})
-    if not appointment:
+    # Pre-check the slot against the other workers' latest confirmations; the claim below decides
+    current, _ = await asyncio.gather(
+        db.appointments.find_one({"id": appointment_id}, {"_id": False, "service_type": True, "status": True}),
+        availability.sync(force=True)
+    )
+    
+    if current is None:
         raise HTTPException(status_code=404, detail="Cita no encontrada")
     
+    try:
+        placement = appointment_interval(current["service_type"], confirmation_data.assigned_date, confirmation_data.assigned_time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Fecha u hora asignada inválida")
+    # Stored as YYYY-MM-DD and HH:MM so the startup load can range-scan assigned_date
+    confirmation_data.assigned_date = placement[0]
+    confirmation_data.assigned_time = format_clock(placement[1])
+    
+    conflict = availability.conflict(*placement, exclude=appointment_id)
+    if conflict:
+        raise HTTPException(status_code=409, detail=overlap_detail(conflict[0], conflict[1]))
+    claim_id = await claim_slot(appointment_id, *placement)
+    if claim_id is None:
+        # A concurrent confirmation took the slot after the pre-check
+        claimed = await overlapping_claim(appointment_id, *placement)
+        raise HTTPException(
+            status_code=409,
+            detail=overlap_detail(claimed["start"], claimed["end"]) if claimed else "El horario se superpone con otra cita confirmada"
+        )
+    
     update_data = {
         "status": AppointmentStatus.CONFIRMADA,
         "confirmed_at": datetime.utcnow(),
@@ -842,36 +3382,104 @@ async def confirm_appointment(appointment_id: str, confirmation_data: Appointmen
     if confirmation_data.doctor_notes:
         update_data["doctor_notes"] = confirmation_data.doctor_notes
     
+    # Update and read back the details the confirmation message needs in one round trip
+    try:
+        appointment = await db.appointments.find_one_and_update(
+            {"id": appointment_id},
+            {"$set": update_data},
+            projection={"_id": False, "patient_id": True, "patient_name": True, "service_type": True, "appointment_type": True},
+            return_document=ReturnDocument.AFTER
+        )
+    except Exception:
+        # Give the new claim back, or it blocks the slot for good; the previous slot stays held
+        try:
+            await release_claim(placement[0], claim_id)
+        except PyMongoError as e:
+            logger.error(f"Could not release claim {claim_id} of appointment {appointment_id}: {e}")
+        raise
+    
+    if appointment is None:
+        await release_slot(appointment_id)
+        raise HTTPException(status_code=404, detail="Cita no encontrada")
+    
+    # The confirmation message and its fan-out run in the background job queue
+    await asyncio.gather(
+        job_queue.enqueue("appointment_confirmation_message", {
+            "message_id": str(uuid.uuid4()),
+            "appointment": appointment,
+            "confirmation": confirmation_data.model_dump()
+        }),
+        availability.commit(appointment_id, placement),
+        # A rescheduled confirmation gives up its previous slot
+        *([release_slot(appointment_id, keep=claim_id)] if current.get("status") == AppointmentStatus.CONFIRMADA else [])
+    )
+    
+    return {
+        "message": "Cita confirmada exitosamente", 
+        "patient_notified": True,
+        "appointment_details": {
+            "patient_name": appointment["patient_name"],
+            "service_type": appointment["service_type"],
+            "appointment_type": appointment["appointment_type"],
+            "assigned_date": confirmation_data.assigned_date,
+            "assigned_time": confirmation_data.assigned_time,
+            "telemedicine_link": confirmation_data.telemedicine_link if confirmation_data.telemedicine_link else None,
+            "doctor_notes": confirmation_data.doctor_notes if confirmation_data.doctor_notes else None
+        }
+    }
+
+@api_router.put("/appointments/{appointment_id}/cancel", dependencies=ADMIN_SESSION_ACCESS)
+async def cancel_appointment(appointment_id: str):
     result = await db.appointments.update_one(
         {"id": appointment_id},
-        {"$set": update_data}
+        {"$set": {"status": AppointmentStatus.CANCELADA, "cancelled_at": datetime.utcnow()}}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Cita no encontrada")
     
-    # Send confirmation message to patient
-    try:
-        confirmation_message = {
-            "id": str(uuid.uuid4()),
-            "sender_id": "admin",
-            "sender_name": "Dr. Zerquera",
-            "receiver_id": appointment["patient_id"],
-            "receiver_name": appointment["patient_name"],
-            "subject": "✅ Cita Confirmada - Dr. Zerquera",
-            "message": f"""¡Excelente noticia! Su cita ha sido confirmada.
+    # Frees the slot for new confirmations
+    await asyncio.gather(release_slot(appointment_id), availability.commit(appointment_id))
+    return {"message": "Cita cancelada exitosamente"}
+
+@api_router.post("/admin/appointments/slots/rebuild", dependencies=ADMIN_SESSION_ACCESS)
+async def rebuild_slot_claims():
+    """Recompute the slot claims from the confirmed appointments.
+
+    Run it when confirmations answer 409 for a slot the availability shows free.
+    """
+    await availability.load()
+    days = slot_claim_days()
+    if days:
+        await db.appointment_slots.bulk_write([ReplaceOne({"_id": day["_id"]}, day, upsert=True) for day in days], ordered=False)
+    await db.appointment_slots.delete_many({"_id": {"$nin": [day["_id"] for day in days]}})
+    return {"message": "Horarios confirmados reconstruidos", "days": len(days)}
+
+@job_queue.handler("appointment_confirmation_message")
+async def send_confirmation_message(payload: dict):
+    appointment = payload["appointment"]
+    confirmation = AppointmentConfirmation(**payload["confirmation"])
+    confirmation_message = {
+        "id": payload["message_id"],
+        "thread_id": payload["message_id"],
+        "sender_id": "admin",
+        "sender_name": "Dr. Zerquera",
+        "receiver_id": appointment["patient_id"],
+        "receiver_name": appointment["patient_name"],
+        "subject": "✅ Cita Confirmada - Dr. Zerquera",
+        "message": f"""¡Excelente noticia! Su cita ha sido confirmada.
 
 📅 **DETALLES DE SU CITA CONFIRMADA:**
 
 👤 **Paciente:** {appointment["patient_name"]}
 🩺 **Servicio:** {appointment["service_type"].replace('_', ' ').title()}
 📍 **Modalidad:** {'💻 Telemedicina' if appointment["appointment_type"] == 'telemedicina' else '🏥 Consulta Presencial'}
-📅 **Fecha Asignada:** {confirmation_data.assigned_date}
-🕐 **Hora Asignada:** {confirmation_data.assigned_time}
+📅 **Fecha Asignada:** {confirmation.assigned_date}
+🕐 **Hora Asignada:** {confirmation.assigned_time}
 
-{f'🔗 **Link de Telemedicina:** {confirmation_data.telemedicine_link}' if confirmation_data.telemedicine_link else ''}
+{f'🔗 **Link de Telemedicina:** {confirmation.telemedicine_link}' if confirmation.telemedicine_link else ''}
 
-{f'📝 **Notas del Doctor:** {confirmation_data.doctor_notes}' if confirmation_data.doctor_notes else ''}
+{f'📝 **Notas del Doctor:** {confirmation.doctor_notes}' if confirmation.doctor_notes else ''}
 
 📞 **Información de Contacto:**
 - Teléfono: +1 305 274 4351
@@ -879,78 +3487,181 @@ async def confirm_appointment(appointment_id: str, confirmation_data: Appointmen
 
 ⚠️ **IMPORTANTE:**
 - Llegue 10 minutos antes de su cita
-{f'- Para telemedicina, haga clic en el link 5 minutos antes' if confirmation_data.telemedicine_link else '- Traiga documento de identidad'}
+{f'- Para telemedicina, haga clic en el link 5 minutos antes' if confirmation.telemedicine_link else '- Traiga documento de identidad'}
 - Si necesita cancelar, contáctenos con 24 horas de anticipación
 
 ¡Esperamos verle pronto!
 
 Dr. Pablo Zerquera, OMD, AP
 Instituto de Medicina Integrativa""",
-            "message_type": "appointment_confirmation",
-            "is_read": False,
-            "created_at": datetime.utcnow()
-        }
-        
-        await db.messages.insert_one(confirmation_message)
-        print(f"✅ Confirmation message sent to patient {appointment['patient_name']}")
-        
-    except Exception as e:
-        print(f"❌ Error sending confirmation message: {str(e)}")
-        # Don't fail the confirmation if message sending fails
-    
-    return {
-        "message": "Cita confirmada exitosamente", 
-        "patient_notified": True,
-        "appointment_details": {
-            "patient_name": appointment["patient_name"],
-            "service_type": appointment["service_type"],
-            "appointment_type": appointment["appointment_type"],
-            "assigned_date": confirmation_data.assigned_date,
-            "assigned_time": confirmation_data.assigned_time,
-            "telemedicine_link": confirmation_data.telemedicine_link if confirmation_data.telemedicine_link else None,
-            "doctor_notes": confirmation_data.doctor_notes if confirmation_data.doctor_notes else None
-        }
+        "message_type": "appointment_confirmation",
+        "is_read": False,
+        "created_at": datetime.utcnow()
     }
+    
+    # The message id is fixed at enqueue time, so a retry after the insert landed does not send it twice,
+    # and each fan-out step runs at most once, picking up only the ones an earlier attempt never reached
+    try:
+        await db.messages.insert_one(confirmation_message)
+    except DuplicateKeyError:
+        pass
+    await fan_out_new_message(confirmation_message, once=True)
+    logger.info(f"Confirmation message sent to patient {appointment['patient_name']}")
 
 @api_router.post("/contact", response_model=Contact)
 async def create_contact(contact_data: ContactCreate):
-    contact_obj = Contact(**contact_data.dict())
-    await db.contacts.insert_one(contact_obj.dict())
+    contact_obj = Contact(**contact_data.model_dump())
+    await db.contacts.insert_one(contact_obj.model_dump())
     return contact_obj
 
+# Admin exports, streamed from the cursor in chunks so a full quarter is never held in memory
+EXPORT_MODELS = {"appointments": Appointment, "messages": Message, "contacts": Contact}
+EXPORT_CHUNK_DOCUMENTS = 500
+
+def export_cell(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    return str(value)
+
+async def export_chunks(cursor, fields: List[str], export_format: str):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    chunk, count = [], 0
+    if export_format == "csv":
+        # The BOM lets Excel detect UTF-8 and keep accented names intact
+        chunk.append("\ufeff".encode("utf-8"))
+        writer.writerow(fields)
+    async for document in cursor:
+        if export_format == "csv":
+            writer.writerow([export_cell(document.get(field)) for field in fields])
+        else:
+            chunk.append(orjson.dumps(document, default=jsonable_encoder) + b"\n")
+        count += 1
+        if count % EXPORT_CHUNK_DOCUMENTS == 0:
+            chunk.append(buffer.getvalue().encode("utf-8"))
+            buffer.seek(0)
+            buffer.truncate()
+            yield b"".join(chunk)
+            chunk = []
+    chunk.append(buffer.getvalue().encode("utf-8"))
+    yield b"".join(chunk)
+
+@api_router.get("/admin/export/{collection_name}", dependencies=ADMIN_SESSION_ACCESS)
+async def export_collection(
+    collection_name: str,
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    status: Optional[AppointmentStatus] = None,
+    fields: Optional[str] = None
+):
+    """Stream appointments, messages or contacts created in [date_from, date_to) as NDJSON or CSV"""
+    model = EXPORT_MODELS.get(collection_name)
+    if model is None:
+        raise HTTPException(status_code=404, detail="Colección no exportable")
+
+    selected = [field.strip() for field in fields.split(",") if field.strip()] if fields else list(model.model_fields)
+    unknown = [field for field in selected if field not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Campos desconocidos: {', '.join(unknown)}")
+
+    query = {}
+    if date_from or date_to:
+        query["created_at"] = {}
+        if date_from:
+            query["created_at"]["$gte"] = date_from
+        if date_to:
+            query["created_at"]["$lt"] = date_to
+    if status:
+        if "status" not in model.model_fields:
+            raise HTTPException(status_code=400, detail="El filtro de estado solo aplica a las citas")
+        query["status"] = status.value
+
+    cursor = db[collection_name].find(
+        query, {"_id": False, **{field: True for field in selected}}, batch_size=EXPORT_CHUNK_DOCUMENTS
+    ).sort("created_at", ASCENDING)
+    filename = f"{collection_name}-{datetime.utcnow().strftime('%Y%m%d')}.{export_format}"
+    return StreamingResponse(
+        export_chunks(cursor, selected, export_format),
+        media_type="text/csv; charset=utf-8" if export_format == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+TESTIMONIALS = [
+    {
+        "nombre": "Natalie G",
+        "rol": "Paciente",
+        "testimonio": "He sido paciente del Dr. Zerquera durante varios años. Es extremadamente conocedor y meticuloso. Bajo su cuidado holístico, mi túnel carpiano y dolor de hombro está completamente curado. Continuaré recomendándolo a familiares y amigos.",
+        "rating": 5
+    },
+    {
+        "nombre": "Betti",
+        "rol": "Paciente", 
+        "testimonio": "Estoy muy feliz desde que comencé la terapia con el Dr. Zerquera. La acupuntura es una medicina natural fantástica, excelente trabajo del doctor. Es una persona muy profesional, y el ambiente se siente como familia. Me siento muy agradecida porque he tenido muy buenos resultados.",
+        "rating": 5
+    },
+    {
+        "nombre": "Mariela Carvajal",
+        "rol": "Paciente",
+        "testimonio": "Estoy emocionada con la terapia de ozono del Dr. Zerquera. Su experiencia y enfoque cariñoso han llevado a excelentes resultados. ¡Altamente recomendado!",
+        "rating": 5
+    }
+]
+
 @api_router.get("/testimonials")
-async def get_testimonials():
-    return [
-        {
-            "nombre": "Natalie G",
-            "rol": "Paciente",
-            "testimonio": "He sido paciente del Dr. Zerquera durante varios años. Es extremadamente conocedor y meticuloso. Bajo su cuidado holístico, mi túnel carpiano y dolor de hombro está completamente curado. Continuaré recomendándolo a familiares y amigos.",
-            "rating": 5
-        },
-        {
-            "nombre": "Betti",
-            "rol": "Paciente", 
-            "testimonio": "Estoy muy feliz desde que comencé la terapia con el Dr. Zerquera. La acupuntura es una medicina natural fantástica, excelente trabajo del doctor. Es una persona muy profesional, y el ambiente se siente como familia. Me siento muy agradecida porque he tenido muy buenos resultados.",
-            "rating": 5
-        },
-        {
-            "nombre": "Mariela Carvajal",
-            "rol": "Paciente",
-            "testimonio": "Estoy emocionada con la terapia de ozono del Dr. Zerquera. Su experiencia y enfoque cariñoso han llevado a excelentes resultados. ¡Altamente recomendado!",
-            "rating": 5
-        }
-    ]
+async def get_testimonials(request: Request):
+    return catalog.response("testimonials", request)
+
+catalog.register("services", lambda: SERVICES)
+catalog.register("doctor-info", lambda: {**DOCTOR_INFO, "imagen": doctor_image.url()})
+catalog.register("team", lambda: TEAM)
+catalog.register("insurance", lambda: INSURANCE)
+catalog.register("contact-info", lambda: CONTACT_INFO)
+catalog.register("testimonials", lambda: TESTIMONIALS)
+
+@api_router.post("/admin/catalog/invalidate", dependencies=ADMIN_SESSION_ACCESS)
+async def invalidate_catalog(name: Optional[str] = None):
+    """Rebuild cached catalog responses after their content changes"""
+    if name and name not in catalog.builders:
+        raise HTTPException(status_code=404, detail="Catálogo no encontrado")
+    catalog.invalidate(name)
+    return {"message": "Catálogo actualizado", "entries": {entry: catalog.entries[entry][1] for entry in catalog.entries}}
+
+@api_router.get("/metrics")
+async def get_metrics():
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # Include the router in the main app
 app.include_router(api_router)
 
+@app.exception_handler(PyMongoError)
+async def database_error(request: Request, exc: PyMongoError):
+    """Deadline misses without a degraded response answer 503; any other database error stays a 500"""
+    if not exc.timeout:
+        raise exc
+    endpoint = request.scope.get("endpoint")
+    DEADLINE_EXCEEDED.inc(getattr(endpoint, "__name__", "unknown"), "unavailable")
+    return ORJSONResponse(
+        {"detail": "La base de datos no respondió a tiempo, intente de nuevo"}, status_code=503, headers={"Retry-After": "1"}
+    )
+
+rate_limit_redis_url = os.environ.get("RATE_LIMIT_REDIS_URL")
+app.add_middleware(ReadConsistency)
+app.add_middleware(AdmissionControl)
+app.add_middleware(RateLimit, store=RedisBucketStore(rate_limit_redis_url) if rate_limit_redis_url else None)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[READ_AFTER_HEADER],
 )
+app.add_middleware(RequestMetrics)
 
 # Configure logging
 logging.basicConfig(
@@ -959,6 +3670,84 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def connect_mongo():
+    """Open the client and warm the minimum pool so the first requests after a deploy skip the handshakes"""
+    global client, db, replica_db, mongo_options
+    mongo_options = mongo_client_options(mongo_url)
+    client = AsyncIOMotorClient(mongo_url, event_listeners=[CommandMetrics(), PoolMetrics()], **mongo_options)
+    db = client[os.environ['DB_NAME']]
+    replica_db = db.with_options(read_preference=LISTING_READ_PREFERENCE)
+    # Concurrent pings each check out a connection, opening up to minPoolSize of them;
+    # pymongo's pool maintenance tops up the rest in the background
+    try:
+        await asyncio.gather(*(client.admin.command("ping") for _ in range(max(client.options.pool_options.min_pool_size, 1))))
+    except PyMongoError as e:
+        # Every later startup hook needs the server too, so fail here with the reason
+        logger.error(f"MongoDB is not reachable, refusing to start: {e}")
+        raise
+    opened = sum(MONGO_CONNECTIONS.snapshot().values())
+    logger.info(f"MongoDB pool ready with {opened} connections, compressors {mongo_options['compressors']}")
+
+@app.on_event("startup")
+async def ensure_indexes():
+    """Create the indexes in COLLECTION_INDEXES and log any that could not be built"""
+    for collection_name, indexes in COLLECTION_INDEXES.items():
+        failed = []
+        for index in indexes:
+            try:
+                await db[collection_name].create_indexes([index])
+            except OperationFailure as e:
+                # Typically duplicate data blocking a unique index; the audit endpoint keeps reporting it
+                logger.error(f"Could not create index {index.document['name']} on {collection_name}: {e}")
+                failed.append(index.document["name"])
+
+        if not failed:
+            logger.info(f"Indexes ready on {collection_name}")
+
+@app.on_event("startup")
+async def seed_unread_counters():
+    # Messages stored before the counters existed would otherwise count as read
+    if await claim_migration("unread_counters"):
+        logger.info(f"Unread counters built, {await rebuild_unread_counts()} users with unread messages")
+
+@app.on_event("startup")
+async def seed_patient_directory():
+    # Patients registered before the directory existed, and entries without name_tokens
+    if await claim_migration("patient_directory"):
+        logger.info(f"Patient directory built with {await rebuild_directory()} patients")
+
+@app.on_event("startup")
+async def build_catalog():
+    await doctor_image.seed(DEFAULT_DOCTOR_IMAGE_DATA)
+    catalog.build_all()
+
+@app.on_event("startup")
+async def start_sessions():
+    await session_keys.load()
+    revocations.start()
+
+@app.on_event("startup")
+async def load_availability():
+    await availability.load()
+    await seed_slot_claims()
+
+@app.on_event("startup")
+async def start_message_events():
+    message_events.start()
+
+@app.on_event("startup")
+async def start_job_queue():
+    job_queue.start()
+
+@app.on_event("startup")
+async def start_event_loop_sampler():
+    app.state.event_loop_sampler = asyncio.create_task(sample_event_loop_lag())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    app.state.event_loop_sampler.cancel()
+    await job_queue.stop()
+    await revocations.stop()
+    await message_events.stop()
     client.close()
\ No newline at end of file
@@ -7,7 +7,10 @@ Tests all core API endpoints, CORS configuration, environment variables, and dat
 import requests
 import json
 import os
+import random
+import re
 import sys
+import time
 from datetime import datetime
 import uuid
 
@@ -30,6 +33,37 @@ if not BACKEND_URL:
 API_BASE = f"{BACKEND_URL}/api"
 print(f"Testing backend API at: {API_BASE}")
 
+def mongo_command_counts():
+    """Commands sent to MongoDB so far, by (collection, command), from the metrics endpoint"""
+    response = requests.get(f"{API_BASE}/metrics", timeout=10)
+    counts = {}
+    for line in response.text.splitlines():
+        if line.startswith("mongodb_command_duration_seconds_count{"):
+            labels, value = line.rsplit(" ", 1)
+            collection = re.search(r'collection="([^"]*)"', labels).group(1)
+            command = re.search(r'command="([^"]*)"', labels).group(1)
+            counts[(collection, command)] = float(value)
+    return counts
+
+# Issued by the event relay and the job workers on their own schedule, never by a request
+BACKGROUND_COMMANDS = {"message_events.find", "message_events.getMore", "jobs.findAndModify", "jobs.delete", "revoked_sessions.find"}
+
+def round_trips_since(before, background=()):
+    """Commands issued since the snapshot, leaving out background work"""
+    after = mongo_command_counts()
+    trips = {
+        f"{collection}.{command}": int(count - before.get((collection, command), 0))
+        for (collection, command), count in after.items()
+        if count != before.get((collection, command), 0)
+    }
+    return {key: count for key, count in trips.items() if key not in BACKGROUND_COMMANDS and key not in background}
+
+def free_slot(service_type):
+    """A random free (date, time) for the service, so repeated runs do not book the same slot"""
+    response = requests.get(f"{API_BASE}/appointments/availability",
+                            params={"service_type": service_type, "days": 60}, timeout=10)
+    return random.choice([(day["date"], slot) for day in response.json()["days"] for slot in day["slots"]])
+
 class BackendTester:
     def __init__(self):
         self.test_results = []
@@ -154,7 +188,7 @@ class BackendTester:
         try:
             response = requests.get(f"{API_BASE}/appointments", timeout=10)
             if response.status_code == 200:
-                appointments = response.json()
+                appointments = response.json()["items"]
                 if isinstance(appointments, list):
                     self.log_test("Get Appointments", True, f"Retrieved {len(appointments)} appointments")
                 else:
@@ -172,9 +206,10 @@ class BackendTester:
             
         try:
             # Test appointment confirmation with all fields
+            assigned_date, assigned_time = free_slot("acupuntura")
             confirmation_data = {
-                "assigned_date": "2025-01-25",
-                "assigned_time": "14:30",
+                "assigned_date": assigned_date,
+                "assigned_time": assigned_time,
                 "telemedicine_link": "https://meet.google.com/abc-defg-hij",
                 "doctor_notes": "Por favor traiga sus estudios médicos previos. Llegue 10 minutos antes."
             }
@@ -216,7 +251,7 @@ class BackendTester:
             # Get the confirmed appointment to verify new fields
             response = requests.get(f"{API_BASE}/appointments", timeout=10)
             if response.status_code == 200:
-                appointments = response.json()
+                appointments = response.json()["items"]
                 confirmed_appointment = None
                 
                 for appointment in appointments:
@@ -332,6 +367,52 @@ class BackendTester:
         except Exception as e:
             self.log_test("Admin Login", False, error=e)
 
+    def test_session_tokens(self):
+        """Bearer tokens from login open the patient's own data only, refresh, and stop working after logout"""
+        try:
+            if not self.patient_email:
+                self.log_test("Session Tokens", False, "No patient credentials available for testing")
+                return
+            login = requests.post(f"{API_BASE}/auth/login",
+                                  params={"email": self.patient_email, "phone": self.patient_phone}, timeout=10).json()
+            patient_id = login["patient_id"]
+            headers = {"Authorization": f"Bearer {login['access_token']}"}
+
+            own = requests.get(f"{API_BASE}/patient/{patient_id}/profile", headers=headers, timeout=10)
+            other = requests.get(f"{API_BASE}/patient/{uuid.uuid4()}/profile", headers=headers, timeout=10)
+            admin_only = requests.get(f"{API_BASE}/admin/jobs", headers=headers, timeout=10)
+            # EventSource cannot send headers, so the stream takes the token as a query parameter
+            other_stream = requests.get(f"{API_BASE}/messages/stream/{uuid.uuid4()}",
+                                        params={"token": login["access_token"]}, timeout=10)
+            self.log_test("Session Tokens - patient scope",
+                          own.status_code == 200 and other.status_code == 403 and admin_only.status_code == 403
+                          and other_stream.status_code == 403,
+                          f"own {own.status_code}, other patient {other.status_code}, admin route {admin_only.status_code}, "
+                          f"other stream {other_stream.status_code}")
+
+            # Bulk exports and the other admin tools never fall under the anonymous rollout
+            anonymous_export = requests.get(f"{API_BASE}/admin/export/contacts", timeout=10)
+            anonymous_jobs = requests.get(f"{API_BASE}/admin/jobs", timeout=10)
+            patient_export = requests.get(f"{API_BASE}/admin/export/contacts", headers=headers, timeout=10)
+            self.log_test("Session Tokens - admin tools need admin",
+                          anonymous_export.status_code == 401 and patient_export.status_code == 403
+                          and anonymous_jobs.status_code == 401,
+                          f"anonymous export {anonymous_export.status_code}, patient export {patient_export.status_code}, "
+                          f"anonymous jobs {anonymous_jobs.status_code}")
+
+            refreshed = requests.post(f"{API_BASE}/auth/refresh", json={"refresh_token": login["refresh_token"]}, timeout=10)
+            self.log_test("Session Tokens - refresh", refreshed.status_code == 200 and refreshed.json().get("access_token"),
+                          f"Status: {refreshed.status_code}")
+
+            requests.post(f"{API_BASE}/auth/logout", headers=headers, timeout=10)
+            after = requests.get(f"{API_BASE}/patient/{patient_id}/profile",
+                                 headers={"Authorization": f"Bearer {refreshed.json()['access_token']}"}, timeout=10)
+            refresh_after = requests.post(f"{API_BASE}/auth/refresh", json={"refresh_token": login["refresh_token"]}, timeout=10)
+            self.log_test("Session Tokens - logout", after.status_code == 401 and refresh_after.status_code == 401,
+                          f"access {after.status_code}, refresh {refresh_after.status_code}")
+        except Exception as e:
+            self.log_test("Session Tokens", False, error=e)
+
     def test_message_system(self):
         """Test message system endpoints"""
         if not self.patient_id:
@@ -364,7 +445,7 @@ class BackendTester:
                 # Test getting messages
                 response = requests.get(f"{API_BASE}/messages/{self.patient_id}", timeout=10)
                 if response.status_code == 200:
-                    messages = response.json()
+                    messages = response.json()["items"]
                     self.log_test("Get Messages", True, f"Retrieved {len(messages)} messages")
                 else:
                     self.log_test("Get Messages", False, f"Status: {response.status_code}")
@@ -374,6 +455,27 @@ class BackendTester:
         except Exception as e:
             self.log_test("Message System", False, error=e)
 
+    def test_read_your_writes(self):
+        """A sent message shows up in the sender's inbox and unread counts read back with X-Read-After"""
+        if not self.patient_id:
+            self.log_test("Read Your Writes", False, "No patient ID available for testing")
+            return
+        try:
+            response = requests.post(f"{API_BASE}/messages", json={
+                "receiver_id": "admin", "receiver_name": "Dr. Zerquera",
+                "subject": "Lectura tras escritura", "message": "Prueba de consistencia de lectura"
+            }, params={"sender_id": self.patient_id, "sender_name": "Carlos Mendez"}, timeout=10)
+            message_id = response.json()["id"]
+            # Standalone servers report no cluster time, so the header is only there on replica sets
+            read_after = response.headers.get("X-Read-After")
+            headers = {"X-Read-After": read_after} if read_after else {}
+            inbox = requests.get(f"{API_BASE}/messages/{self.patient_id}", headers=headers, timeout=10).json()["items"]
+            unread = requests.get(f"{API_BASE}/messages/unread/admin", headers=headers, timeout=10)
+            self.log_test("Read Your Writes", any(item["id"] == message_id for item in inbox) and unread.status_code == 200,
+                          f"X-Read-After {read_after or 'not sent (standalone)'}, unread {unread.json().get('unread_count')}")
+        except Exception as e:
+            self.log_test("Read Your Writes", False, error=e)
+
     def test_admin_message_polling(self):
         """Test GET /api/admin/messages/poll endpoint"""
         try:
@@ -494,7 +596,7 @@ class BackendTester:
             response = requests.get(f"{API_BASE}/messages/{self.patient_id}", timeout=10)
             initial_message_count = 0
             if response.status_code == 200:
-                initial_message_count = len(response.json())
+                initial_message_count = len(response.json()["items"])
             
             # Create a new appointment to confirm (since we already confirmed the first one)
             appointment_data = {
@@ -518,9 +620,10 @@ class BackendTester:
                 new_patient_id = new_appointment.get("patient_id")
                 
                 # Confirm the new appointment
+                assigned_date, assigned_time = free_slot("medicina_funcional")
                 confirmation_data = {
-                    "assigned_date": "2025-01-28",
-                    "assigned_time": "16:00",
+                    "assigned_date": assigned_date,
+                    "assigned_time": assigned_time,
                     "telemedicine_link": "https://zoom.us/j/123456789",
                     "doctor_notes": "Consulta de medicina funcional. Prepare lista de síntomas actuales."
                 }
@@ -530,10 +633,13 @@ class BackendTester:
                                               timeout=10)
                 
                 if confirm_response.status_code == 200:
+                    # The confirmation message is written by the background job queue
+                    time.sleep(2)
+                    
                     # Check if patient received confirmation message
                     response = requests.get(f"{API_BASE}/messages/{new_patient_id}", timeout=10)
                     if response.status_code == 200:
-                        messages = response.json()
+                        messages = response.json()["items"]
                         
                         # Look for confirmation message
                         confirmation_message = None
@@ -582,13 +688,45 @@ class BackendTester:
         except Exception as e:
             self.log_test("Confirmation Messages", False, error=e)
 
+    def test_slot_conflicts(self):
+        """Overlapping confirmations are rejected until the first appointment is cancelled"""
+        try:
+            ids = []
+            for service_type in ("acupuntura", "terapia_ozono"):
+                response = requests.post(f"{API_BASE}/appointments", json={
+                    "patient_name": "Horario Prueba", "patient_email": "horario@example.com", "patient_phone": "3055550142",
+                    "service_type": service_type, "appointment_type": "presencial",
+                    "fecha_solicitada": "2025-09-15", "hora_solicitada": "10:00"
+                }, timeout=10)
+                ids.append(response.json()["id"])
+
+            assigned_date, assigned_time = free_slot("acupuntura")
+            slot = {"assigned_date": assigned_date, "assigned_time": assigned_time}
+            first = requests.put(f"{API_BASE}/appointments/{ids[0]}/confirm", json=slot, timeout=10)
+            overlapping = requests.put(f"{API_BASE}/appointments/{ids[1]}/confirm", json=slot, timeout=10)
+            check = requests.get(f"{API_BASE}/appointments/availability/check",
+                                 params={"service_type": "terapia_ozono", **slot}, timeout=10).json()
+            self.log_test("Slot Conflicts - overlap rejected",
+                          first.status_code == 200 and overlapping.status_code == 409 and check["conflict"]["appointment_id"] == ids[0],
+                          f"first {first.status_code}, overlapping {overlapping.status_code}, check {check}")
+
+            login = requests.post(f"{API_BASE}/auth/admin/login",
+                                  params={"email": "admin@drzerquera.com", "password": "ZimiAdmin2025!"}, timeout=10).json()
+            cancel = requests.put(f"{API_BASE}/appointments/{ids[0]}/cancel",
+                                  headers={"Authorization": f"Bearer {login['access_token']}"}, timeout=10)
+            retry = requests.put(f"{API_BASE}/appointments/{ids[1]}/confirm", json=slot, timeout=10)
+            self.log_test("Slot Conflicts - cancel frees slot", cancel.status_code == 200 and retry.status_code == 200,
+                          f"cancel {cancel.status_code}, confirm {retry.status_code}")
+        except Exception as e:
+            self.log_test("Slot Conflicts", False, error=e)
+
     def test_flyer_management(self):
         """Test flyer management endpoints"""
         try:
             # Test getting all flyers
             response = requests.get(f"{API_BASE}/flyers", timeout=10)
             if response.status_code == 200:
-                flyers = response.json()
+                flyers = response.json()["items"]
                 self.log_test("Get All Flyers", True, f"Retrieved {len(flyers)} flyers")
             else:
                 self.log_test("Get All Flyers", False, f"Status: {response.status_code}")
@@ -607,6 +745,81 @@ class BackendTester:
         except Exception as e:
             self.log_test("Flyer Management", False, error=e)
 
+    def test_round_trips(self):
+        """Count MongoDB round trips per write handler through /api/metrics.
+
+        Needs a single backend worker, since each worker keeps its own metrics.
+        """
+        def check(name, budget, call, background=()):
+            before = mongo_command_counts()
+            response = call()
+            trips = round_trips_since(before, background)
+            total = sum(trips.values())
+            self.log_test(f"Round Trips - {name}", response.status_code in (200, 400) and total <= budget,
+                          f"{total} commands (budget {budget}): {trips}")
+            return response
+
+        try:
+            unique = uuid.uuid4().hex[:8]
+            patient = {"nombre": "Ronda", "apellido": "Prueba", "email": f"rondas.{unique}@example.com", "telefono": "3055550199"}
+            check("register_patient", 2, lambda: requests.post(f"{API_BASE}/auth/register", json=patient, timeout=10))
+            check("register_patient (duplicate)", 1, lambda: requests.post(f"{API_BASE}/auth/register", json=patient, timeout=10))
+
+            flyer = {
+                "service_id": f"rondas_{unique}", "title": "Flyer de prueba", "image_url": "https://example.com/f.jpg",
+                "benefits": [], "conditions": [], "process": [], "safety": "", "duration": "30 min",
+                "frequency": "", "location": "", "contact_phone": "", "contact_website": ""
+            }
+            check("create_service_flyer", 2, lambda: requests.post(f"{API_BASE}/flyers", json=flyer, timeout=10))
+            requests.delete(f"{API_BASE}/flyers/{flyer['service_id']}", timeout=10)
+
+            message = requests.post(f"{API_BASE}/messages", params={"sender_id": "admin", "sender_name": "Dr. Zerquera"}, json={
+                "receiver_id": "admin", "receiver_name": "Dr. Zerquera", "subject": "Rondas", "message": "Prueba"
+            }, timeout=10).json()
+            # find + insert, then counter, thread summary and event written concurrently
+            check("reply_to_message", 5, lambda: requests.post(
+                f"{API_BASE}/messages/{message['id']}/reply",
+                params={"sender_id": "admin", "sender_name": "Dr. Zerquera"}, json={"message": "Respuesta"}, timeout=10
+            ))
+
+            appointment = requests.post(f"{API_BASE}/appointments", json={
+                "patient_name": "Ronda Prueba", "patient_email": patient["email"], "patient_phone": patient["telefono"],
+                "service_type": "acupuntura", "appointment_type": "presencial",
+                "fecha_solicitada": "2025-09-15", "hora_solicitada": "10:00"
+            }, timeout=10).json()
+            assigned_date, assigned_time = free_slot("acupuntura")
+            # Let the new appointment's notification job finish outside the measured window
+            time.sleep(1)
+            # find + version check, slot claim, findAndModify, then job insert + version bump;
+            # the message and its fan-out are written by the job queue
+            check("confirm_appointment", 6, lambda: requests.put(
+                f"{API_BASE}/appointments/{appointment['id']}/confirm",
+                json={"assigned_date": assigned_date, "assigned_time": assigned_time}, timeout=10
+            ), background={
+                "messages.insert", "messages.update", "unread_counters.findAndModify", "conversations.update", "message_events.insert"
+            })
+        except Exception as e:
+            self.log_test("Round Trips", False, error=e)
+
+    def test_pool_stats(self):
+        """The pool endpoint reports the configured pool and a warmed, in-use connection pool"""
+        try:
+            login = requests.post(f"{API_BASE}/auth/admin/login",
+                                  params={"email": "admin@drzerquera.com", "password": "ZimiAdmin2025!"}, timeout=10).json()
+            response = requests.get(f"{API_BASE}/admin/db/pool",
+                                    headers={"Authorization": f"Bearer {login['access_token']}"}, timeout=10)
+            if response.status_code != 200:
+                self.log_test("Pool Stats", False, f"Status: {response.status_code}")
+                return
+            stats = response.json()
+            servers = stats["servers"]
+            warmed = sum(server["connections"] for server in servers) >= min(stats["options"]["min_pool_size"], 1)
+            used = sum(server["checkouts"] for server in servers) > 0
+            self.log_test("Pool Stats", warmed and used,
+                          f"options {stats['options']}, connections {[server['connections'] for server in servers]}")
+        except Exception as e:
+            self.log_test("Pool Stats", False, error=e)
+
     def test_additional_endpoints(self):
         """Test additional endpoints"""
         endpoints = [
@@ -673,6 +886,24 @@ class BackendTester:
         except Exception as e:
             self.log_test("Error Handling", False, error=e)
 
+    def test_rate_limiting(self):
+        """The contact form answers 429 with Retry-After once this client's budget is spent"""
+        try:
+            contact = {"nombre": "Prueba Límite", "email": "limite@example.com", "telefono": "3055550177",
+                       "asunto": "Prueba de límite", "mensaje": "Mensaje de la prueba de límite"}
+            statuses = []
+            # The default budget is 5 per 10 minutes; earlier runs may have spent part of it
+            for _ in range(10):
+                response = requests.post(f"{API_BASE}/contact", json=contact, timeout=10)
+                statuses.append(response.status_code)
+                if response.status_code == 429:
+                    break
+            retry_after = response.headers.get("Retry-After", "")
+            self.log_test("Rate Limiting", response.status_code == 429 and retry_after.isdigit() and int(retry_after) > 0,
+                          f"statuses {statuses}, Retry-After {retry_after!r}")
+        except Exception as e:
+            self.log_test("Rate Limiting", False, error=e)
+
     def run_all_tests(self):
         """Run all backend tests"""
         print("=" * 60)
@@ -690,6 +921,7 @@ class BackendTester:
         self.test_patient_registration()
         self.test_patient_login()
         self.test_admin_login()
+        self.test_session_tokens()
         
         # Appointments
         self.test_appointment_creation()
@@ -701,6 +933,7 @@ class BackendTester:
         
         # Message system
         self.test_message_system()
+        self.test_read_your_writes()
         
         # NEW: Admin notification polling tests
         self.test_admin_message_polling()
@@ -709,9 +942,18 @@ class BackendTester:
         # NEW: Confirmation message tests
         self.test_confirmation_messages()
         
+        # Appointment slot conflicts
+        self.test_slot_conflicts()
+        
         # Flyer management
         self.test_flyer_management()
         
+        # MongoDB round trips per write handler
+        self.test_round_trips()
+        
+        # Connection pool settings and usage
+        self.test_pool_stats()
+        
         # Additional endpoints
         self.test_additional_endpoints()
         
@@ -719,6 +961,9 @@ class BackendTester:
         self.test_cors_configuration()
         self.test_error_handling()
         
+        # Last, since it spends this client's contact form budget
+        self.test_rate_limiting()
+        
         # Summary
         self.print_summary()
 
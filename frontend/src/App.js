@@ -5,6 +5,120 @@ import axios from 'axios';
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Session tokens live with the saved user; API calls carry the access token
+// and trade the refresh token for a new pair once when it has expired
+const savedSession = () => {
+  try {
+    return JSON.parse(localStorage.getItem('zimi_user')) || {};
+  } catch (error) {
+    return {};
+  }
+};
+
+// Cluster time of this browser's latest write; sending it back keeps lists
+// served by a database replica from hiding what the user just saved
+const READ_AFTER_KEY = 'zimi_read_after';
+const laterClusterTime = (a, b) => {
+  const [aTime, aInc] = (a || '0.0').split('.').map(Number);
+  const [bTime, bInc] = (b || '0.0').split('.').map(Number);
+  return aTime > bTime || (aTime === bTime && aInc >= bInc) ? a : b;
+};
+
+axios.interceptors.request.use((config) => {
+  const { access_token } = savedSession();
+  if (access_token && config.url?.startsWith(API) && !config.headers.Authorization) {
+    config.headers.Authorization = `Bearer ${access_token}`;
+  }
+  const readAfter = sessionStorage.getItem(READ_AFTER_KEY);
+  if (readAfter && config.url?.startsWith(API)) {
+    config.headers['X-Read-After'] = readAfter;
+  }
+  return config;
+});
+
+axios.interceptors.response.use((response) => {
+  const writeTime = response.headers['x-read-after'];
+  if (writeTime) {
+    sessionStorage.setItem(READ_AFTER_KEY, laterClusterTime(writeTime, sessionStorage.getItem(READ_AFTER_KEY)));
+  }
+  return response;
+});
+
+let pendingRefresh = null;
+axios.interceptors.response.use(undefined, async (error) => {
+  const { config, response } = error;
+  const { refresh_token } = savedSession();
+  if (response?.status !== 401 || !refresh_token || config._retried || config.url === `${API}/auth/refresh`) {
+    throw error;
+  }
+  pendingRefresh = pendingRefresh || axios.post(`${API}/auth/refresh`, { refresh_token })
+    .finally(() => { pendingRefresh = null; });
+  const { data } = await pendingRefresh;
+  localStorage.setItem('zimi_user', JSON.stringify({
+    ...savedSession(), access_token: data.access_token, refresh_token: data.refresh_token
+  }));
+  config._retried = true;
+  config.headers.Authorization = `Bearer ${data.access_token}`;
+  return axios(config);
+});
+
+// Whether a read_many event (ids, sender or cutoff date) applies to a message
+const isCoveredByBulkRead = (message, { receiver_id, message_ids, sender_id, before }) => (
+  !message.is_read &&
+  message.receiver_id === receiver_id &&
+  (!message_ids || message_ids.includes(message.id)) &&
+  (!sender_id || message.sender_id === sender_id) &&
+  (!before || message.created_at <= before)
+);
+
+// Every page of a cursor-paginated listing, for views that count over the whole list
+const fetchAllPages = async (url) => {
+  const items = [];
+  let after;
+  do {
+    const response = await axios.get(url, { params: { after } });
+    items.push(...response.data.items);
+    after = response.data.next_cursor;
+  } while (after);
+  return items;
+};
+
+// The doctor photo is served by the API; /doctor-info only returns its path
+const doctorImageSrc = (imagen) => (imagen && imagen.startsWith('/') ? `${BACKEND_URL}${imagen}` : imagen);
+
+// Server-sent message events; EventSource reconnects on its own and resumes from the last event id.
+// It cannot send headers, so the access token goes in the URL; once it expires the
+// stream is refused and closed, and is reopened with the current token from where it stopped
+const STREAM_REOPEN_MS = 3000;
+const subscribeToMessageEvents = (userId, handlers) => {
+  let source = null;
+  let lastEventId = null;
+  let reopenTimer = null;
+  const open = () => {
+    const params = new URLSearchParams();
+    const { access_token } = savedSession();
+    if (access_token) params.set('token', access_token);
+    if (lastEventId) params.set('last_event_id', lastEventId);
+    source = new EventSource(`${API}/messages/stream/${userId}?${params}`);
+    Object.entries(handlers).forEach(([eventType, handler]) => {
+      source.addEventListener(eventType, (event) => {
+        lastEventId = event.lastEventId || lastEventId;
+        handler(JSON.parse(event.data));
+      });
+    });
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) {
+        reopenTimer = setTimeout(open, STREAM_REOPEN_MS);
+      }
+    };
+  };
+  open();
+  return () => {
+    clearTimeout(reopenTimer);
+    source.close();
+  };
+};
+
 // Authentication Context
 const AuthContext = React.createContext();
 
@@ -37,7 +151,9 @@ const LoginPage = ({ setCurrentPage, setUser, setIsAuthenticated }) => {
           id: response.data.patient_id,
           name: response.data.patient_name,
           email: response.data.patient_email,
-          role: 'patient'
+          role: 'patient',
+          access_token: response.data.access_token,
+          refresh_token: response.data.refresh_token
         });
         setIsAuthenticated(true);
         setCurrentPage('inicio');
@@ -52,7 +168,8 @@ const LoginPage = ({ setCurrentPage, setUser, setIsAuthenticated }) => {
         setUser({
           email: formData.email,
           role: 'admin',
-          access_token: response.data.access_token
+          access_token: response.data.access_token,
+          refresh_token: response.data.refresh_token
         });
         setIsAuthenticated(true);
         setCurrentPage('admin');
@@ -215,7 +332,9 @@ const RegisterPage = ({ setCurrentPage, setUser, setIsAuthenticated }) => {
         id: response.data.patient_id,
         name: response.data.patient_name,
         email: formData.email,
-        role: 'patient'
+        role: 'patient',
+        access_token: response.data.access_token,
+        refresh_token: response.data.refresh_token
       });
       setIsAuthenticated(true);
       setCurrentPage('inicio');
@@ -389,6 +508,7 @@ const RegisterPage = ({ setCurrentPage, setUser, setIsAuthenticated }) => {
 // Messaging System Component
 const MessagingPage = ({ setCurrentPage, user }) => {
   const [messages, setMessages] = useState([]);
+  const [messagesCursor, setMessagesCursor] = useState(null);
   const [selectedMessage, setSelectedMessage] = useState(null);
   const [showCompose, setShowCompose] = useState(false);
   const [newMessage, setNewMessage] = useState({
@@ -399,36 +519,74 @@ const MessagingPage = ({ setCurrentPage, user }) => {
     message_type: 'general'
   });
   const [patients, setPatients] = useState([]);
+  const [patientSearch, setPatientSearch] = useState('');
   const [unreadCount, setUnreadCount] = useState(0);
   const [loading, setLoading] = useState(false);
 
   useEffect(() => {
     fetchMessages();
     fetchUnreadCount();
-    if (user?.role === 'admin') {
-      fetchPatients();
-    }
-    
-    // Refresh messages every 30 seconds
-    const interval = setInterval(() => {
-      fetchMessages();
-      fetchUnreadCount();
-    }, 30000);
     
-    return () => clearInterval(interval);
+    // New messages and read receipts are pushed by the server
+    const userId = user.role === 'admin' ? 'admin' : user.id;
+    return subscribeToMessageEvents(userId, {
+      message: (message) => {
+        setMessages(prev => prev.some(m => m.id === message.id) ? prev : [message, ...prev]);
+        if (message.receiver_id === userId && !message.is_read) {
+          setUnreadCount(count => count + 1);
+        }
+      },
+      read: ({ message_id, receiver_id, read_at, unread_count }) => {
+        setMessages(prev => prev.map(m => m.id === message_id ? { ...m, is_read: true, read_at } : m));
+        if (receiver_id === userId) {
+          setUnreadCount(unread_count);
+        }
+      },
+      read_many: (event) => {
+        setMessages(prev => prev.map(m => isCoveredByBulkRead(m, event) ? { ...m, is_read: true, read_at: event.read_at } : m));
+        if (event.receiver_id === userId) {
+          setUnreadCount(event.unread_count);
+        }
+      }
+    });
   }, [user]);
 
+  const markAllAsRead = async () => {
+    try {
+      const userId = user.role === 'admin' ? 'admin' : user.id;
+      const response = await axios.put(`${API}/messages/read-bulk/${userId}/before`);
+      setUnreadCount(response.data.unread_count);
+    } catch (error) {
+      console.error('Error marking messages as read:', error);
+    }
+  };
+
   const fetchMessages = async () => {
     try {
       // Use consistent ID for admin and user ID for patients
       const userId = user.role === 'admin' ? 'admin' : user.id;
       const response = await axios.get(`${API}/messages/${userId}`);
-      setMessages(response.data);
+      setMessages(response.data.items);
+      setMessagesCursor(response.data.next_cursor);
     } catch (error) {
       console.error('Error fetching messages:', error);
     }
   };
 
+  const loadMoreMessages = async () => {
+    try {
+      const userId = user.role === 'admin' ? 'admin' : user.id;
+      const response = await axios.get(`${API}/messages/${userId}`, {
+        params: { after: messagesCursor }
+      });
+      // Skip messages pushed by events that are already in the list
+      setMessages(prev => [...prev, ...response.data.items.filter(m => !prev.some(p => p.id === m.id))]);
+      setMessagesCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Error loading more messages:', error);
+    }
+  };
+
   const fetchUnreadCount = async () => {
     try {
       // Use consistent ID for admin and user ID for patients
@@ -440,25 +598,24 @@ const MessagingPage = ({ setCurrentPage, user }) => {
     }
   };
 
-  const fetchPatients = async () => {
+  const fetchPatients = async (search = '') => {
     try {
-      const response = await axios.get(`${API}/appointments`);
-      const uniquePatients = response.data.reduce((acc, apt) => {
-        if (!acc.find(p => p.id === apt.patient_id)) {
-          acc.push({
-            id: apt.patient_id,
-            name: apt.patient_name,
-            email: apt.patient_email
-          });
-        }
-        return acc;
-      }, []);
-      setPatients(uniquePatients);
+      const response = await axios.get(`${API}/admin/patients`, {
+        params: { q: search || undefined, limit: 50 }
+      });
+      setPatients(response.data.items);
     } catch (error) {
       console.error('Error fetching patients:', error);
     }
   };
 
+  // Load the patient directory for admins, searching as they type once typing pauses
+  useEffect(() => {
+    if (user?.role !== 'admin') return;
+    const timer = setTimeout(() => fetchPatients(patientSearch), 300);
+    return () => clearTimeout(timer);
+  }, [patientSearch]);
+
   const sendMessage = async () => {
     setLoading(true);
     try {
@@ -484,7 +641,6 @@ const MessagingPage = ({ setCurrentPage, user }) => {
         message_type: 'general'
       });
       setShowCompose(false);
-      fetchMessages();
       
       // Show success notification
       const notification = document.createElement('div');
@@ -519,8 +675,6 @@ const MessagingPage = ({ setCurrentPage, user }) => {
   const markAsRead = async (messageId) => {
     try {
       await axios.put(`${API}/messages/${messageId}/read`);
-      fetchMessages();
-      fetchUnreadCount();
     } catch (error) {
       console.error('Error marking message as read:', error);
     }
@@ -537,7 +691,6 @@ const MessagingPage = ({ setCurrentPage, user }) => {
           }
         }
       );
-      fetchMessages();
       setSelectedMessage(null);
       
       // Show success notification
@@ -606,6 +759,14 @@ const MessagingPage = ({ setCurrentPage, user }) => {
             </p>
           </div>
           <div className="space-x-4">
+            {unreadCount > 0 && (
+              <button
+                onClick={markAllAsRead}
+                className="bg-green-600 text-white px-4 py-3 rounded-lg hover:bg-green-700 font-semibold"
+              >
+                ✓ Marcar todo como leído
+              </button>
+            )}
             <button
               onClick={() => setShowCompose(true)}
               className="bg-blue-600 text-white px-6 py-3 rounded-lg hover:bg-blue-700 font-semibold"
@@ -708,6 +869,16 @@ const MessagingPage = ({ setCurrentPage, user }) => {
                     </div>
                   ))
                 )}
+                {messagesCursor && (
+                  <div className="p-4 text-center">
+                    <button
+                      onClick={loadMoreMessages}
+                      className="bg-blue-600 text-white px-4 py-2 rounded-lg hover:bg-blue-700"
+                    >
+                      Cargar más mensajes
+                    </button>
+                  </div>
+                )}
               </div>
             </div>
           </div>
@@ -733,6 +904,13 @@ const MessagingPage = ({ setCurrentPage, user }) => {
                       <label className="block text-sm font-medium text-gray-700 mb-2">
                         Para (Paciente)
                       </label>
+                      <input
+                        type="text"
+                        value={patientSearch}
+                        onChange={(e) => setPatientSearch(e.target.value)}
+                        placeholder="Buscar por nombre o email"
+                        className="w-full px-3 py-2 mb-2 border border-gray-300 rounded-lg focus:ring-2 focus:ring-blue-500"
+                      />
                       <select
                         value={newMessage.receiver_id}
                         onChange={(e) => {
@@ -1375,7 +1553,7 @@ const HomePage = ({ setCurrentPage }) => {
             <div className="grid md:grid-cols-2 gap-8 items-center">
               <div>
                 <img
-                  src={doctorInfo.imagen}
+                  src={doctorImageSrc(doctorInfo.imagen)}
                   alt="Dr. Pablo Zerquera"
                   className="w-full h-96 object-cover object-center rounded-lg shadow-lg"
                   style={{ objectPosition: 'center top' }}
@@ -1973,7 +2151,7 @@ const DoctorPage = ({ setCurrentPage }) => {
             </div>
             <div className="text-center">
               <img
-                src={doctorInfo.imagen}
+                src={doctorImageSrc(doctorInfo.imagen)}
                 alt={doctorInfo.nombre}
                 className="w-full max-w-sm h-80 object-cover object-center rounded-lg shadow-2xl mx-auto border-4 border-white"
                 style={{ objectPosition: 'center top' }}
@@ -2118,16 +2296,32 @@ const DoctorPage = ({ setCurrentPage }) => {
 
 const AdminPage = ({ setCurrentPage }) => {
   const [appointments, setAppointments] = useState([]);
+  const [appointmentsCursor, setAppointmentsCursor] = useState(null);
   const [contacts, setContacts] = useState([]);
   const [loading, setLoading] = useState(true);
 
+  const refreshAppointments = async () => {
+    const response = await axios.get(`${API}/appointments`);
+    setAppointments(response.data.items);
+    setAppointmentsCursor(response.data.next_cursor);
+  };
+
+  const loadMoreAppointments = async () => {
+    try {
+      const response = await axios.get(`${API}/appointments`, {
+        params: { after: appointmentsCursor }
+      });
+      setAppointments(prev => [...prev, ...response.data.items]);
+      setAppointmentsCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Error loading more appointments:', error);
+    }
+  };
+
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const [appointmentsResponse] = await Promise.all([
-          axios.get(`${API}/appointments`)
-        ]);
-        setAppointments(appointmentsResponse.data);
+        await refreshAppointments();
       } catch (error) {
         console.error('Error fetching admin data:', error);
       } finally {
@@ -2147,29 +2341,35 @@ const AdminPage = ({ setCurrentPage }) => {
 
   const confirmAppointment = async (appointmentId, directConfirm = false) => {
     if (directConfirm) {
-      // Direct confirmation without modal (for quick confirm)
-      const today = new Date();
-      const tomorrow = new Date(today);
-      tomorrow.setDate(tomorrow.getDate() + 1);
-      
-      const defaultData = {
-        assigned_date: tomorrow.toISOString().split('T')[0],
-        assigned_time: '09:00',
-        telemedicine_link: '',
-        doctor_notes: 'Cita confirmada. Por favor contacte nuestra oficina si necesita más información.'
-      };
+      // Direct confirmation without modal (for quick confirm) in the first free slot
+      const appointment = appointments.find(apt => apt.id === appointmentId);
       
       try {
+        const availability = await axios.get(`${API}/appointments/availability`, {
+          params: { service_type: appointment?.service_type, days: 30 }
+        });
+        const firstDay = availability.data.days.find(day => day.slots.length > 0);
+        if (!firstDay) {
+          alert('No hay horarios disponibles en los próximos 30 días');
+          return;
+        }
+        
+        const defaultData = {
+          assigned_date: firstDay.date,
+          assigned_time: firstDay.slots[0],
+          telemedicine_link: '',
+          doctor_notes: 'Cita confirmada. Por favor contacte nuestra oficina si necesita más información.'
+        };
+        
         await axios.put(`${API}/appointments/${appointmentId}/confirm`, defaultData);
         
         // Refresh appointments
-        const response = await axios.get(`${API}/appointments`);
-        setAppointments(response.data);
+        await refreshAppointments();
         
-        alert('Cita confirmada exitosamente para mañana a las 9:00 AM');
+        alert(`Cita confirmada exitosamente para el ${defaultData.assigned_date} a las ${defaultData.assigned_time}`);
       } catch (error) {
         console.error('Error confirming appointment:', error);
-        alert('Error al confirmar la cita');
+        alert(error.response?.data?.detail || 'Error al confirmar la cita');
       }
     } else {
       // Open confirmation modal
@@ -2200,8 +2400,7 @@ const AdminPage = ({ setCurrentPage }) => {
       await axios.put(`${API}/appointments/${confirmingAppointment.id}/confirm`, confirmationData);
       
       // Refresh appointments
-      const response = await axios.get(`${API}/appointments`);
-      setAppointments(response.data);
+      await refreshAppointments();
       
       // Close modal
       setConfirmingAppointment(null);
@@ -2215,7 +2414,7 @@ const AdminPage = ({ setCurrentPage }) => {
       alert('Cita confirmada exitosamente con fecha y hora asignada');
     } catch (error) {
       console.error('Error confirming appointment:', error);
-      alert('Error al confirmar la cita');
+      alert(error.response?.data?.detail || 'Error al confirmar la cita');
     }
   };
 
@@ -2526,6 +2725,17 @@ const AdminPage = ({ setCurrentPage }) => {
               </p>
             </div>
           )}
+
+          {appointmentsCursor && (
+            <div className="p-6 border-t text-center">
+              <button
+                onClick={loadMoreAppointments}
+                className="bg-blue-600 text-white px-6 py-3 rounded-lg text-lg hover:bg-blue-700"
+              >
+                Cargar más citas
+              </button>
+            </div>
+          )}
         </div>
 
         {/* Instructions */}
@@ -2717,7 +2927,7 @@ const DoctorImageManager = ({ setCurrentPage }) => {
   const fetchCurrentImage = async () => {
     try {
       const response = await axios.get(`${API}/doctor-info`);
-      setCurrentImage(response.data.imagen);
+      setCurrentImage(doctorImageSrc(response.data.imagen));
     } catch (error) {
       console.error('Error fetching current image:', error);
     }
@@ -2757,8 +2967,8 @@ const DoctorImageManager = ({ setCurrentPage }) => {
           
           console.log('Upload response:', response.data);
           
-          // Refresh the current image from server to confirm update
-          await fetchCurrentImage();
+          // Show the stored image at its new versioned URL
+          setCurrentImage(doctorImageSrc(response.data.image_url));
           
           setUploadSuccess(true);
           setNewImage(null);
@@ -3841,6 +4051,7 @@ const FlyerManagementPage = ({ setCurrentPage, user }) => {
 const PatientProfilePage = ({ setCurrentPage, user }) => {
   const [patientData, setPatientData] = useState(null);
   const [appointments, setAppointments] = useState([]);
+  const [appointmentsCursor, setAppointmentsCursor] = useState(null);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
@@ -3854,7 +4065,8 @@ const PatientProfilePage = ({ setCurrentPage, user }) => {
         ]);
         
         setPatientData(profileResponse.data);
-        setAppointments(appointmentsResponse.data);
+        setAppointments(appointmentsResponse.data.items);
+        setAppointmentsCursor(appointmentsResponse.data.next_cursor);
       } catch (error) {
         console.error('Error fetching patient data:', error);
       } finally {
@@ -3865,6 +4077,18 @@ const PatientProfilePage = ({ setCurrentPage, user }) => {
     fetchPatientData();
   }, [user]);
 
+  const loadMoreAppointments = async () => {
+    try {
+      const response = await axios.get(`${API}/patient/${user.id}/appointments`, {
+        params: { after: appointmentsCursor }
+      });
+      setAppointments(prev => [...prev, ...response.data.items]);
+      setAppointmentsCursor(response.data.next_cursor);
+    } catch (error) {
+      console.error('Error loading more appointments:', error);
+    }
+  };
+
   const getStatusColor = (status) => {
     switch (status) {
       case 'solicitada': return 'bg-yellow-100 text-yellow-800';
@@ -4073,6 +4297,17 @@ const PatientProfilePage = ({ setCurrentPage, user }) => {
                     ))}
                   </div>
                 )}
+
+                {appointmentsCursor && (
+                  <div className="pt-6 text-center">
+                    <button
+                      onClick={loadMoreAppointments}
+                      className="bg-blue-600 text-white px-6 py-3 rounded-lg hover:bg-blue-700 font-semibold"
+                    >
+                      Cargar más citas
+                    </button>
+                  </div>
+                )}
               </div>
             </div>
           </div>
@@ -4120,20 +4355,11 @@ function App() {
     if (user?.role === 'admin') {
       const loadAdminData = async () => {
         try {
-          // Use the specific admin polling endpoint
-          const pollResponse = await axios.get(`${API}/admin/messages/poll`);
-          
-          // Also load all messages for admin
-          const messagesResponse = await axios.get(`${API}/messages/admin`);
-          setMessages(messagesResponse.data);
-          
-          // Load appointments
-          const appointmentsResponse = await axios.get(`${API}/appointments`);
-          setAppointments(appointmentsResponse.data);
-          
-          // Log unread count for debugging
-          console.log(`Admin notification poll - Unread messages: ${pollResponse.data.unread_count}`);
+          // Load all messages for admin, every page, so the unread count covers them all
+          setMessages(await fetchAllPages(`${API}/messages/admin`));
           
+          // Load appointments, every page, so the pending count covers them all
+          setAppointments(await fetchAllPages(`${API}/appointments`));
         } catch (error) {
           console.error('Error loading admin data for notifications:', error);
         }
@@ -4141,9 +4367,21 @@ function App() {
       
       loadAdminData();
       
-      // Poll more frequently for admin notifications (every 15 seconds)
-      const interval = setInterval(loadAdminData, 15000);
-      return () => clearInterval(interval);
+      // Keep notifications current from server-pushed events instead of polling
+      return subscribeToMessageEvents('admin', {
+        message: (message) => {
+          setMessages(prev => prev.some(m => m.id === message.id) ? prev : [message, ...prev]);
+        },
+        read: ({ message_id, read_at }) => {
+          setMessages(prev => prev.map(m => m.id === message_id ? { ...m, is_read: true, read_at } : m));
+        },
+        read_many: (event) => {
+          setMessages(prev => prev.map(m => isCoveredByBulkRead(m, event) ? { ...m, is_read: true, read_at: event.read_at } : m));
+        },
+        appointment: (appointment) => {
+          setAppointments(prev => [appointment, ...prev]);
+        }
+      });
     }
   }, [user]);
 
@@ -4155,6 +4393,11 @@ function App() {
   }, [user, isAuthenticated]);
 
   const logout = () => {
+    // Revoke the session server-side; the local session is cleared either way
+    const { access_token } = savedSession();
+    if (access_token) {
+      axios.post(`${API}/auth/logout`, {}, { headers: { Authorization: `Bearer ${access_token}` } }).catch(() => {});
+    }
     setUser(null);
     setIsAuthenticated(false);
     setCurrentPage('login');
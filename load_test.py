@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+ZIMI Backend Load Test
+Drives the /api surface with concurrent virtual users running weighted
+scenario mixes, then reports requests/s and p50/p95/p99 latency per route
+and saves the run as JSON for comparison with earlier runs.
+
+Runs against a local uvicorn backed by a local mongod, with the public write
+rate limits turned off since every virtual user shares one address:
+    cd backend && RATE_LIMITS="POST /api/appointments=off,POST /api/auth/register=off" \
+        uvicorn server:app --port 8001 --workers 2
+    python load_test.py --base-url http://localhost:8001 --concurrency 50 --duration 60
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+SERVICE_IDS = [
+    "acupuntura", "medicina_oriental", "medicina_funcional", "medicina_ortomolecular", "homeopatia",
+    "nutricion_tcm", "fisioterapia", "terapia_ozono", "terapia_inyeccion", "herbal_tcm"
+]
+CATALOG_ROUTES = ["/", "/services", "/doctor-info", "/team", "/insurance", "/testimonials", "/contact-info"]
+
+# Relative weights of each scenario in the default mix
+DEFAULT_MIX = {
+    "landing": 50,
+    "patient_portal": 25,
+    "admin_inbox": 15,
+    "appointment_burst": 5,
+    "confirmation": 5,
+}
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+class Recorder:
+    """Latencies and outcomes per route template"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.recording = False
+
+    def record(self, route, status, elapsed, expected=()):
+        if not self.recording:
+            return
+        self.latencies[route].append(elapsed)
+        self.statuses[route][status] += 1
+        if status == 0 or (status >= 400 and status not in expected):
+            self.errors[route] += 1
+
+    def summary(self, elapsed_seconds):
+        routes = {}
+        for route in sorted(self.latencies):
+            values = sorted(self.latencies[route])
+            routes[route] = {
+                "requests": len(values),
+                "errors": self.errors[route],
+                "requests_per_second": round(len(values) / elapsed_seconds, 2),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2),
+                "statuses": dict(self.statuses[route]),
+            }
+        total = sum(route["requests"] for route in routes.values())
+        return {
+            "total_requests": total,
+            "total_errors": sum(route["errors"] for route in routes.values()),
+            "requests_per_second": round(total / elapsed_seconds, 2),
+            "routes": routes,
+        }
+
+class LoadTester:
+    def __init__(self, client, recorder, patients, admin_headers):
+        self.client = client
+        self.recorder = recorder
+        self.patients = patients
+        self.admin_headers = admin_headers
+        self.pending_appointments = []
+
+    async def call(self, method, route, path, expected=(), **kwargs):
+        """Issue one request, recording it under its route template; `expected` error statuses are not failures"""
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, f"/api{path}", **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            response, status = None, 0
+        self.recorder.record(f"{method} /api{route}", status, time.perf_counter() - started, expected)
+        return response
+
+    def appointment_payload(self):
+        patient = random.choice(self.patients)
+        return {
+            "patient_name": patient["name"],
+            "patient_email": patient["email"],
+            "patient_phone": patient["phone"],
+            "service_type": random.choice(SERVICE_IDS),
+            "appointment_type": random.choice(["presencial", "telemedicina"]),
+            "fecha_solicitada": "2025-09-15",
+            "hora_solicitada": random.choice(["09:00", "10:30", "14:00", "16:30"]),
+            "mensaje": "Cita generada por la prueba de carga"
+        }
+
+    async def landing(self):
+        """A visitor browsing the public site"""
+        for route in random.sample(CATALOG_ROUTES, 4):
+            await self.call("GET", route, route)
+        service_id = random.choice(SERVICE_IDS)
+        await self.call("GET", "/flyers/{service_id}", f"/flyers/{service_id}")
+
+    async def patient_portal(self):
+        """A logged-in patient refreshing their portal"""
+        patient = random.choice(self.patients)
+        patient_id = patient["id"]
+        await self.call("GET", "/patient/{patient_id}/appointments", f"/patient/{patient_id}/appointments")
+        await self.call("GET", "/messages/{user_id}", f"/messages/{patient_id}", params={"limit": 20})
+        await self.call("GET", "/messages/unread/{user_id}", f"/messages/unread/{patient_id}")
+        await self.call("GET", "/conversations/{user_id}", f"/conversations/{patient_id}", params={"limit": 20})
+
+    async def admin_inbox(self):
+        """The doctor working through the inbox"""
+        headers = self.admin_headers
+        await self.call("GET", "/admin/messages/poll", "/admin/messages/poll", headers=headers)
+        response = await self.call("GET", "/messages/{user_id}", "/messages/admin", params={"limit": 50}, headers=headers)
+        await self.call("GET", "/conversations/{user_id}", "/conversations/admin", params={"limit": 50}, headers=headers)
+        await self.call("GET", "/appointments", "/appointments", params={"limit": 50}, headers=headers)
+        await self.call("GET", "/admin/patients", "/admin/patients", headers=headers,
+                        params={"q": random.choice("abcdeglmr"), "limit": 20})
+        if response is not None and response.status_code == 200:
+            unread = [message for message in response.json()["items"] if not message["is_read"]]
+            if unread:
+                message_id = random.choice(unread)["id"]
+                await self.call("PUT", "/messages/{message_id}/read", f"/messages/{message_id}/read", headers=headers)
+
+    async def appointment_burst(self):
+        """Several appointment requests arriving together"""
+        responses = await asyncio.gather(*[
+            self.call("POST", "/appointments", "/appointments", json=self.appointment_payload())
+            for _ in range(5)
+        ])
+        for response in responses:
+            if response is not None and response.status_code == 200:
+                appointment = response.json()
+                self.pending_appointments.append((appointment["id"], appointment["service_type"]))
+
+    async def confirmation(self):
+        """The doctor confirming a requested appointment"""
+        if not self.pending_appointments:
+            return await self.appointment_burst()
+        appointment_id, service_type = self.pending_appointments.pop()
+        response = await self.call("GET", "/appointments/availability", "/appointments/availability",
+                                   params={"service_type": service_type, "days": 60})
+        if response is None or response.status_code != 200:
+            return
+        slots = [(day["date"], slot) for day in response.json()["days"] for slot in day["slots"]]
+        if not slots:
+            return
+        assigned_date, assigned_time = random.choice(slots)
+        # Two users can pick the same free slot at once; the loser gets 409
+        await self.call("PUT", "/appointments/{appointment_id}/confirm", f"/appointments/{appointment_id}/confirm",
+                        expected=(409,), headers=self.admin_headers, json={
+            "assigned_date": assigned_date,
+            "assigned_time": assigned_time,
+            "doctor_notes": "Confirmada por la prueba de carga"
+        })
+
+async def register_patients(client, count):
+    """Create the patient accounts the scenarios act as, outside the measured window"""
+    run_tag = uuid.uuid4().hex[:8]
+    patients = []
+    for index in range(count):
+        email = f"carga.{run_tag}.{index}@example.com"
+        phone = f"+1305555{index:04d}"
+        response = await client.post("/api/auth/register", json={
+            "nombre": f"Paciente{index}", "apellido": "Carga", "email": email, "telefono": phone
+        })
+        response.raise_for_status()
+        patients.append({"id": response.json()["patient_id"], "name": f"Paciente{index} Carga", "email": email, "phone": phone})
+    return patients
+
+async def admin_login(client, email, password):
+    """Bearer header for the admin scenarios; the admin tools always need a session"""
+    response = await client.post("/api/auth/admin/login", params={"email": email, "password": password})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+async def seed_messages(tester, count):
+    """Give the inboxes some history so message reads are not trivially empty"""
+    for _ in range(count):
+        patient = random.choice(tester.patients)
+        await tester.client.post("/api/messages", params={"sender_id": patient["id"], "sender_name": patient["name"]}, json={
+            "receiver_id": "admin",
+            "receiver_name": "Dr. Zerquera",
+            "subject": "Consulta de prueba de carga",
+            "message": "Mensaje generado por la prueba de carga"
+        })
+
+async def virtual_user(tester, scenarios, weights, deadline):
+    while time.monotonic() < deadline:
+        scenario = random.choices(scenarios, weights)[0]
+        await getattr(tester, scenario)()
+
+async def run(args):
+    mix = dict(DEFAULT_MIX)
+    for entry in args.mix or []:
+        name, _, weight = entry.partition("=")
+        if name not in DEFAULT_MIX:
+            sys.exit(f"Unknown scenario: {name} (choose from {', '.join(DEFAULT_MIX)})")
+        mix[name] = float(weight)
+    scenarios = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in scenarios]
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        recorder = Recorder()
+        tester = LoadTester(client, recorder, await register_patients(client, args.patients),
+                            await admin_login(client, args.admin_email, args.admin_password))
+        await seed_messages(tester, args.seed_messages)
+
+        print(f"Load testing {args.base_url} with {args.concurrency} virtual users for {args.duration}s")
+        print(f"Scenario mix: {', '.join(f'{name}={mix[name]:g}' for name in scenarios)}")
+
+        if args.warmup:
+            await asyncio.gather(*[
+                virtual_user(tester, scenarios, weights, time.monotonic() + args.warmup)
+                for _ in range(args.concurrency)
+            ])
+
+        recorder.recording = True
+        started = time.monotonic()
+        await asyncio.gather(*[
+            virtual_user(tester, scenarios, weights, started + args.duration)
+            for _ in range(args.concurrency)
+        ])
+        elapsed = time.monotonic() - started
+        recorder.recording = False
+
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "config": {
+            "base_url": args.base_url,
+            "concurrency": args.concurrency,
+            "duration_seconds": args.duration,
+            "warmup_seconds": args.warmup,
+            "mix": {name: mix[name] for name in scenarios},
+        },
+        "elapsed_seconds": round(elapsed, 2),
+        **recorder.summary(elapsed),
+    }
+
+def print_report(results, baseline=None):
+    print("=" * 108)
+    print(f"{'ROUTE':<46}{'REQS':>8}{'ERR':>6}{'REQ/S':>9}{'P50 ms':>10}{'P95 ms':>10}{'P99 ms':>10}{'ΔP95':>9}")
+    print("=" * 108)
+    for route, stats in results["routes"].items():
+        delta = ""
+        previous = (baseline or {}).get("routes", {}).get(route)
+        if previous:
+            delta = f"{(stats['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100:+.0f}%" if previous["p95_ms"] else ""
+        print(f"{route:<46}{stats['requests']:>8}{stats['errors']:>6}{stats['requests_per_second']:>9.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{delta:>9}")
+    print("=" * 108)
+    print(f"Total: {results['total_requests']} requests, {results['total_errors']} errors, "
+          f"{results['requests_per_second']:.1f} req/s over {results['elapsed_seconds']}s")
+    if baseline:
+        print(f"Baseline: {baseline['requests_per_second']:.1f} req/s ({baseline['timestamp']})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load test for the ZIMI backend API")
+    parser.add_argument("--base-url", default="http://localhost:8001", help="backend URL without /api")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="unmeasured seconds before the run")
+    parser.add_argument("--timeout", type=float, default=30, help="per-request timeout in seconds")
+    parser.add_argument("--patients", type=int, default=20, help="patient accounts registered for the run")
+    parser.add_argument("--admin-email", default="admin@drzerquera.com", help="admin account for the admin scenarios")
+    parser.add_argument("--admin-password", default="ZimiAdmin2025!", help="admin account password")
+    parser.add_argument("--seed-messages", type=int, default=100, help="messages sent to admin before the run")
+    parser.add_argument("--mix", nargs="*", metavar="SCENARIO=WEIGHT",
+                        help=f"override scenario weights, e.g. landing=0 admin_inbox=50 ({', '.join(DEFAULT_MIX)})")
+    parser.add_argument("--output", default=None, help="results file (default load-test-<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="earlier results file to compare p95 against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    output = args.output or f"load-test-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}")
+    sys.exit(1 if results["total_errors"] else 0)
+
+if __name__ == "__main__":
+    main()
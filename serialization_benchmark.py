@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+ZIMI Serialization Micro-Benchmark
+Compares the per-document cost of the list endpoints' old response path
+(Model(**doc), response_model validation, jsonable_encoder + json.dumps)
+with the trusted-document path (projected dict + orjson) used by the API.
+
+Usage: python serialization_benchmark.py [--documents 200] [--rounds 50]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+# The server module connects lazily, so importing it needs no running database
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "zimi_benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import server  # noqa: E402
+
+def sample_messages(count):
+    now = datetime.utcnow().replace(microsecond=0)
+    documents = []
+    for index in range(count):
+        message_id = str(uuid.uuid4())
+        documents.append({
+            "id": message_id,
+            "sender_id": str(uuid.uuid4()),
+            "receiver_id": "admin",
+            "sender_name": "María González",
+            "receiver_name": "Dr. Zerquera",
+            "subject": f"Consulta de seguimiento #{index}",
+            "message": "Buenos días doctor, quería consultarle sobre el tratamiento de acupuntura. " * 3,
+            "is_read": index % 3 == 0,
+            "message_type": "general",
+            "appointment_id": None,
+            "thread_id": message_id,
+            "created_at": now - timedelta(minutes=index),
+            "read_at": None
+        })
+    return documents
+
+def sample_appointments(count):
+    now = datetime.utcnow().replace(microsecond=0)
+    return [{
+        "id": str(uuid.uuid4()),
+        "patient_id": str(uuid.uuid4()),
+        "patient_name": "Carlos Rodríguez",
+        "patient_email": "carlos@example.com",
+        "patient_phone": "+1 305 555 0100",
+        "service_type": "acupuntura",
+        "appointment_type": "presencial",
+        "fecha_solicitada": "2025-03-10",
+        "hora_solicitada": "10:00",
+        "mensaje": "Dolor lumbar crónico",
+        "status": "solicitada",
+        "created_at": now - timedelta(hours=index),
+        "confirmed_at": None,
+        "assigned_date": None,
+        "assigned_time": None,
+        "telemedicine_link": None,
+        "doctor_notes": None
+    } for index in range(count)]
+
+def old_path(model, page_model, documents):
+    """What FastAPI did with Model(**doc) items and a response_model"""
+    adapter = TypeAdapter(page_model)
+    page = page_model(items=[model(**document) for document in documents], next_cursor=None)
+    validated = adapter.validate_python(page.model_dump())
+    content = jsonable_encoder(adapter.dump_python(validated, mode="json"))
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def fast_path(shape, documents):
+    return orjson.dumps({"items": [shape.complete(document) for document in documents], "next_cursor": None})
+
+def measure(function, rounds):
+    function()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        function()
+    return (time.perf_counter() - started) / rounds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=200, help="documents per page")
+    parser.add_argument("--rounds", type=int, default=50, help="pages serialized per measurement")
+    args = parser.parse_args()
+
+    cases = [
+        ("messages", server.Message, server.MessagePage, server.MESSAGE_SHAPE, sample_messages),
+        ("appointments", server.Appointment, server.AppointmentPage, server.APPOINTMENT_SHAPE, sample_appointments),
+    ]
+
+    print(f"{'endpoint':<14}{'antes µs/doc':>14}{'ahora µs/doc':>14}{'mejora':>9}")
+    for name, model, page_model, shape, sample in cases:
+        documents = sample(args.documents)
+        # Both paths must produce the same JSON document
+        assert json.loads(old_path(model, page_model, documents)) == json.loads(fast_path(shape, documents))
+        before = measure(lambda: old_path(model, page_model, documents), args.rounds) / args.documents * 1e6
+        after = measure(lambda: fast_path(shape, documents), args.rounds) / args.documents * 1e6
+        print(f"{name:<14}{before:>14.2f}{after:>14.2f}{before / after:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
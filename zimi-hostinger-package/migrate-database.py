@@ -1,37 +1,361 @@
 #!/usr/bin/env python3
 """
 Script para migrar datos desde Emergent a Hostinger
-Exporta datos existentes y los prepara para importación
+Exporta cada colección en streaming a un archivo comprimido (BSON o NDJSON
+en Extended JSON canónico, conservando fechas, ObjectId y tipos numéricos)
+junto con un manifest.json con conteos e índices para la importación.
+La importación lee esos archivos en streaming, escribe con insert_many sin
+orden desde varios escritores por colección y crea los índices al final.
+
+Uso:
+    python migrate-database.py export --out zimi_export
+    python migrate-database.py export --out zimi_export --resume   # continuar una exportación interrumpida
+    python migrate-database.py import --src zimi_export --mongo-url mongodb://hostinger:27017 --db zimi
 """
 
-import os
+import argparse
+import asyncio
+import gzip
 import json
-from motor.motor_asyncio import AsyncIOMotorClient
+import os
+import sys
+import time
 from datetime import datetime
 
-async def export_data():
-    # Conectar a la base de datos actual (Emergent)
-    current_mongo_url = "mongodb://localhost:27017"  # Actualizar si es diferente
-    client = AsyncIOMotorClient(current_mongo_url)
-    db = client["test_database"]
-    
-    # Exportar colecciones
-    collections_to_export = ["appointments", "patients", "messages", "flyers"]
-    export_data = {}
-    
-    for collection_name in collections_to_export:
-        collection = db[collection_name]
-        documents = await collection.find().to_list(1000)
-        export_data[collection_name] = documents
-        print(f"Exported {len(documents)} documents from {collection_name}")
-    
-    # Guardar datos exportados
-    with open("zimi_data_export.json", "w") as f:
-        json.dump(export_data, f, indent=2, default=str)
-    
-    print("✅ Datos exportados a zimi_data_export.json")
-    client.close()
+from bson import decode, json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+DEFAULT_MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+DEFAULT_DB_NAME = os.environ.get("DB_NAME", "test_database")
+PROGRESS_SECONDS = 5
+DUPLICATE_KEY = 11000
+RAW_CODEC = CodecOptions(document_class=RawBSONDocument)
+
+def data_path(out_dir, collection_name, export_format):
+    return os.path.join(out_dir, f"{collection_name}.{export_format}.gz")
+
+def state_path(out_dir, collection_name):
+    return os.path.join(out_dir, f"{collection_name}.state.json")
+
+def write_json_atomic(path, payload):
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(payload, f, indent=2)
+    os.replace(temporary, path)
+
+def load_state(out_dir, collection_name):
+    try:
+        with open(state_path(out_dir, collection_name)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+class Progress:
+    """Documentos y bytes por colección, con el ritmo desde el inicio"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.collections = {}
+
+    def start(self, name, total, done=0):
+        self.collections[name] = {"total": total, "done": done, "bytes": 0, "finished": False}
+
+    def add(self, name, documents, size):
+        self.collections[name]["done"] += documents
+        self.collections[name]["bytes"] += size
+
+    def finish(self, name):
+        self.collections[name]["finished"] = True
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        parts = []
+        for name, stats in self.collections.items():
+            mark = "✅" if stats["finished"] else "…"
+            parts.append(f"{mark} {name} {stats['done']}/{stats['total']}")
+        documents = sum(stats["done"] for stats in self.collections.values())
+        megabytes = sum(stats["bytes"] for stats in self.collections.values()) / 1e6
+        throughput = f"{documents / elapsed:,.0f} docs/s" + (f", {megabytes / elapsed:.1f} MB/s" if megabytes else "")
+        print(f"[{elapsed:7.1f}s] {throughput} | " + " | ".join(parts))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PROGRESS_SECONDS)
+            self.report()
+
+def append_batch(path, export_format, batch):
+    """Comprime y añade un lote al archivo como un miembro gzip completo.
+
+    Devuelve los bytes sin comprimir y el tamaño del archivo al terminar, ya en
+    disco: ese desplazamiento se guarda en el estado para reanudar.
+    """
+    if export_format == "bson":
+        payload = b"".join(document.raw for document in batch)
+    else:
+        payload = "".join(
+            json_util.dumps(decode(document.raw), json_options=json_util.CANONICAL_JSON_OPTIONS) + "\n"
+            for document in batch
+        ).encode("utf-8")
+    with open(path, "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="ab", compresslevel=6) as f:
+            f.write(payload)
+        raw.flush()
+        os.fsync(raw.fileno())
+        return len(payload), raw.tell()
+
+async def export_collection(db, name, args, progress, manifest):
+    collection = db.get_collection(name, codec_options=RAW_CODEC)
+    path = data_path(args.out, name, args.format)
+    state = load_state(args.out, name) if args.resume else None
+
+    query = {}
+    if state and state.get("complete"):
+        progress.start(name, state["exported"], state["exported"])
+        progress.finish(name)
+        manifest["collections"][name] = {**manifest["collections"].get(name, {}), "count": state["exported"]}
+        return
+    if state and ("offset" not in state or not os.path.exists(path) or os.path.getsize(path) < state["offset"]):
+        # Sin desplazamiento (estado de una versión anterior) o con el archivo más corto, no se sabe
+        # dónde acaba el último lote completo
+        print(f"⚠️ {name}: no se puede reanudar, se exporta de nuevo desde el principio")
+        state = None
+    if state:
+        # Un corte a mitad de lote deja un miembro gzip truncado tras el último lote guardado
+        with open(path, "ab") as f:
+            f.truncate(state["offset"])
+        # Los documentos se leen en orden de _id, así que el último _id escrito es el punto de reanudación
+        query = {"_id": {"$gt": json_util.loads(state["last_id"])}}
+    elif os.path.exists(path):
+        os.remove(path)
+
+    exported = state["exported"] if state else 0
+    progress.start(name, await collection.estimated_document_count(), exported)
+    manifest["collections"][name] = {
+        "file": os.path.basename(path),
+        # Extended JSON para que opciones como partialFilterExpression conserven sus tipos
+        "indexes": json.loads(json_util.dumps(
+            [{key: value for key, value in index.items() if key not in ("v", "ns")}
+             for index in await db[name].list_indexes().to_list(None)],
+            json_options=json_util.CANONICAL_JSON_OPTIONS
+        ))
+    }
+
+    last_id = state["last_id"] if state else None
+    offset = state["offset"] if state else 0
+    batch = []
+    cursor = collection.find(query, batch_size=args.batch_size).sort("_id", 1)
+    async for document in cursor:
+        batch.append(document)
+        if len(batch) >= args.batch_size:
+            exported, last_id, offset = await flush_batch(args, name, path, batch, exported, progress)
+            batch = []
+    if batch:
+        exported, last_id, offset = await flush_batch(args, name, path, batch, exported, progress)
+
+    write_json_atomic(state_path(args.out, name), {"last_id": last_id, "exported": exported, "offset": offset, "complete": True})
+    manifest["collections"][name]["count"] = exported
+    progress.finish(name)
+
+async def flush_batch(args, name, path, batch, exported, progress):
+    # Comprimir fuera del event loop deja que las demás colecciones sigan leyendo
+    size, offset = await asyncio.to_thread(append_batch, path, args.format, batch)
+    exported += len(batch)
+    last_id = json_util.dumps(batch[-1]["_id"], json_options=json_util.CANONICAL_JSON_OPTIONS)
+    # El estado se escribe después de los datos: al reanudar se trunca al último lote guardado
+    # y se repite como mucho ese lote, y la importación es idempotente por id
+    write_json_atomic(state_path(args.out, name), {"last_id": last_id, "exported": exported, "offset": offset, "complete": False})
+    progress.add(name, len(batch), size)
+    return exported, last_id, offset
+
+async def export_data(args):
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db]
+    os.makedirs(args.out, exist_ok=True)
+
+    collections = args.collections or sorted(
+        name for name in await db.list_collection_names() if not name.startswith("system.")
+    )
+    manifest_path = os.path.join(args.out, "manifest.json")
+    manifest = {"collections": {}}
+    if args.resume and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    manifest.update({"database": args.db, "format": args.format, "exported_at": datetime.utcnow().isoformat()})
+
+    progress = Progress()
+    reporter = asyncio.create_task(progress.run())
+    semaphore = asyncio.Semaphore(args.parallel)
+
+    async def run_one(name):
+        async with semaphore:
+            await export_collection(db, name, args, progress, manifest)
+
+    try:
+        await asyncio.gather(*(run_one(name) for name in collections))
+    finally:
+        reporter.cancel()
+        write_json_atomic(manifest_path, manifest)
+        client.close()
+
+    progress.report()
+    print(f"✅ Datos exportados a {args.out}/ ({args.format}.gz por colección, manifest.json)")
+
+def read_batches(path, export_format, batch_size):
+    """Lotes de documentos de un archivo exportado; BSON se entrega sin decodificar"""
+    with gzip.open(path, "rb") as f:
+        batch = []
+        if export_format == "bson":
+            while True:
+                header = f.read(4)
+                if not header:
+                    break
+                batch.append(RawBSONDocument(header + f.read(int.from_bytes(header, "little") - 4)))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        else:
+            for line in f:
+                if line.strip():
+                    batch.append(json_util.loads(line))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+def replacement(document):
+    """Reemplazo idempotente: por id cuando el documento lo tiene, si no por _id"""
+    document = decode(document.raw) if isinstance(document, RawBSONDocument) else dict(document)
+    if "id" in document:
+        document.pop("_id", None)
+        return ReplaceOne({"id": document["id"]}, document, upsert=True)
+    return ReplaceOne({"_id": document["_id"]}, document, upsert=True)
+
+async def write_batch(collection, batch):
+    """insert_many sin orden; los documentos que ya existen se reemplazan, así repetir la importación es seguro"""
+    try:
+        await collection.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        duplicates = [error["index"] for error in e.details["writeErrors"] if error["code"] == DUPLICATE_KEY]
+        if len(duplicates) < len(e.details["writeErrors"]):
+            raise
+        await collection.bulk_write([replacement(batch[index]) for index in duplicates], ordered=False)
+
+def index_models(specs):
+    models = []
+    for spec in json_util.loads(json.dumps(specs)):
+        if spec["name"] == "_id_":
+            continue
+        options = {key: value for key, value in spec.items() if key != "key"}
+        models.append(IndexModel(list(spec["key"].items()), **options))
+    return models
+
+async def import_collection(db, name, entry, args, progress, export_format):
+    path = os.path.join(args.src, entry.get("file") or f"{name}.{export_format}.gz")
+    progress.start(name, entry.get("count", 0))
+    collection = db[name]
+    if args.drop:
+        await collection.drop()
+
+    if os.path.exists(path):
+        # Cola acotada: la lectura espera a los escritores y la memoria queda limitada a unos pocos lotes
+        queue = asyncio.Queue(maxsize=args.writers * 2)
+        failures = []
+
+        async def writer():
+            # Tras un fallo los escritores siguen vaciando la cola para no bloquear la lectura
+            while (batch := await queue.get()) is not None:
+                if failures:
+                    continue
+                try:
+                    await write_batch(collection, batch)
+                    progress.add(name, len(batch), sum(len(document.raw) for document in batch) if export_format == "bson" else 0)
+                except PyMongoError as e:
+                    failures.append(e)
+
+        writers = [asyncio.create_task(writer()) for _ in range(args.writers)]
+        batches = read_batches(path, export_format, args.batch_size)
+        while not failures and (batch := await asyncio.to_thread(next, batches, None)) is not None:
+            await queue.put(batch)
+        for _ in writers:
+            await queue.put(None)
+        await asyncio.gather(*writers)
+        if failures:
+            raise failures[0]
+
+    # Los índices se crean con los datos ya cargados: una sola construcción en lugar de mantenerlos en cada inserción
+    for model in index_models(entry.get("indexes", [])):
+        try:
+            await collection.create_indexes([model])
+        except OperationFailure as e:
+            print(f"⚠️ No se pudo crear el índice {model.document['name']} en {name}: {e}")
+    progress.finish(name)
+
+async def import_data(args):
+    with open(os.path.join(args.src, "manifest.json")) as f:
+        manifest = json.load(f)
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db]
+
+    collections = {
+        name: entry for name, entry in manifest["collections"].items()
+        if not args.collections or name in args.collections
+    }
+    progress = Progress()
+    reporter = asyncio.create_task(progress.run())
+    semaphore = asyncio.Semaphore(args.parallel)
+
+    async def run_one(name, entry):
+        async with semaphore:
+            await import_collection(db, name, entry, args, progress, manifest["format"])
+
+    try:
+        await asyncio.gather(*(run_one(name, entry) for name, entry in collections.items()))
+    finally:
+        reporter.cancel()
+        client.close()
+
+    progress.report()
+    print(f"✅ Datos importados en {args.db} desde {args.src}/")
+
+def main():
+    parser = argparse.ArgumentParser(description="Migración de datos de ZIMI entre servidores MongoDB")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subcommands.add_parser("export", help="exportar colecciones a archivos comprimidos")
+    export_parser.add_argument("--mongo-url", default=DEFAULT_MONGO_URL)
+    export_parser.add_argument("--db", default=DEFAULT_DB_NAME)
+    export_parser.add_argument("--out", default="zimi_export", help="directorio de salida")
+    export_parser.add_argument("--format", choices=["bson", "ndjson"], default="bson")
+    export_parser.add_argument("--collections", nargs="*", help="por defecto, todas las colecciones")
+    export_parser.add_argument("--batch-size", type=int, default=1000)
+    export_parser.add_argument("--parallel", type=int, default=4, help="colecciones exportadas a la vez")
+    export_parser.add_argument("--resume", action="store_true", help="continuar desde el último _id exportado")
+
+    import_parser = subcommands.add_parser("import", help="importar una exportación en otra base de datos")
+    import_parser.add_argument("--mongo-url", default=DEFAULT_MONGO_URL)
+    import_parser.add_argument("--db", default=DEFAULT_DB_NAME)
+    import_parser.add_argument("--src", default="zimi_export", help="directorio de la exportación")
+    import_parser.add_argument("--collections", nargs="*", help="por defecto, todas las del manifest")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.add_argument("--writers", type=int, default=4, help="escritores concurrentes por colección")
+    import_parser.add_argument("--parallel", type=int, default=2, help="colecciones importadas a la vez")
+    import_parser.add_argument("--drop", action="store_true", help="vaciar cada colección antes de cargarla")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        if args.resume and os.path.exists(os.path.join(args.out, "manifest.json")):
+            with open(os.path.join(args.out, "manifest.json")) as f:
+                previous_format = json.load(f).get("format")
+            if previous_format and previous_format != args.format:
+                sys.exit(f"La exportación existente usa el formato {previous_format}")
+        asyncio.run(export_data(args))
+    else:
+        asyncio.run(import_data(args))
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(export_data())
+    main()